@@ -49,6 +49,70 @@ def build_assets():
     cmdenv.build()
 
 
+def query_archive(table, start, end):
+    """
+    Prints the archived rows of a table between two dates as NDJSON, ex:
+    fab query_archive:deathevent,2015-01-01,2015-02-01
+    """
+    import json
+    from datetime import datetime
+
+    from standardweb.lib import archive
+
+    start = datetime.strptime(start, '%Y-%m-%d')
+    end = datetime.strptime(end, '%Y-%m-%d')
+
+    with app.app_context():
+        for row in archive.query_archive(table, start, end):
+            print json.dumps(row, default=archive.encode_value)
+
+
+def restore_archive(table, start, end):
+    """
+    Restores the archived rows of a table between two dates to the db, ex:
+    fab restore_archive:deathevent,2015-01-01,2015-02-01
+    """
+    from datetime import datetime
+
+    from standardweb.lib import archive
+
+    start = datetime.strptime(start, '%Y-%m-%d')
+    end = datetime.strptime(end, '%Y-%m-%d')
+
+    with app.app_context():
+        print "Restored %d rows." % archive.restore_archive(table, start, end)
+
+
+def replay_failed_events():
+    """
+    Puts the event ingest requests that failed to record back on the queue.
+    """
+    from standardweb.lib import events
+
+    with app.app_context():
+        print "Replayed %d requests." % events.replay_failed_events()
+
+
+def index_player_search():
+    """
+    Fills the player search index with the names of every existing player.
+    """
+    from standardweb.lib import search
+
+    with app.app_context():
+        print "Indexed %d players." % search.rebuild_index()
+
+
+def import_legacy_faces():
+    """
+    Adds the faces saved by uuid before the face store existed to the store.
+    """
+    from standardweb.lib import faces
+
+    with app.app_context():
+        print "Imported %d faces." % faces.import_legacy_faces()
+
+
 @roles('web')
 def _update_and_restart_services():
     with cd(CODE_DIR):
@@ -0,0 +1,43 @@
+-- merge duplicate count rows into the lowest id for each key before adding unique keys on the
+-- key columns, so that inserting a count for a key that already has a row adds to that row
+
+create temporary table deathcount_keep
+  select min(id) as id, server_id, death_type_id, victim_id, killer_id, sum(ifnull(count, 0)) as total
+  from deathcount group by server_id, death_type_id, victim_id, killer_id having count(*) > 1;
+
+delete c from deathcount c join deathcount_keep k
+  on c.server_id <=> k.server_id and c.death_type_id <=> k.death_type_id
+  and c.victim_id <=> k.victim_id and c.killer_id <=> k.killer_id
+  where c.id != k.id;
+update deathcount c join deathcount_keep k on k.id = c.id set c.count = k.total;
+
+create temporary table killcount_keep
+  select min(id) as id, server_id, kill_type_id, killer_id, sum(ifnull(count, 0)) as total
+  from killcount group by server_id, kill_type_id, killer_id having count(*) > 1;
+
+delete c from killcount c join killcount_keep k
+  on c.server_id <=> k.server_id and c.kill_type_id <=> k.kill_type_id and c.killer_id <=> k.killer_id
+  where c.id != k.id;
+update killcount c join killcount_keep k on k.id = c.id set c.count = k.total;
+
+create temporary table orediscoverycount_keep
+  select min(id) as id, server_id, material_type_id, player_id, sum(ifnull(count, 0)) as total
+  from orediscoverycount group by server_id, material_type_id, player_id having count(*) > 1;
+
+delete c from orediscoverycount c join orediscoverycount_keep k
+  on c.server_id <=> k.server_id and c.material_type_id <=> k.material_type_id
+  and c.player_id <=> k.player_id
+  where c.id != k.id;
+update orediscoverycount c join orediscoverycount_keep k on k.id = c.id set c.count = k.total;
+
+-- the upsert adds to the existing count, which stays null if it started out null
+update deathcount set count = 0 where count is null;
+update killcount set count = 0 where count is null;
+update orediscoverycount set count = 0 where count is null;
+
+-- non-pvp deaths have no killer, and mysql doesn't treat nulls as equal in a unique key
+alter table deathcount add column killer_key int(11) as (ifnull(killer_id, 0)) stored;
+
+alter table deathcount add unique key (server_id, death_type_id, victim_id, killer_key);
+alter table killcount add unique key (server_id, kill_type_id, killer_id);
+alter table orediscoverycount add unique key (server_id, material_type_id, player_id);
@@ -0,0 +1,38 @@
+create table killcount_daily (
+  server_id int(11) not null,
+  kill_type_id int(11) not null,
+  date date not null,
+  player_id int(11) not null,
+  count int(11) not null default 0,
+
+  primary key (server_id, kill_type_id, date, player_id),
+  foreign key (server_id) references server (id),
+  foreign key (kill_type_id) references killtype (id),
+  foreign key (player_id) references player (id)
+) engine=InnoDB default charset=utf8;
+
+create table orediscoverycount_daily (
+  server_id int(11) not null,
+  material_type_id int(11) not null,
+  date date not null,
+  player_id int(11) not null,
+  count int(11) not null default 0,
+
+  primary key (server_id, material_type_id, date, player_id),
+  foreign key (server_id) references server (id),
+  foreign key (material_type_id) references materialtype (id),
+  foreign key (player_id) references player (id)
+) engine=InnoDB default charset=utf8;
+
+# only the longest leaderboard window (30 days) needs to be backfilled from the raw events
+insert into killcount_daily
+select server_id, kill_type_id, date(timestamp), killer_id, count(*)
+from killevent
+where timestamp >= utc_date() - interval 30 day and killer_id is not null
+group by server_id, kill_type_id, date(timestamp), killer_id;
+
+insert into orediscoverycount_daily
+select server_id, material_type_id, date(timestamp), player_id, count(*)
+from orediscoveryevent
+where timestamp >= utc_date() - interval 30 day and player_id is not null
+group by server_id, material_type_id, date(timestamp), player_id;
@@ -0,0 +1,22 @@
+create table orediscovery_chunk (
+  server_id int(11) not null,
+  material_type_id int(11) not null,
+  date date not null,
+  chunk_x int(11) not null,
+  chunk_z int(11) not null,
+  player_id int(11) not null,
+  count int(11) not null default 0,
+
+  primary key (server_id, material_type_id, date, chunk_x, chunk_z, player_id),
+  key server_id_player_id_date (server_id, player_id, date),
+  foreign key (server_id) references server (id),
+  foreign key (material_type_id) references materialtype (id),
+  foreign key (player_id) references player (id)
+) engine=InnoDB default charset=utf8;
+
+# one-off backfill from the raw events, after this the bins are kept up to date as events are logged
+insert into orediscovery_chunk
+select server_id, material_type_id, date(timestamp), floor(x / 16), floor(z / 16), player_id, count(*)
+from orediscoveryevent
+where player_id is not null
+group by server_id, material_type_id, date(timestamp), floor(x / 16), floor(z / 16), player_id;
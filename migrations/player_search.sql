@@ -0,0 +1,21 @@
+create table playersearch_name (
+  id int(11) not null auto_increment,
+  player_id int(11) not null,
+  name varchar(30) collate utf8_bin not null,
+  kind varchar(10) not null,
+
+  primary key (id),
+  key player_id (player_id),
+  key name (name),
+  foreign key (player_id) references player (id)
+) engine=InnoDB default charset=utf8;
+
+create table playersearch_trigram (
+  trigram varchar(3) collate utf8_bin not null,
+  name_id int(11) not null,
+
+  primary key (trigram, name_id),
+  foreign key (name_id) references playersearch_name (id)
+) engine=InnoDB default charset=utf8;
+
+# once created, fill the index with `fab index_player_search`, after which it's kept up to date as players change
@@ -0,0 +1,7 @@
+alter table player add column total_time int(11) not null default 0;
+
+update player p set p.total_time = (
+  select ifnull(sum(s.time_spent), 0) from playerstats s
+  join server on server.id = s.server_id
+  where s.player_id = p.id and server.type = 'survival'
+);
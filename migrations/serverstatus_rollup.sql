@@ -0,0 +1,42 @@
+create table serverstatus_rollup (
+  server_id int(11) not null,
+  resolution int(11) not null,
+  timestamp datetime not null,
+  sample_count int(11) not null default 0,
+  player_count_sum int(11) not null default 0,
+  player_count_min int(11) not null default 0,
+  player_count_max int(11) not null default 0,
+  cpu_load_sum double not null default 0,
+  cpu_load_min double not null default 0,
+  cpu_load_max double not null default 0,
+  tps_sum double not null default 0,
+  tps_min double not null default 0,
+  tps_max double not null default 0,
+
+  primary key (server_id, resolution, timestamp),
+  foreign key (server_id) references server (id)
+) engine=InnoDB default charset=utf8;
+
+# serverstatus timestamps are stored in UTC, so bucket them without any session offset
+set time_zone = '+00:00';
+
+insert into serverstatus_rollup
+select server_id, 900, from_unixtime(floor(unix_timestamp(timestamp) / 900) * 900),
+    count(*), sum(player_count), min(player_count), max(player_count),
+    sum(cpu_load), min(cpu_load), max(cpu_load), sum(tps), min(tps), max(tps)
+from serverstatus
+group by server_id, floor(unix_timestamp(timestamp) / 900);
+
+insert into serverstatus_rollup
+select server_id, 3600, from_unixtime(floor(unix_timestamp(timestamp) / 3600) * 3600),
+    count(*), sum(player_count), min(player_count), max(player_count),
+    sum(cpu_load), min(cpu_load), max(cpu_load), sum(tps), min(tps), max(tps)
+from serverstatus
+group by server_id, floor(unix_timestamp(timestamp) / 3600);
+
+insert into serverstatus_rollup
+select server_id, 86400, from_unixtime(floor(unix_timestamp(timestamp) / 86400) * 86400),
+    count(*), sum(player_count), min(player_count), max(player_count),
+    sum(cpu_load), min(cpu_load), max(cpu_load), sum(tps), min(tps), max(tps)
+from serverstatus
+group by server_id, floor(unix_timestamp(timestamp) / 86400);
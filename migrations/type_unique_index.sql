@@ -0,0 +1,22 @@
+-- point references to duplicate types at the lowest id for each name before removing them
+
+create temporary table deathtype_keep
+  select t.id, keep.id as keep_id from deathtype t
+  join (select type, min(id) as id from deathtype group by type) keep on keep.type = t.type
+  where t.id != keep.id;
+
+update deathevent e join deathtype_keep k on k.id = e.death_type_id set e.death_type_id = k.keep_id;
+update deathcount c join deathtype_keep k on k.id = c.death_type_id set c.death_type_id = k.keep_id;
+delete t from deathtype t join deathtype_keep k on k.id = t.id;
+
+create temporary table killtype_keep
+  select t.id, keep.id as keep_id from killtype t
+  join (select type, min(id) as id from killtype group by type) keep on keep.type = t.type
+  where t.id != keep.id;
+
+update killevent e join killtype_keep k on k.id = e.kill_type_id set e.kill_type_id = k.keep_id;
+update killcount c join killtype_keep k on k.id = c.kill_type_id set c.kill_type_id = k.keep_id;
+delete t from killtype t join killtype_keep k on k.id = t.id;
+
+alter table deathtype add unique key (type);
+alter table killtype add unique key (type);
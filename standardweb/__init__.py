@@ -1,3 +1,4 @@
+from datetime import timedelta
 import socket
 import traceback
 
@@ -7,6 +8,7 @@ from flask import Flask, g, got_request_exception, Request
 from flask_cdn import CDN
 from flask_sqlalchemy import SQLAlchemy
 from kombu import Queue, Exchange
+from redis import StrictRedis
 import rollbar
 from rollbar.contrib.flask import report_exception
 import statsd
@@ -28,6 +30,8 @@ cdn = CDN(app)
 
 cache = MemcachedCache(app.config['MEMCACHED_URLS'])
 
+redis_client = StrictRedis.from_url(app.config['REDIS_URL'], socket_timeout=1)
+
 try:
     stats = statsd.StatsClient(host=app.config['STATSD_HOST'], port=app.config['STATSD_PORT'])
 except socket.gaierror:
@@ -44,6 +48,7 @@ def make_celery(app):
             Queue('default', Exchange('default'), routing_key='default'),
             Queue('minute_query', Exchange('minute_query'), routing_key='minute_query'),
             Queue('check_uuids', Exchange('check_uuids'), routing_key='check_uuids'),
+            Queue('faces', Exchange('faces'), routing_key='faces'),
         ),
         'CELERY_ROUTES': {
             'standardweb.jobs.query.minute_query': {
@@ -51,6 +56,9 @@ def make_celery(app):
             },
             'standardweb.jobs.usernames.check_uuids': {
                 'queue': 'check_uuids'
+            },
+            'standardweb.tasks.faces.refresh_faces_task': {
+                'queue': 'faces'
             }
         },
         'CELERYBEAT_SCHEDULE': {
@@ -58,6 +66,26 @@ def make_celery(app):
                 'task': 'standardweb.jobs.query.minute_query',
                 'schedule': crontab()
             },
+            'flush_counts': {
+                'task': 'standardweb.jobs.counters.flush_counts',
+                'schedule': timedelta(seconds=app.config['COUNT_BUFFER_FLUSH_INTERVAL'])
+            },
+            'prune_daily_counts': {
+                'task': 'standardweb.jobs.counters.prune_daily_counts',
+                'schedule': crontab(minute=30, hour=11)  # 4:30AM PST, after the archive
+            },
+            'refresh_autocomplete_snapshot': {
+                'task': 'standardweb.jobs.autocomplete.refresh_autocomplete_snapshot',
+                'schedule': crontab(minute='*/20')
+            },
+            'evict_faces': {
+                'task': 'standardweb.jobs.faces.evict_faces',
+                'schedule': crontab(minute=30)
+            },
+            'archive_tables': {
+                'task': 'standardweb.jobs.archive.archive_tables',
+                'schedule': crontab(minute=0, hour=11)  # 4AM PST, after the backup
+            },
             'db_backup': {
                 'task': 'standardweb.jobs.backup.db_backup',
                 'schedule': crontab(minute=0, hour=10)  # 3AM PST
@@ -133,7 +161,11 @@ if app.config.has_key('ROLLBAR_ACCESS_TOKEN'):
 import assets
 
 import jobs.query
+import jobs.archive
+import jobs.autocomplete
 import jobs.backup
+import jobs.counters
+import jobs.faces
 import jobs.usernames
 
 import middleware
@@ -141,6 +173,8 @@ import models
 
 import tasks.access_log
 import tasks.email
+import tasks.events
+import tasks.faces
 import tasks.messages
 import tasks.notifications
 import tasks.realtime
@@ -160,3 +194,24 @@ import views.notifications
 import views.player
 import views.settings
 import views.static_files
+
+
+def warm_worker():
+    from standardweb.lib import autocomplete
+
+    with app.app_context():
+        try:
+            autocomplete.index.warm()
+        except Exception:
+            rollbar.report_exc_info()
+        finally:
+            db.session.remove()
+
+
+# only available when running under uwsgi
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    postfork(warm_worker)
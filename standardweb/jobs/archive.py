@@ -0,0 +1,22 @@
+import rollbar
+
+from standardweb import app, celery, db
+from standardweb import stats as statsd
+from standardweb.lib import archive
+from standardweb.lib.cache import Lease
+
+
+@celery.task()
+def archive_tables():
+    with Lease('archive-tables', time=app.config['ARCHIVE_LEASE_TIME']) as acquired:
+        if not acquired:
+            return
+
+        for table_name, months in app.config['ARCHIVE_POLICIES'].iteritems():
+            try:
+                archived = archive.archive_table(table_name, months)
+            except Exception:
+                db.session.rollback()
+                rollbar.report_exc_info(extra_data={'table': table_name})
+            else:
+                statsd.incr('archive.%s.archived' % table_name, archived)
@@ -0,0 +1,7 @@
+from standardweb import celery
+from standardweb.lib import autocomplete
+
+
+@celery.task()
+def refresh_autocomplete_snapshot():
+    autocomplete.refresh_snapshot()
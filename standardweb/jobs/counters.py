@@ -0,0 +1,26 @@
+import rollbar
+
+from standardweb import celery, db
+from standardweb import stats as statsd
+from standardweb.lib import counters, leaderboards
+from standardweb.models import DeathCount, KillCount, KillCountDaily, OreDiscoveryCount, OreDiscoveryCountDaily
+
+
+@celery.task()
+def flush_counts():
+    for cls in (DeathCount, KillCount, KillCountDaily, OreDiscoveryCount, OreDiscoveryCountDaily):
+        try:
+            flushed = counters.flush(cls)
+        except Exception:
+            db.session.rollback()
+            rollbar.report_exc_info(extra_data={'table': cls.__tablename__})
+        else:
+            if flushed:
+                statsd.incr('count_buffer.%s.flushed' % cls.__tablename__, flushed)
+
+
+@celery.task()
+def prune_daily_counts():
+    pruned = leaderboards.prune_daily_counts()
+
+    statsd.incr('count_buffer.daily.pruned', pruned)
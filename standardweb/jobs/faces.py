@@ -0,0 +1,13 @@
+from standardweb import app, celery
+from standardweb import stats as statsd
+from standardweb.lib import faces
+from standardweb.lib.cache import Lease
+
+
+@celery.task()
+def evict_faces():
+    with Lease('evict-faces', time=app.config['FACE_EVICTION_LEASE_TIME']) as acquired:
+        if not acquired:
+            return
+
+        statsd.incr('faces.evicted', faces.evict_faces())
@@ -1,20 +1,24 @@
+import bisect
 from datetime import datetime, timedelta
 import time
 
 import requests
 import rollbar
-from sqlalchemy import not_
+from sqlalchemy import bindparam, func, not_
 from sqlalchemy.orm import joinedload
 
-from standardweb import app, celery, db
+from standardweb import app, cache, celery, db
 from standardweb import stats as statsd
-from standardweb.lib import api, geoip
+from standardweb.lib import api, concurrency, geoip
 from standardweb.lib import helpers as h
 from standardweb.lib import player as libplayer
+from standardweb.lib import profiles, rank
+from standardweb.lib.cache import Lease
+from standardweb.lib.circuit_breaker import STATE_CLOSED
 from standardweb.lib.constants import *
 from standardweb.models import (
     AuditLog, Group, PlayerStats, GroupInvite, Player, PlayerActivity,
-    IPTracking, ServerStatus, MojangStatus, Server,
+    IPTracking, ServerStatus, ServerStatusRollup, MojangStatus, Server,
 )
 
 
@@ -138,10 +142,249 @@ def _handle_groups(server, server_groups):
     db.session.commit()
 
 
-def _query_server(server, mojang_status):
-    server_status = api.get_server_status(server) or {}
-    
-    player_stats = []
+def _get_or_create_players(players):
+    """
+    Loads every player in the polled list in a single query, creating or
+    renaming players as needed. Returns a map of uuid -> Player.
+    """
+    uuids = [x['uuid'] for x in players]
+
+    player_map = {
+        player.uuid: player for player in Player.query.options(
+            joinedload(Player.titles)
+        ).filter(
+            Player.uuid.in_(uuids)
+        )
+    }
+
+    for player_info in players:
+        username = player_info['username']
+        uuid = player_info['uuid']
+
+        player = player_map.get(uuid)
+
+        if player:
+            if player.username != username:
+                h.avoid_duplicate_username(username)
+
+                player.set_username(username)
+                player.save(commit=False)
+        else:
+            h.avoid_duplicate_username(username)
+
+            player = Player(username=username, uuid=uuid)
+            player.save(commit=False)
+
+            player_map[uuid] = player
+
+            statsd.incr('player.created')
+
+    # assign ids to any newly created players
+    db.session.flush()
+
+    return player_map
+
+
+def _get_latest_activity_types(server, player_ids):
+    """
+    Returns a map of player id -> type of the latest activity on the given server
+    for each of the given players that has any activity at all.
+    """
+    if not player_ids:
+        return {}
+
+    latest = db.session.query(
+        func.max(PlayerActivity.id).label('id')
+    ).filter(
+        PlayerActivity.server_id == server.id,
+        PlayerActivity.player_id.in_(player_ids)
+    ).group_by(
+        PlayerActivity.player_id
+    ).subquery()
+
+    result = db.session.query(
+        PlayerActivity.player_id,
+        PlayerActivity.activity_type
+    ).join(
+        latest, PlayerActivity.id == latest.c.id
+    )
+
+    return {player_id: activity_type for player_id, activity_type in result}
+
+
+def _insert_activities(server, player_ids, activity_type):
+    if not player_ids:
+        return
+
+    db.session.execute(PlayerActivity.__table__.insert(), [{
+        'server_id': server.id,
+        'player_id': player_id,
+        'activity_type': activity_type
+    } for player_id in player_ids])
+
+
+def _track_ips(player_ips):
+    """
+    Inserts an IPTracking row for every (player id, ip) pair not seen before.
+    """
+    if not player_ips:
+        return
+
+    existing = set(
+        db.session.query(
+            IPTracking.player_id,
+            IPTracking.ip
+        ).filter(
+            IPTracking.player_id.in_(set(x[0] for x in player_ips)),
+            IPTracking.ip.in_(set(x[1] for x in player_ips))
+        )
+    )
+
+    missing = set(player_ips) - existing
+
+    if missing:
+        db.session.execute(IPTracking.__table__.insert(), [{
+            'player_id': player_id,
+            'ip': ip
+        } for player_id, ip in missing])
+
+
+def _update_player_stats(server, online_players, minutes):
+    """
+    Credits `minutes` of play time to each of the given (player id, player info) pairs,
+    updating existing stats in a single executemany and inserting missing stats in a
+    single multi-row insert, along with each player's total time if it's a survival
+    server. Returns a map of player id -> new time spent.
+    """
+    if not online_players:
+        return {}
+
+    player_ids = [player_id for player_id, _ in online_players]
+
+    existing = {}
+    for stats_id, player_id, time_spent in db.session.query(
+        PlayerStats.id,
+        PlayerStats.player_id,
+        PlayerStats.time_spent
+    ).filter(
+        PlayerStats.server_id == server.id,
+        PlayerStats.player_id.in_(player_ids)
+    ).order_by(
+        PlayerStats.id
+    ):
+        existing.setdefault(player_id, (stats_id, time_spent))
+
+    now = datetime.utcnow()
+    time_spent_map = {}
+    updates = []
+    inserts = []
+
+    for player_id, player_info in online_players:
+        pvp_logs = player_info.get('pvp_logs')
+
+        if player_id in existing:
+            stats_id, time_spent = existing[player_id]
+
+            updates.append({
+                'stats_id': stats_id,
+                'last_seen': now,
+                'pvp_logs': pvp_logs
+            })
+
+            time_spent_map[player_id] = (time_spent or 0) + minutes
+        else:
+            inserts.append({
+                'server_id': server.id,
+                'player_id': player_id,
+                'last_seen': now,
+                'pvp_logs': pvp_logs,
+                'time_spent': minutes
+            })
+
+            time_spent_map[player_id] = minutes
+
+    table = PlayerStats.__table__
+
+    if updates:
+        db.session.execute(
+            table.update().where(
+                table.c.id == bindparam('stats_id')
+            ).values(
+                time_spent=func.ifnull(table.c.time_spent, 0) + minutes
+            ),
+            updates
+        )
+
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+    if server.type == 'survival':
+        player_table = Player.__table__
+
+        db.session.execute(
+            player_table.update().where(
+                player_table.c.id.in_(player_ids)
+            ).values(
+                total_time=player_table.c.total_time + minutes
+            )
+        )
+
+    return time_spent_map
+
+
+def _get_ranks(server, time_spents):
+    """
+    Returns a map of time spent -> rank on the given server for each of the given
+    time spent values, falling back to a single query if the rank index is unavailable.
+    """
+    ranks = rank.get_ranks(server.id, time_spents)
+    if ranks is not None:
+        return ranks
+
+    if not time_spents:
+        return {}
+
+    higher = sorted(
+        x for x, in db.session.query(
+            PlayerStats.time_spent
+        ).filter(
+            PlayerStats.server_id == server.id,
+            PlayerStats.time_spent > min(time_spents)
+        )
+    )
+
+    return {
+        time_spent: len(higher) - bisect.bisect_right(higher, time_spent) + 1
+        for time_spent in time_spents
+    }
+
+
+class PollAbandoned(Exception):
+    pass
+
+
+def _get_timeout(deadline):
+    """
+    Returns the server API timeouts for a call made while polling a server, cut
+    down to what's left until the poll's deadline.
+    """
+    remaining = max(deadline - time.time(), 0.1)
+
+    return (
+        min(app.config['MC_API_CONNECT_TIMEOUT'], remaining),
+        min(app.config['MC_API_READ_TIMEOUT'], remaining)
+    )
+
+
+def _check_poll(lease, deadline):
+    # once the poll is given up on, the next run can get the lease and credit the
+    # same minutes, so nothing can be committed past that point
+    if time.time() >= deadline or not lease.is_held():
+        raise PollAbandoned()
+
+
+def _query_server(server, mojang_status, lease, deadline, all_server_ids, poll_time, minutes=1):
+    server_status = api.get_server_status(server, timeout=_get_timeout(deadline)) or {}
 
     players_to_sync_ban = Player.query.filter(
         Player.uuid.in_(server_status.get('banned_uuids', [])),
@@ -167,44 +410,16 @@ def _query_server(server, mojang_status):
             )
 
     players = server_status.get('players', [])
-    online_player_ids = []
-    players_to_nok_ban = []
-    for player_info in players:
-        username = player_info['username']
-        uuid = player_info['uuid']
 
-        player = Player.query.options(
-            joinedload(Player.titles)
-        ).filter_by(uuid=uuid).first()
+    player_map = _get_or_create_players(players)
 
-        if player:
-            if player.username != username:
-                h.avoid_duplicate_username(username)
-
-                player.set_username(username)
-                player.save(commit=False)
-        else:
-            h.avoid_duplicate_username(username)
+    online_players = []
+    player_ips = []
+    players_to_nok_ban = []
+    for player_info in players:
+        player = player_map[player_info['uuid']]
 
-            player = Player(username=username, uuid=uuid)
-            player.save(commit=False)
-
-            statsd.incr('player.created')
-        
-        online_player_ids.append(player.id)
-
-        last_activity = PlayerActivity.query.filter_by(
-            server=server, player=player
-        ).order_by(
-            PlayerActivity.timestamp.desc()
-        ).first()
-        
-        # if the last activity for this player is an 'exit' activity (or there isn't an activity),
-        # create a new 'enter' activity since they just joined this minute
-        if not last_activity or last_activity.activity_type == PLAYER_ACTIVITY_TYPES['exit']:
-            enter = PlayerActivity(server=server, player=player,
-                                   activity_type=PLAYER_ACTIVITY_TYPES['enter'])
-            enter.save(commit=False)
+        online_players.append((player.id, player_info))
 
         if server.id == app.config['MAIN_SERVER_ID']:
             if player.banned:
@@ -217,38 +432,49 @@ def _query_server(server, mojang_status):
                     commit=False
                 )
 
-            nickname_ansi = player_info.get('nickname_ansi')
-            nickname = player_info.get('nickname')
-
-            player.nickname_ansi = nickname_ansi
-            player.nickname = nickname
+            player.nickname_ansi = player_info.get('nickname_ansi')
+            player.nickname = player_info.get('nickname')
             player.save(commit=False)
 
         ip = player_info.get('address')
         if ip:
-            if not IPTracking.query.filter_by(ip=ip, player=player).first():
-                existing_player_ip = IPTracking(ip=ip, player=player)
-                existing_player_ip.save(commit=False)
+            player_ips.append((player.id, ip))
 
             if geoip.is_nok(ip):
                 players_to_nok_ban.append((player, ip))
 
-        stats = PlayerStats.query.filter_by(server=server, player=player).first()
-        if not stats:
-            stats = PlayerStats(server=server, player=player)
+    online_player_ids = [player_id for player_id, _ in online_players]
+
+    # if the last activity for a player is an 'exit' activity (or there isn't an activity),
+    # create a new 'enter' activity since they just joined this minute
+    latest_activity_types = _get_latest_activity_types(server, online_player_ids)
+    _insert_activities(server, [
+        player_id for player_id in online_player_ids
+        if latest_activity_types.get(player_id, PLAYER_ACTIVITY_TYPES['exit']) == PLAYER_ACTIVITY_TYPES['exit']
+    ], PLAYER_ACTIVITY_TYPES['enter'])
+
+    _track_ips(player_ips)
+
+    rank.ensure_index(server.id)
+
+    time_spent_map = _update_player_stats(server, online_players, minutes)
+    rank.update_index(server.id, time_spent_map)
+    profiles.record_play(server, online_players, time_spent_map, all_server_ids)
+
+    rank_map = _get_ranks(server, time_spent_map.values())
 
-        stats.last_seen = datetime.utcnow()
-        stats.pvp_logs = player_info.get('pvp_logs')
-        stats.time_spent = (stats.time_spent or 0) + 1
-        stats.save(commit=False)
+    player_stats = []
+    for player_info in players:
+        player = player_map[player_info['uuid']]
+        time_spent = time_spent_map[player.id]
 
         titles = [{'name': x.name, 'broadcast': x.broadcast} for x in player.titles]
 
         player_stats.append({
             'username': player.username,
             'uuid': player.uuid,
-            'minutes': stats.time_spent,
-            'rank': stats.rank,
+            'minutes': time_spent,
+            'rank': rank_map[time_spent],
             'titles': titles
         })
 
@@ -257,34 +483,41 @@ def _query_server(server, mojang_status):
             libplayer.ban_player(player, with_ip=True, source='query', ip=ip, commit=False)
 
     five_minutes_ago = datetime.utcnow() - timedelta(minutes=10)
-    result = PlayerStats.query.filter(PlayerStats.server == server,
-                                      PlayerStats.last_seen > five_minutes_ago)
+    result = db.session.query(PlayerStats.player_id).filter(PlayerStats.server == server,
+                                                            PlayerStats.last_seen > five_minutes_ago)
     recent_player_ids = [x.player_id for x in result]
-    
+
     # find all players that have recently left and insert an 'exit' activity for them
     # if their last activity was an 'enter'
-    for player_id in set(recent_player_ids) - set(online_player_ids):
-        latest_activity = PlayerActivity.query.filter_by(server=server, player_id=player_id)\
-        .order_by(PlayerActivity.timestamp.desc()).first()
-        
-        if latest_activity and latest_activity.activity_type == PLAYER_ACTIVITY_TYPES['enter']:
-            ex = PlayerActivity(server=server, player_id=player_id,
-                                activity_type=PLAYER_ACTIVITY_TYPES['exit'])
-            ex.save(commit=False)
-    
+    left_player_ids = list(set(recent_player_ids) - set(online_player_ids))
+    latest_activity_types = _get_latest_activity_types(server, left_player_ids)
+    _insert_activities(server, [
+        player_id for player_id in left_player_ids
+        if latest_activity_types.get(player_id) == PLAYER_ACTIVITY_TYPES['enter']
+    ], PLAYER_ACTIVITY_TYPES['exit'])
+
     player_count = server_status.get('numplayers', 0) or 0
     cpu_load = server_status.get('load', 0) or 0
     tps = server_status.get('tps', 0) or 0
     
-    status = ServerStatus(server=server, player_count=player_count, cpu_load=cpu_load, tps=tps)
-    status.save(commit=True)
+    status = ServerStatus(server=server, player_count=player_count, cpu_load=cpu_load, tps=tps,
+                          timestamp=datetime.utcnow())
+    ServerStatusRollup.record(status)
+    status.save(commit=False)
+
+    _check_poll(lease, deadline)
+    db.session.commit()
+
+    # the minutes are credited once they're committed, so the poll time has to be
+    # recorded before anything else can fail or the next run would credit them again
+    _set_last_poll_time(server, poll_time)
 
     api.send_stats(server, {
         'player_stats': player_stats,
-        'session': mojang_status.session,
-        'account': mojang_status.account,
-        'auth': mojang_status.auth
-    })
+        'session': mojang_status['session'],
+        'account': mojang_status['account'],
+        'auth': mojang_status['auth']
+    }, timeout=_get_timeout(deadline))
 
     _handle_groups(server, server_status.get('groups', []))
 
@@ -314,23 +547,112 @@ def _get_mojang_status():
     return mojang_status
 
 
+def _last_poll_cache_key(server):
+    return 'minute-query-last-poll-%d' % server.id
+
+
+def _get_elapsed_minutes(server, poll_time):
+    """
+    Returns the number of minutes of play time to credit for a poll of the server,
+    which is more than one if previous runs were skipped or didn't complete.
+    """
+    last_poll_time = cache.get(_last_poll_cache_key(server))
+
+    if not last_poll_time:
+        return 1
+
+    minutes = int(round((poll_time - last_poll_time) / 60.0))
+
+    return max(1, min(minutes, app.config['MINUTE_QUERY_MAX_CATCH_UP']))
+
+
+def _set_last_poll_time(server, poll_time):
+    cache.set(_last_poll_cache_key(server), poll_time, 86400)
+
+
+def _report_server_health(server_ids):
+    for server in Server.query.filter(Server.id.in_(server_ids)):
+        health = api.get_server_health(server)
+
+        statsd.gauge('server_api.health.%d.open' % server.id, int(health['state'] != STATE_CLOSED))
+        statsd.gauge('server_api.health.%d.recent_failures' % server.id, health['recent_failures'])
+
+        if health['average_latency'] is not None:
+            statsd.gauge('server_api.health.%d.average_latency' % server.id, health['average_latency'])
+
+
 @celery.task()
 def minute_query():
     mojang_status = _get_mojang_status()
 
+    # plain values, since the servers are queried from other threads with their own sessions
+    mojang_status = {
+        'session': mojang_status.session,
+        'account': mojang_status.account,
+        'auth': mojang_status.auth
+    }
+
+    servers = Server.query.all()
+
+    all_server_ids = [server.id for server in servers]
+    server_ids = [server.id for server in servers if server.online]
+
+    def poll_server(server):
+        deadline = time.time() + app.config['MINUTE_QUERY_SERVER_DEADLINE']
+
+        lease = Lease('minute-query-%d' % server.id, time=app.config['MINUTE_QUERY_LEASE_TIME'])
+
+        with lease as acquired:
+            if not acquired:
+                # a previous run is still polling this server, the next run to get
+                # the lease will credit the minutes skipped here
+                statsd.incr('minute_query.skipped')
+                return False
+
+            poll_time = int(time.time())
+
+            try:
+                _query_server(server, mojang_status, lease, deadline, all_server_ids, poll_time,
+                              minutes=_get_elapsed_minutes(server, poll_time))
+            except PollAbandoned:
+                db.session.rollback()
+                statsd.incr('minute_query.abandoned')
+                return False
+
+            return True
+
+    start = time.time()
+
+    results = concurrency.map_servers(
+        poll_server,
+        server_ids,
+        pool_size=app.config['MINUTE_QUERY_POOL_SIZE'],
+        deadline=app.config['MINUTE_QUERY_SERVER_DEADLINE']
+    )
+
     durations = []
 
-    for server in Server.query.filter_by(online=True):
-        start = int(round(time.time() * 1000))
+    for result in results:
+        duration = int(round(result.duration * 1000))
+        durations.append((result.server_id, result.status, duration))
+
+        statsd.timing('minute_query.servers.%d' % result.server_id, duration)
+
+        if result.status == concurrency.STATUS_ERROR:
+            rollbar.report_exc_info(result.exc_info, extra_data={'server_id': result.server_id})
+        elif result.status == concurrency.STATUS_TIMEOUT:
+            rollbar.report_message('Minute query deadline exceeded', level='warning', extra_data={
+                'server_id': result.server_id,
+                'duration': duration
+            })
 
-        try:
-            _query_server(server, mojang_status)
-        except:
-            db.session.rollback()
-            rollbar.report_exc_info(extra_data={'server_id': server.id})
-            raise
+        if result.status == concurrency.STATUS_OK and not result.result:
+            print 'Skipped server %d, previous query still running' % result.server_id
         else:
-            db.session.commit()
-            duration = int(round(time.time() * 1000)) - start
-            durations.append((server.id, duration))
-            print 'Done with server %d in %d milliseconds' % (server.id, duration)
+            print 'Done with server %d (%s) in %d milliseconds' % (result.server_id, result.status, duration)
+
+    statsd.timing('minute_query.duration', int(round((time.time() - start) * 1000)))
+
+    _report_server_health(server_ids)
+
+    return durations
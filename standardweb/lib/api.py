@@ -1,8 +1,18 @@
+import json
+import time
+
+import redis
+import requests
+from requests.adapters import HTTPAdapter
 import rollbar
+from urllib3.exceptions import NewConnectionError
 
-from standardweb import app
+from standardweb import app, redis_client, stats
+from standardweb.lib import concurrency
+from standardweb.lib.circuit_breaker import CircuitBreaker
 from standardweb.lib.constants import *
 from standardweb.models import Server
+from standardweb.tasks.server_api import api_batch_flush_task
 from standardweb.tasks.server_api import api_forum_post_task
 from standardweb.tasks.server_api import api_player_action_task
 from standardweb.tasks.server_api import api_new_message_task
@@ -11,6 +21,12 @@ from standardweb.vendor.minecraft_api import MinecraftJsonApi
 
 apis = {}
 
+BROADCAST_OK = 'ok'
+BROADCAST_FAILED = 'failed'
+# the call never reached the server, so it can be sent again without the server
+# possibly acting on it twice
+BROADCAST_NOT_SENT = 'not_sent'
+
 
 def _global_console_command(command):
     for server in Server.query.filter_by(online=True):
@@ -19,28 +35,11 @@ def _global_console_command(command):
         api.call('runConsoleCommand', command)
 
 
-def api_call(server, type, data=None):
-    api = get_api(server.address)
-
-    try:
-        if data:
-            result = api.call(type, data)
-        else:
-            result = api.call(type)
-    except Exception:
-        rollbar.report_exc_info(
-            extra_data={
-                'server_id': server.id,
-                'type': type,
-                'data': data
-            }
-        )
-
-        return None
-
+def _check_result(server, type, data, result):
     if not result or result.get('result') == API_CALL_RESULTS['exception']:
         extra_data = {
             'server_id': server.id,
+            'type': type,
             'data': data
         }
 
@@ -56,25 +55,272 @@ def api_call(server, type, data=None):
     return result
 
 
+def _was_sent(e):
+    """
+    Returns whether a call that failed with the given exception could have reached
+    the server anyway, which is anything but failing to connect.
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return False
+
+    if isinstance(e, requests.ConnectionError):
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return not isinstance(reason, NewConnectionError)
+
+    return True
+
+
+def api_call(server, type, data=None, timeout=None):
+    _, result = _api_call(server, type, data=data, timeout=timeout)
+
+    return result
+
+
+def _api_call(server, type, data=None, timeout=None):
+    """
+    Returns a tuple of whether the call could have reached the server and its
+    result, None if it failed.
+    """
+    breaker = get_circuit_breaker(server)
+
+    if not breaker.allow_request():
+        stats.incr('server_api.circuit_open')
+        return False, None
+
+    api = get_api(server.address)
+    pool = _get_connection_pool(server.address)
+    num_connections = pool.num_connections
+
+    start = time.time()
+
+    try:
+        if data:
+            result = api.call(type, data, timeout=timeout)
+        else:
+            result = api.call(type, timeout=timeout)
+    except Exception as e:
+        stats.incr('server_api.failures')
+
+        # only report the failure that takes the server out of rotation
+        if breaker.record_failure():
+            rollbar.report_exc_info(
+                extra_data={
+                    'server_id': server.id,
+                    'type': type,
+                    'data': data,
+                    'circuit': 'opened'
+                }
+            )
+
+        return _was_sent(e), None
+    else:
+        breaker.record_success((time.time() - start) * 1000)
+    finally:
+        stats.timing('server_api.calls.%s' % type, int(round((time.time() - start) * 1000)))
+        stats.incr('server_api.connections.%s' % (
+            'new' if pool.num_connections > num_connections else 'reused'
+        ))
+
+    return True, _check_result(server, type, data, result)
+
+
+def api_call_multiple(server, calls, timeout=None):
+    """
+    Sends a list of (type, data) calls to the server in a single call-multiple
+    round trip. Returns the result of each call in the same order, with None for
+    any call that failed.
+    """
+    if not calls:
+        return []
+
+    breaker = get_circuit_breaker(server)
+
+    if not breaker.allow_request():
+        stats.incr('server_api.circuit_open')
+        return [None] * len(calls)
+
+    api = get_api(server.address)
+
+    types = [type for type, _ in calls]
+    args = [[data] if data else [] for _, data in calls]
+
+    start = time.time()
+
+    try:
+        response = json.loads(api.call_multiple(types, args, timeout=timeout))
+
+        if response['result'] != 'success':
+            raise Exception('(%s) %s' % (response['result'], response.get(response['result'])))
+
+        results = response['success']
+    except Exception:
+        stats.incr('server_api.failures')
+
+        if breaker.record_failure():
+            rollbar.report_exc_info(
+                extra_data={
+                    'server_id': server.id,
+                    'types': types,
+                    'circuit': 'opened'
+                }
+            )
+
+        return [None] * len(calls)
+    else:
+        breaker.record_success((time.time() - start) * 1000)
+    finally:
+        stats.timing('server_api.calls.multiple', int(round((time.time() - start) * 1000)))
+        stats.incr('server_api.calls.batched', len(calls))
+
+    retval = []
+    for (type, data), result in zip(calls, results):
+        # unwrap the per-call envelope if the server wraps each result in one
+        if isinstance(result, dict) and result.get('result') == 'success' and 'success' in result:
+            result = result['success']
+
+        retval.append(_check_result(server, type, data, result))
+
+    return retval
+
+
+def broadcast(type, data=None, server_ids=None):
+    """
+    Sends the same call to the given servers, or every online server, concurrently
+    on a bounded pool with a deadline per server.
+
+    Returns a map of server id -> status, one of BROADCAST_OK, BROADCAST_FAILED,
+    BROADCAST_NOT_SENT, or the concurrency error/timeout statuses.
+    """
+    if server_ids is None:
+        server_ids = [server.id for server in Server.query.filter_by(online=True)]
+
+    results = concurrency.map_servers(
+        lambda server: _api_call(server, type, data=data),
+        server_ids,
+        pool_size=app.config['BROADCAST_POOL_SIZE'],
+        deadline=app.config['BROADCAST_SERVER_DEADLINE']
+    )
+
+    statuses = {}
+
+    for result in results:
+        if result.status == concurrency.STATUS_OK:
+            sent, call_result = result.result
+
+            if call_result is not None:
+                statuses[result.server_id] = BROADCAST_OK
+            else:
+                statuses[result.server_id] = BROADCAST_FAILED if sent else BROADCAST_NOT_SENT
+        else:
+            statuses[result.server_id] = result.status
+
+            if result.status == concurrency.STATUS_ERROR:
+                rollbar.report_exc_info(result.exc_info, extra_data={
+                    'server_id': result.server_id,
+                    'type': type
+                })
+
+    return statuses
+
+
+def _batch_queue_key(server_id):
+    return 'api-batch-%d' % server_id
+
+
+def _batch_scheduled_key(server_id):
+    return 'api-batch-scheduled-%d' % server_id
+
+
+def queue_api_call(server, type, data=None):
+    """
+    Queues a call whose result isn't needed to be sent together with any other
+    calls queued for the same server within MC_API_BATCH_WINDOW seconds.
+    """
+    window = app.config['MC_API_BATCH_WINDOW']
+
+    try:
+        pipe = redis_client.pipeline()
+        pipe.rpush(_batch_queue_key(server.id), json.dumps({
+            'type': type,
+            'data': data
+        }))
+        pipe.set(_batch_scheduled_key(server.id), 1, nx=True, ex=window * 10)
+        _, schedule = pipe.execute()
+    except redis.RedisError:
+        # can't batch right now, send the call on its own instead
+        api_call(server, type, data=data)
+        return
+
+    if schedule:
+        api_batch_flush_task.apply_async((server.id,), countdown=window)
+
+
+def flush_queued_api_calls(server):
+    """
+    Sends the calls queued for the server in call-multiple batches.
+    """
+    batch_size = app.config['MC_API_BATCH_SIZE']
+
+    while True:
+        # clear the scheduled flag before taking the batch so that any call queued
+        # after this point schedules another flush
+        pipe = redis_client.pipeline()
+        pipe.delete(_batch_scheduled_key(server.id))
+        pipe.lrange(_batch_queue_key(server.id), 0, batch_size - 1)
+        pipe.ltrim(_batch_queue_key(server.id), batch_size, -1)
+        _, calls, _ = pipe.execute()
+
+        if not calls:
+            return
+
+        calls = [json.loads(call) for call in calls]
+
+        api_call_multiple(server, [(call['type'], call['data']) for call in calls])
+
+        if len(calls) < batch_size:
+            return
+
+
 def get_api(host):
     if host not in apis:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=app.config['MC_API_POOL_SIZE']
+        ))
+
         apis[host] = MinecraftJsonApi(
             host=host,
             port=app.config['MC_API_PORT'],
             username=app.config['MC_API_USERNAME'],
             password=app.config['MC_API_PASSWORD'],
-            salt=app.config['MC_API_SALT']
+            salt=app.config['MC_API_SALT'],
+            session=session,
+            timeout=(app.config['MC_API_CONNECT_TIMEOUT'], app.config['MC_API_READ_TIMEOUT'])
         )
 
     return apis[host]
 
 
-def get_server_status(server, minimal=False):
+def get_circuit_breaker(server):
+    return CircuitBreaker(server.address)
+
+
+def get_server_health(server):
+    return get_circuit_breaker(server).get_health()
+
+
+def _get_connection_pool(host):
+    adapter = get_api(host).session.get_adapter('http://')
+    return adapter.poolmanager.connection_from_host(host, port=app.config['MC_API_PORT'], scheme='http')
+
+
+def get_server_status(server, minimal=False, timeout=None):
     data = {
         'minimal': minimal
     }
 
-    resp = api_call(server, 'server_status', data=data)
+    resp = api_call(server, 'server_status', data=data, timeout=timeout)
 
     return resp.get('data') if resp else None
 
@@ -83,8 +329,8 @@ def send_player_stats(server, stats):
     api_call(server, 'player_stats', data=stats)
 
 
-def send_stats(server, data):
-    api_call(server, 'stats', data=data)
+def send_stats(server, data, timeout=None):
+    api_call(server, 'stats', data=data, timeout=timeout)
 
 
 def ban_player(player, reason, with_ip):
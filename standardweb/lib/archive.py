@@ -0,0 +1,209 @@
+"""
+Archival of old rows from the high-volume event tables into monthly gzipped NDJSON
+files under ARCHIVE_DIR/<table>/<YYYY-MM>.ndjson.gz.
+
+Rows are written to their month's file and fsynced before they're deleted from
+the db, so a crash in between leaves them in both places and they're archived
+again by the next run. Archive files can therefore hold the same row more than
+once, which reading and restoring skip over by id.
+"""
+from collections import defaultdict
+from datetime import datetime
+import gzip
+import json
+import os
+
+from sqlalchemy import DateTime, select
+
+from standardweb import app, db
+from standardweb.models import (
+    AccessLog, DeathEvent, KillEvent, MojangStatus, OreDiscoveryEvent, PlayerActivity, ServerStatus
+)
+
+
+ARCHIVE_MODELS = (
+    AccessLog, DeathEvent, KillEvent, MojangStatus, OreDiscoveryEvent, PlayerActivity, ServerStatus
+)
+
+ARCHIVE_TABLES = {cls.__tablename__: cls.__table__ for cls in ARCHIVE_MODELS}
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class UnknownTableError(RuntimeError):
+    pass
+
+
+def _get_table(table_name):
+    if table_name not in ARCHIVE_TABLES:
+        raise UnknownTableError(table_name)
+
+    return ARCHIVE_TABLES[table_name]
+
+
+def _month_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def _next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _archive_path(table_name, month):
+    return os.path.join(app.config['ARCHIVE_DIR'], table_name, month.strftime('%Y-%m') + '.ndjson.gz')
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+
+    raise TypeError(repr(value))
+
+
+def _decode(table, data):
+    for column in table.columns:
+        if isinstance(column.type, DateTime) and data.get(column.name):
+            data[column.name] = datetime.strptime(data[column.name], TIMESTAMP_FORMAT)
+
+    return data
+
+
+def get_cutoff(months, now=None):
+    """
+    Returns the start of the month `months` months before the current one, every
+    row older than which is due to be archived.
+    """
+    month = _month_start(now or datetime.utcnow())
+
+    year, month_index = divmod(month.year * 12 + month.month - 1 - months, 12)
+
+    return datetime(year, month_index + 1, 1)
+
+
+def _append(path, rows):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # appending creates another gzip member, which gzip reads back as one stream
+    with open(path, 'ab') as f:
+        with gzip.GzipFile(fileobj=f, mode='ab') as gz:
+            for row in rows:
+                gz.write(json.dumps(dict(row), default=encode_value) + '\n')
+
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def archive_table(table_name, months, batch_size=None):
+    """
+    Moves every row of the table from before the last `months` months to its
+    month's archive file, deleting them from the db batch_size rows at a time.
+    Returns the number of rows archived.
+    """
+    table = _get_table(table_name)
+    cutoff = get_cutoff(months)
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+
+    archived = 0
+
+    while True:
+        rows = db.session.execute(
+            select([table]).where(
+                table.c.timestamp < cutoff
+            ).order_by(
+                table.c.id
+            ).limit(batch_size)
+        ).fetchall()
+
+        if not rows:
+            break
+
+        month_rows = defaultdict(list)
+        for row in rows:
+            month_rows[_month_start(row.timestamp)].append(row)
+
+        for month, rows_in_month in month_rows.iteritems():
+            _append(_archive_path(table_name, month), rows_in_month)
+
+        db.session.execute(
+            table.delete().where(table.c.id.in_([row.id for row in rows]))
+        )
+        db.session.commit()
+
+        archived += len(rows)
+
+        if len(rows) < batch_size:
+            break
+
+    return archived
+
+
+def query_archive(table_name, start, end, **filters):
+    """
+    Yields the archived rows of the table as dicts with timestamps from `start` up
+    to `end`, optionally only those with the given column values, ex:
+    query_archive('deathevent', start, end, victim_id=5).
+    """
+    table = _get_table(table_name)
+
+    seen_ids = set()
+    month = _month_start(start)
+
+    while month < end:
+        path = _archive_path(table_name, month)
+        month = _next_month(month)
+
+        if not os.path.exists(path):
+            continue
+
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                row = _decode(table, json.loads(line))
+
+                if row['id'] in seen_ids:
+                    continue
+
+                if not start <= row['timestamp'] < end:
+                    continue
+
+                if any(row.get(column) != value for column, value in filters.iteritems()):
+                    continue
+
+                seen_ids.add(row['id'])
+
+                yield row
+
+
+def restore_archive(table_name, start, end, batch_size=None):
+    """
+    Inserts the archived rows of the table with timestamps from `start` up to `end`
+    back into the db, skipping any that are already there. Returns the number of
+    archived rows in the range.
+
+    The rows are left in the archive, so if they're still old enough they'll just
+    be archived again by the next run.
+    """
+    table = _get_table(table_name)
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+
+    restored = 0
+    batch = []
+
+    for row in query_archive(table_name, start, end):
+        batch.append(row)
+
+        if len(batch) >= batch_size:
+            db.session.execute(table.insert().prefix_with('IGNORE'), batch)
+            db.session.commit()
+
+            restored += len(batch)
+            batch = []
+
+    if batch:
+        db.session.execute(table.insert().prefix_with('IGNORE'), batch)
+        db.session.commit()
+
+        restored += len(batch)
+
+    return restored
@@ -0,0 +1,367 @@
+"""
+In-memory prefix index of player and user names for autocompleting contacts.
+
+Each process keeps a sorted list of (lowercased name, id) for every player's
+username and nickname and another for every user's username, so the matches for
+a prefix are found with a bisect and read off in order. The lists are loaded when
+a web worker starts from the snapshot in redis, which a job refreshes before it
+expires. If there isn't one, a single process builds it from the db under a lease
+while the rest wait for it, building their own only if it doesn't turn up.
+
+New and renamed players and users are published to a change log in redis once
+committed, each under the next number of a shared sequence. Processes check the
+log at most every AUTOCOMPLETE_CHECK_INTERVAL seconds and apply the changes they
+haven't seen yet, rebuilding if they've fallen further behind than the log goes
+back. A change holds the full current names of its player or user, so applying
+one more than once is harmless and a snapshot can be taken while changes come in.
+"""
+import bisect
+import json
+import threading
+import time
+import zlib
+
+import redis
+import rollbar
+from sqlalchemy import event, inspect
+
+from standardweb import app, db, redis_client
+from standardweb.lib.cache import Lease
+from standardweb.lib.transactions import after_commit
+from standardweb.models import Player, User
+
+
+PLAYER = 'player'
+USER = 'user'
+
+KINDS = (PLAYER, USER)
+
+SEQUENCE_KEY = 'autocomplete-sequence'
+CHANGES_KEY = 'autocomplete-changes'
+SNAPSHOT_KEY = 'autocomplete-snapshot'
+BUILD_LEASE = 'autocomplete-build'
+
+
+# numbers and logs the changes in one step so the log never has gaps that fill in later
+_publish = redis_client.register_script("""
+for i = 2, #ARGV do
+    local sequence = redis.call('incr', KEYS[1])
+    redis.call('zadd', KEYS[2], sequence, sequence .. ':' .. ARGV[i])
+end
+redis.call('zremrangebyrank', KEYS[2], 0, -(tonumber(ARGV[1]) + 1))
+""")
+
+
+def _player_change(player, deleted=False):
+    return {
+        'kind': PLAYER,
+        'id': player.id,
+        'names': [] if deleted else [player.username, player.nickname],
+        'data': None if deleted else {
+            'username': player.username,
+            'nickname': player.nickname,
+            'displayname_html': player.displayname_html
+        }
+    }
+
+
+def _user_change(user, deleted=False):
+    return {
+        'kind': USER,
+        'id': user.id,
+        'names': [] if deleted else [user.username],
+        'data': None if deleted else {
+            'username': user.username
+        }
+    }
+
+
+class AutocompleteIndex(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sequence = None
+        self.checked = 0
+        # kind -> sorted list of (name, id)
+        self.keys = None
+        # (kind, id) -> names indexed for it
+        self.names = {}
+        # (kind, id) -> display fields
+        self.data = {}
+
+    def _remove(self, kind, id):
+        keys = self.keys[kind]
+
+        for name in self.names.pop((kind, id), ()):
+            i = bisect.bisect_left(keys, (name, id))
+            if i < len(keys) and keys[i] == (name, id):
+                del keys[i]
+
+        self.data.pop((kind, id), None)
+
+    def _apply(self, change):
+        kind, id = change['kind'], change['id']
+
+        self._remove(kind, id)
+
+        names = sorted(set(name.lower() for name in change['names'] if name))
+        if not names:
+            return
+
+        for name in names:
+            bisect.insort(self.keys[kind], (name, id))
+
+        self.names[(kind, id)] = names
+        self.data[(kind, id)] = change['data']
+
+    def _set(self, sequence, changes):
+        self.keys = {kind: [] for kind in KINDS}
+        self.names = {}
+        self.data = {}
+
+        for change in changes:
+            kind, id = change['kind'], change['id']
+            names = sorted(set(name.lower() for name in change['names'] if name))
+
+            self.keys[kind].extend((name, id) for name in names)
+            self.names[(kind, id)] = names
+            self.data[(kind, id)] = change['data']
+
+        for keys in self.keys.itervalues():
+            keys.sort()
+
+        self.sequence = sequence
+
+    def _build(self):
+        try:
+            sequence = int(redis_client.get(SEQUENCE_KEY) or 0)
+        except redis.RedisError:
+            # catch up once redis is back
+            sequence = None
+
+        # query columns rather than loading every player and user into the session,
+        # building transient players only to get their display names
+        changes = [
+            _player_change(Player(id=id, username=username, nickname=nickname, nickname_ansi=nickname_ansi))
+            for id, username, nickname, nickname_ansi in db.session.query(
+                Player.id, Player.username, Player.nickname, Player.nickname_ansi
+            )
+        ]
+
+        changes.extend(
+            _user_change(user) for user in db.session.query(
+                User.id, User.username
+            ).filter(
+                User.username.isnot(None)
+            )
+        )
+
+        if sequence is not None:
+            try:
+                redis_client.set(
+                    SNAPSHOT_KEY,
+                    zlib.compress(json.dumps([sequence, changes])),
+                    ex=app.config['AUTOCOMPLETE_SNAPSHOT_TIME']
+                )
+            except redis.RedisError:
+                rollbar.report_exc_info(level='warning')
+
+        return sequence, changes
+
+    def _read_snapshot(self):
+        try:
+            snapshot = redis_client.get(SNAPSHOT_KEY)
+        except redis.RedisError:
+            return None
+
+        return json.loads(zlib.decompress(snapshot)) if snapshot else None
+
+    def _build_shared(self):
+        with Lease(BUILD_LEASE, time=app.config['AUTOCOMPLETE_BUILD_LEASE_TIME']) as acquired:
+            if acquired:
+                return self._build()
+
+        # another process is building the snapshot, so wait for it rather than
+        # scan the tables at the same time
+        deadline = time.time() + app.config['AUTOCOMPLETE_BUILD_WAIT']
+
+        while time.time() < deadline:
+            time.sleep(0.5)
+
+            snapshot = self._read_snapshot()
+            if snapshot:
+                return snapshot
+
+        return self._build()
+
+    def _load(self, use_snapshot=True):
+        snapshot = self._read_snapshot() if use_snapshot else None
+
+        if snapshot:
+            sequence, changes = snapshot
+        elif use_snapshot:
+            sequence, changes = self._build_shared()
+        else:
+            sequence, changes = self._build()
+
+        self._set(sequence, changes)
+
+    def _catch_up(self):
+        if self.sequence is None:
+            self._load()
+            return
+
+        try:
+            changes = redis_client.zrangebyscore(
+                CHANGES_KEY, '(%d' % self.sequence, '+inf', withscores=True, score_cast_func=int
+            )
+        except redis.RedisError:
+            # keep what's loaded until redis is back
+            return
+
+        if not changes:
+            return
+
+        if changes[0][1] != self.sequence + 1:
+            # changes we haven't seen have already been trimmed from the log
+            self._load(use_snapshot=False)
+            return
+
+        for member, sequence in changes:
+            self._apply(json.loads(member.split(':', 1)[1]))
+            self.sequence = sequence
+
+    def _refresh(self):
+        now = time.time()
+
+        if self.keys is not None and now - self.checked < app.config['AUTOCOMPLETE_CHECK_INTERVAL']:
+            return
+
+        with self.lock:
+            if self.keys is None:
+                self._load()
+            else:
+                self._catch_up()
+
+            self.checked = now
+
+    def warm(self):
+        """
+        Loads the index if it hasn't been yet, so the first request doesn't have to.
+        """
+        with self.lock:
+            if self.keys is None:
+                self._load()
+                self.checked = time.time()
+
+    def complete(self, prefix, kind, limit=10):
+        """
+        Returns a list of (id, display fields) of up to `limit` players or users
+        with a name starting with the prefix, in order of the matching name.
+        """
+        prefix = prefix.strip().lower() if prefix else None
+        if not prefix:
+            return []
+
+        self._refresh()
+
+        results = []
+        seen = set()
+
+        with self.lock:
+            keys = self.keys[kind]
+
+            i = bisect.bisect_left(keys, (prefix,))
+            while i < len(keys) and len(results) < limit:
+                name, id = keys[i]
+                if not name.startswith(prefix):
+                    break
+
+                if id not in seen:
+                    seen.add(id)
+                    results.append((id, self.data[(kind, id)]))
+
+                i += 1
+
+        return results
+
+
+index = AutocompleteIndex()
+
+
+def complete(prefix, kind, limit=10):
+    return index.complete(prefix, kind, limit=limit)
+
+
+def refresh_snapshot():
+    """
+    Saves a fresh snapshot of the index before the current one expires, so that
+    processes starting up don't find it missing and have to build it themselves.
+    Returns False if another process is already building one.
+    """
+    with Lease(BUILD_LEASE, time=app.config['AUTOCOMPLETE_BUILD_LEASE_TIME']) as acquired:
+        if not acquired:
+            return False
+
+        index._build()
+
+        return True
+
+
+def publish(changes):
+    if not changes:
+        return
+
+    try:
+        _publish(keys=[SEQUENCE_KEY, CHANGES_KEY], args=[
+            app.config['AUTOCOMPLETE_CHANGE_LOG_SIZE']
+        ] + [json.dumps(change) for change in changes])
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning')
+
+
+def _publish_changes(changes):
+    publish(changes.values())
+
+
+def _record(session, change):
+    after_commit(session, 'autocomplete-changes', dict, _publish_changes)[(change['kind'], change['id'])] = change
+
+
+def _changed(target, attrs):
+    state = inspect(target)
+
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+@event.listens_for(Player, 'after_insert')
+def _player_inserted(mapper, connection, target):
+    _record(inspect(target).session, _player_change(target))
+
+
+@event.listens_for(Player, 'after_update')
+def _player_updated(mapper, connection, target):
+    if _changed(target, ('username', 'nickname', 'nickname_ansi')):
+        _record(inspect(target).session, _player_change(target))
+
+
+@event.listens_for(Player, 'after_delete')
+def _player_deleted(mapper, connection, target):
+    _record(inspect(target).session, _player_change(target, deleted=True))
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    if target.username:
+        _record(inspect(target).session, _user_change(target))
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    if _changed(target, ('username',)):
+        _record(inspect(target).session, _user_change(target))
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    _record(inspect(target).session, _user_change(target, deleted=True))
@@ -1,4 +1,20 @@
-from standardweb import cache
+from collections import OrderedDict
+import threading
+import uuid
+
+import redis
+import rollbar
+
+from standardweb import cache, redis_client
+
+
+# deletes the lease only if it's still held by the given token
+_release = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
 
 
 class CachedResult(object):
@@ -31,3 +47,102 @@ class CachedResult(object):
                 pass
 
         return key
+
+
+class LRUCache(object):
+    """
+    Process-local map holding at most `size` keys, dropping the least recently
+    used key to make room for a new one.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+
+            self.items[key] = value
+
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+
+class Lease(object):
+    """
+    Best-effort distributed lock backed by redis' SET NX. The lease expires on its
+    own after `time` seconds in case the holder dies without releasing it.
+
+    If redis can't be reached the lease is granted anyway (and the error reported)
+    rather than stopping every job that runs under one until redis is back.
+
+    with Lease('some-key', time=120) as acquired:
+        if acquired:
+            ...
+    """
+    def __init__(self, name, time=60):
+        self.key = 'lease-' + name
+        self.time = time
+        self.token = uuid.uuid4().hex
+        self.acquired = False
+        self.held = False
+
+    def acquire(self):
+        try:
+            self.held = bool(redis_client.set(self.key, self.token, nx=True, px=int(self.time * 1000)))
+            self.acquired = self.held
+        except redis.RedisError:
+            rollbar.report_exc_info(level='warning', extra_data={'lease': self.key})
+            self.held = False
+            self.acquired = True
+
+        return self.acquired
+
+    def is_held(self):
+        """
+        Returns whether the lease is still ours, as opposed to having expired and
+        possibly been taken by someone else. A lease granted while redis couldn't
+        be reached is considered held.
+        """
+        if not self.acquired:
+            return False
+
+        if not self.held:
+            return True
+
+        try:
+            return redis_client.get(self.key) == self.token
+        except redis.RedisError:
+            return True
+
+    def release(self):
+        # only release the lease if it hasn't expired and been taken by someone else
+        if self.held:
+            try:
+                _release(keys=[self.key], args=[self.token])
+            except redis.RedisError:
+                rollbar.report_exc_info(level='warning', extra_data={'lease': self.key})
+
+        self.acquired = False
+        self.held = False
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,111 @@
+import redis
+
+from standardweb import app, redis_client
+
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+LATENCY_SAMPLES = 20
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of a remote host across all processes. Once
+    CIRCUIT_BREAKER_THRESHOLD calls fail within CIRCUIT_BREAKER_FAILURE_WINDOW
+    seconds the circuit opens and calls fail fast for CIRCUIT_BREAKER_OPEN_TIME
+    seconds, after which a single probe call at a time is let through (half-open)
+    until one succeeds and closes the circuit again.
+
+    If redis is unavailable the circuit is treated as closed.
+    """
+    def __init__(self, host):
+        self.host = host
+
+    def _key(self, name):
+        return 'circuit-%s-%s' % (name, self.host)
+
+    @property
+    def state(self):
+        try:
+            is_open, failures = redis_client.mget(self._key('open'), self._key('failures'))
+        except redis.RedisError:
+            return STATE_CLOSED
+
+        if is_open:
+            return STATE_OPEN
+
+        if int(failures or 0) >= app.config['CIRCUIT_BREAKER_THRESHOLD']:
+            return STATE_HALF_OPEN
+
+        return STATE_CLOSED
+
+    @property
+    def is_open(self):
+        return self.state == STATE_OPEN
+
+    def allow_request(self):
+        state = self.state
+
+        if state == STATE_OPEN:
+            return False
+
+        if state == STATE_HALF_OPEN:
+            # only let one probe through at a time
+            try:
+                return bool(redis_client.set(
+                    self._key('probe'), 1, nx=True, ex=app.config['MC_API_CONNECT_TIMEOUT'] + app.config['MC_API_READ_TIMEOUT']
+                ))
+            except redis.RedisError:
+                return True
+
+        return True
+
+    def record_success(self, latency):
+        try:
+            pipe = redis_client.pipeline()
+            pipe.delete(self._key('failures'), self._key('probe'))
+            pipe.lpush(self._key('latency'), int(latency))
+            pipe.ltrim(self._key('latency'), 0, LATENCY_SAMPLES - 1)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def record_failure(self):
+        """
+        Records a failed call, returning True if it caused the circuit to open.
+        """
+        try:
+            pipe = redis_client.pipeline()
+            pipe.incr(self._key('failures'))
+            pipe.expire(self._key('failures'), app.config['CIRCUIT_BREAKER_FAILURE_WINDOW'])
+            pipe.delete(self._key('probe'))
+            failures, _, _ = pipe.execute()
+
+            if failures >= app.config['CIRCUIT_BREAKER_THRESHOLD']:
+                return bool(redis_client.set(
+                    self._key('open'), 1, nx=True, ex=app.config['CIRCUIT_BREAKER_OPEN_TIME']
+                ))
+        except redis.RedisError:
+            pass
+
+        return False
+
+    def get_health(self):
+        try:
+            failures, latencies = redis_client.pipeline().get(
+                self._key('failures')
+            ).lrange(
+                self._key('latency'), 0, -1
+            ).execute()
+        except redis.RedisError:
+            failures, latencies = None, []
+
+        latencies = [int(x) for x in latencies]
+
+        return {
+            'state': self.state,
+            'recent_failures': int(failures or 0),
+            'average_latency': sum(latencies) / len(latencies) if latencies else None
+        }
@@ -0,0 +1,92 @@
+from collections import namedtuple
+import Queue
+import sys
+import threading
+import time
+
+from standardweb import app, db
+from standardweb.models import Server
+
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_TIMEOUT = 'timeout'
+
+
+ServerResult = namedtuple('ServerResult', ['server_id', 'status', 'result', 'duration', 'exc_info'])
+
+
+def map_servers(func, server_ids, pool_size=4, deadline=30):
+    """
+    Calls func(server) for each of the given server ids concurrently on a bounded
+    pool of threads. Each call runs in its own app context, and so with its own db
+    session, and is given up on once it has been running for `deadline` seconds.
+
+    Returns a list of ServerResults in the same order as server_ids.
+    """
+    server_ids = list(server_ids)
+
+    if not server_ids:
+        return []
+
+    pending = Queue.Queue()
+    for server_id in server_ids:
+        pending.put(server_id)
+
+    done = Queue.Queue()
+    started = {}
+
+    def worker():
+        while True:
+            try:
+                server_id = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            start = time.time()
+            started[server_id] = start
+
+            with app.app_context():
+                try:
+                    result = func(Server.query.get(server_id))
+                except Exception:
+                    db.session.rollback()
+                    done.put(ServerResult(server_id, STATUS_ERROR, None, time.time() - start, sys.exc_info()))
+                else:
+                    done.put(ServerResult(server_id, STATUS_OK, result, time.time() - start, None))
+                finally:
+                    db.session.remove()
+
+    def start_worker():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for _ in xrange(min(pool_size, len(server_ids))):
+        start_worker()
+
+    results = {}
+
+    while len(results) < len(server_ids):
+        now = time.time()
+
+        for server_id, start in started.items():
+            if server_id not in results and now - start >= deadline:
+                results[server_id] = ServerResult(server_id, STATUS_TIMEOUT, None, now - start, None)
+
+                # the thread stuck on this server is abandoned, so replace it to keep
+                # the rest of the servers moving
+                if not pending.empty():
+                    start_worker()
+
+        running = [start for server_id, start in started.items() if server_id not in results]
+        timeout = min(running) + deadline - now if running else deadline
+
+        try:
+            result = done.get(timeout=max(timeout, 0.01))
+        except Queue.Empty:
+            continue
+
+        results.setdefault(result.server_id, result)
+
+    return [results[server_id] for server_id in server_ids]
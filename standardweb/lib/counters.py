@@ -0,0 +1,185 @@
+"""
+Write-behind buffering for the count tables (DeathCount, KillCount, OreDiscoveryCount
+and their daily rollups).
+
+Increments are added up per row key in a redis hash for each table and a periodic
+job applies them to the db in bulk, so hot rows (a single player's diamond count)
+are written once per flush instead of once per event.
+
+Guarantees:
+ - increments are only buffered once the db transaction recording the events they
+   count has committed, and are dropped if it rolls back
+ - increments are buffered in redis only, so anything not yet flushed is lost if
+   redis itself loses its data (bounded by COUNT_BUFFER_FLUSH_INTERVAL unless redis
+   persists with an append-only file)
+ - a flush moves the buffer aside to a processing key before reading it, and only
+   deletes that key once the db transaction has committed, so a worker crashing
+   mid-flush leaves the batch to be retried by the next flush (at-least-once); a
+   crash in the short window between the commit and the delete will apply that
+   batch twice
+ - if redis is unavailable increments are written straight to the db in a
+   transaction of their own
+"""
+from collections import Counter
+from datetime import datetime
+
+import redis
+import rollbar
+from sqlalchemy import Date
+
+from standardweb import app, db, redis_client
+from standardweb.lib.cache import Lease
+from standardweb.lib.transactions import after_commit
+
+
+def _buffer_key(cls):
+    return 'count-buffer-%s' % cls.__tablename__
+
+
+def _processing_key(cls):
+    return 'count-buffer-%s-processing' % cls.__tablename__
+
+
+def _encode_key(key):
+    return ':'.join('' if value is None else str(value) for value in key)
+
+
+def _decode_value(column, value):
+    if not value:
+        return None
+
+    if isinstance(column.type, Date):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+
+    return int(value)
+
+
+def _decode_key(cls, field):
+    columns = [cls.__table__.c[name] for name in cls.KEY_COLUMNS]
+
+    return tuple(_decode_value(column, value) for column, value in zip(columns, field.split(':')))
+
+
+def _decode_counts(cls, counts):
+    return {_decode_key(cls, field): int(n) for field, n in counts.iteritems() if int(n)}
+
+
+def increment(cls, counts):
+    """
+    Adds each n in a map of key -> n, with keys being tuples of the model's
+    KEY_COLUMNS values, to the counts for the given count model, along with today's
+    leaderboard rollups, once the current db session commits.
+    """
+    from standardweb.lib import leaderboards
+
+    if not counts:
+        return
+
+    if not app.config['COUNT_BUFFER_ENABLED']:
+        cls.increment_many(counts)
+
+    after_commit(db.session(), 'count-increments', dict, _record_increments).setdefault(
+        cls, Counter()
+    ).update(counts)
+
+    daily_cls, daily_counts = leaderboards.get_daily_increments(cls, counts)
+    increment(daily_cls, daily_counts)
+
+
+def _write_increments(cls, counts):
+    # the session that was just committed can't be used from its after_commit hook
+    session = db.create_session({})()
+
+    try:
+        cls.increment_many(counts, session=session)
+        session.commit()
+    except Exception:
+        session.rollback()
+        rollbar.report_exc_info(extra_data={'table': cls.__tablename__})
+    finally:
+        session.close()
+
+
+def _buffer_increments(cls, counts):
+    key = _buffer_key(cls)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for count_key, n in counts.iteritems():
+        pipe.hincrby(key, _encode_key(count_key), n)
+
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning', extra_data={'table': cls.__tablename__})
+        _write_increments(cls, counts)
+
+
+def _record_increments(pending):
+    from standardweb.lib import leaderboards, profiles
+
+    for cls, counts in pending.iteritems():
+        leaderboards.update_index(cls, counts)
+        profiles.record_increments(cls, counts)
+
+        if app.config['COUNT_BUFFER_ENABLED']:
+            _buffer_increments(cls, counts)
+
+
+def flush(cls):
+    """
+    Applies all buffered increments for the given count model to the db, returning
+    the number of rows updated, or None if another flush is already in progress.
+    """
+    with Lease('count-buffer-flush-%s' % cls.__tablename__, time=app.config['COUNT_BUFFER_LEASE_TIME']) as acquired:
+        if not acquired:
+            return None
+
+        processing_key = _processing_key(cls)
+
+        # a previous flush that didn't complete leaves its batch behind to be applied first
+        if not redis_client.exists(processing_key):
+            try:
+                redis_client.rename(_buffer_key(cls), processing_key)
+            except redis.ResponseError:
+                # nothing has been buffered since the last flush
+                return 0
+
+        counts = _decode_counts(cls, redis_client.hgetall(processing_key))
+
+        cls.increment_many(counts)
+        db.session.commit()
+
+        redis_client.delete(processing_key)
+
+        return len(counts)
+
+
+def get_pending(cls, **filters):
+    """
+    Returns a map of key -> n of the increments that are buffered for the given
+    count model but not yet flushed to the db, optionally only for the keys with
+    the given column values, ex: get_pending(KillCount, server_id=1, killer_id=5).
+    """
+    if not app.config['COUNT_BUFFER_ENABLED']:
+        return {}
+
+    try:
+        buffered, processing = redis_client.pipeline(transaction=False).hgetall(
+            _buffer_key(cls)
+        ).hgetall(
+            _processing_key(cls)
+        ).execute()
+    except redis.RedisError:
+        return {}
+
+    pending = _decode_counts(cls, buffered)
+
+    for key, n in _decode_counts(cls, processing).iteritems():
+        pending[key] = pending.get(key, 0) + n
+
+    indexes = [(cls.KEY_COLUMNS.index(column), value) for column, value in filters.iteritems()]
+
+    return {
+        key: n for key, n in pending.iteritems()
+        if all(key[index] == value for index, value in indexes)
+    }
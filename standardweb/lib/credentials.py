@@ -0,0 +1,104 @@
+"""
+Verified server credentials, kept in process for SERVER_AUTH_CACHE_TIME seconds
+so authenticating a plugin API call doesn't need to go to the db.
+
+Each entry is stamped with the server's credential generation from redis, which
+is bumped once a change to the server's secret key is committed, so a rotated
+key stops being accepted on the next request rather than when the entry expires.
+"""
+import time
+
+import redis
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from standardweb import app, db, redis_client
+from standardweb.lib import helpers as h
+from standardweb.lib.transactions import after_commit
+from standardweb.models import Server
+
+
+_verified = {}
+
+
+def _generation_key(server_id):
+    return 'server-credentials-generation-%d' % server_id
+
+
+def _get_generation(server_id):
+    try:
+        return redis_client.get(_generation_key(server_id))
+    except redis.RedisError:
+        # fall back to relying on the cache time alone
+        return None
+
+
+def _snapshot(server):
+    return {
+        column.key: getattr(server, column.key)
+        for column in inspect(Server).column_attrs
+    }
+
+
+def _attach(values):
+    """
+    Returns a Server built from a snapshot of its columns, attached to the current
+    session as if it had been loaded without querying the db. It's meant to be
+    read-only, nothing changed on it should be expected to be saved.
+    """
+    server = Server(**values)
+    make_transient_to_detached(server)
+
+    return db.session.merge(server, load=False)
+
+
+def get_server(server_id, secret_key):
+    """
+    Returns the server with the given id if the secret key matches its own, or None.
+    """
+    try:
+        server_id = int(server_id)
+    except (TypeError, ValueError):
+        return None
+
+    generation = _get_generation(server_id)
+    entry = _verified.get(server_id)
+
+    if entry and entry['expires'] > time.time() and entry['generation'] == generation:
+        if h.safe_str_cmp(entry['values']['secret_key'] or '', secret_key):
+            return _attach(entry['values'])
+
+        return None
+
+    server = Server.query.get(server_id)
+
+    if not server or not server.secret_key or not h.safe_str_cmp(server.secret_key, secret_key):
+        return None
+
+    _verified[server_id] = {
+        'values': _snapshot(server),
+        'generation': generation,
+        'expires': time.time() + app.config['SERVER_AUTH_CACHE_TIME']
+    }
+
+    return server
+
+
+def invalidate(server_id):
+    _verified.pop(server_id, None)
+
+    try:
+        redis_client.incr(_generation_key(server_id))
+    except redis.RedisError:
+        pass
+
+
+def _invalidate_all(server_ids):
+    for server_id in server_ids:
+        invalidate(server_id)
+
+
+@event.listens_for(Server, 'after_update')
+def _server_updated(mapper, connection, target):
+    if inspect(target).attrs.secret_key.history.has_changes():
+        after_commit(inspect(target).session, 'rotated-server-ids', set, _invalidate_all).add(target.id)
@@ -0,0 +1,332 @@
+from collections import Counter, defaultdict
+import json
+
+import redis
+import rollbar
+from voluptuous import All, Any, Coerce, Invalid, Length, Required, Schema
+
+from standardweb import app, db, redis_client
+from standardweb import stats as statsd
+from standardweb.lib import counters, ores, registry
+from standardweb.lib.cache import Lease
+from standardweb.models import (
+    DeathCount, DeathEvent, KillCount, KillEvent, OreDiscoveryCount, OreDiscoveryEvent, Player, Server
+)
+from standardweb.tasks.events import ingest_events_task
+
+
+DEATH = 'death'
+KILL = 'kill'
+ORE_DISCOVERY = 'ore_discovery'
+
+INGEST_QUEUE_KEY = 'event-ingest-queue'
+INGEST_PROCESSING_KEY = 'event-ingest-processing'
+INGEST_FAILED_KEY = 'event-ingest-failed'
+INGEST_SCHEDULED_KEY = 'event-ingest-scheduled'
+
+_type_name = All(basestring, Length(min=1, max=100))
+_material_name = All(basestring, Length(min=1, max=32))
+_uuid = All(basestring, Length(min=32, max=36))
+
+EVENT_SCHEMAS = {
+    DEATH: Schema({
+        Required('event'): DEATH,
+        Required('type'): _type_name,
+        Required('victim_uuid'): _uuid,
+        'killer_uuid': Any(None, _uuid)
+    }),
+    KILL: Schema({
+        Required('event'): KILL,
+        Required('type'): _type_name,
+        Required('killer_uuid'): _uuid
+    }),
+    ORE_DISCOVERY: Schema({
+        Required('event'): ORE_DISCOVERY,
+        Required('type'): _material_name,
+        Required('uuid'): _uuid,
+        Required('x'): Coerce(int),
+        Required('y'): Coerce(int),
+        Required('z'): Coerce(int)
+    })
+}
+
+
+class InvalidEventError(RuntimeError):
+    pass
+
+
+def validate_events(events):
+    if not isinstance(events, list):
+        raise InvalidEventError()
+
+    validated = []
+
+    for event in events:
+        schema = EVENT_SCHEMAS.get(event.get('event')) if isinstance(event, dict) else None
+
+        if not schema:
+            raise InvalidEventError()
+
+        try:
+            validated.append(schema(event))
+        except Invalid:
+            raise InvalidEventError()
+
+    return validated
+
+
+def _resolve_player_ids(uuids):
+    uuids = set(uuid for uuid in uuids if uuid)
+
+    if not uuids:
+        return {}
+
+    return dict(
+        db.session.query(Player.uuid, Player.id).filter(Player.uuid.in_(uuids))
+    )
+
+
+def log_events(server, events, commit=True):
+    """
+    Records a batch of validated death, kill and ore discovery events for a server,
+    resolving every uuid and type name up front, inserting each kind of event with
+    a single multi-row insert and adding up the counts by key.
+    """
+    deaths = [event for event in events if event['event'] == DEATH]
+    kills = [event for event in events if event['event'] == KILL]
+    ore_discoveries = [event for event in events if event['event'] == ORE_DISCOVERY]
+
+    for death in deaths:
+        if death['victim_uuid'] == death.get('killer_uuid'):
+            death['type'] = 'suicide'
+
+    player_ids = _resolve_player_ids(
+        [death['victim_uuid'] for death in deaths] +
+        [death.get('killer_uuid') for death in deaths if death['type'] == 'player'] +
+        [kill['killer_uuid'] for kill in kills] +
+        [ore['uuid'] for ore in ore_discoveries]
+    )
+
+    # kills and ore discoveries are only tracked for known players
+    kills = [kill for kill in kills if kill['killer_uuid'] in player_ids]
+    ore_discoveries = [ore for ore in ore_discoveries if ore['uuid'] in player_ids]
+
+    death_type_ids = registry.death_types.get_ids(death['type'] for death in deaths)
+    kill_type_ids = registry.kill_types.get_ids(kill['type'] for kill in kills)
+    material_type_ids = registry.material_types.get_ids(ore['type'] for ore in ore_discoveries)
+
+    death_rows = [{
+        'server_id': server.id,
+        'death_type_id': death_type_ids[death['type']],
+        'victim_id': player_ids.get(death['victim_uuid']),
+        'killer_id': player_ids.get(death.get('killer_uuid')) if death['type'] == 'player' else None
+    } for death in deaths]
+
+    kill_rows = [{
+        'server_id': server.id,
+        'kill_type_id': kill_type_ids[kill['type']],
+        'killer_id': player_ids[kill['killer_uuid']]
+    } for kill in kills]
+
+    ore_rows = [{
+        'server_id': server.id,
+        'material_type_id': material_type_ids[ore['type']],
+        'player_id': player_ids[ore['uuid']],
+        'x': ore['x'],
+        'y': ore['y'],
+        'z': ore['z']
+    } for ore in ore_discoveries]
+
+    if death_rows:
+        db.session.execute(DeathEvent.__table__.insert(), death_rows)
+
+    if kill_rows:
+        db.session.execute(KillEvent.__table__.insert(), kill_rows)
+
+    if ore_rows:
+        db.session.execute(OreDiscoveryEvent.__table__.insert(), ore_rows)
+        ores.record_discoveries(ore_rows)
+
+    counters.increment(DeathCount, Counter(
+        (row['server_id'], row['death_type_id'], row['victim_id'], row['killer_id'])
+        for row in death_rows
+    ))
+
+    counters.increment(KillCount, Counter(
+        (row['server_id'], row['kill_type_id'], row['killer_id'])
+        for row in kill_rows
+    ))
+
+    counters.increment(OreDiscoveryCount, Counter(
+        (row['server_id'], row['material_type_id'], row['player_id'])
+        for row in ore_rows
+    ))
+
+    if commit:
+        db.session.commit()
+
+    return len(death_rows) + len(kill_rows) + len(ore_rows)
+
+
+def _idempotency_key(server_id, key):
+    return 'event-ingest-seen-%d-%s' % (server_id, key)
+
+
+def queue_events(server, events, idempotency_key=None):
+    """
+    Queues a batch of validated events to be recorded by the ingest task within
+    EVENT_INGEST_WINDOW seconds. A batch sent again with the same idempotency key
+    within EVENT_INGEST_IDEMPOTENCY_TIME seconds is ignored, returning False.
+
+    If redis is unavailable the events are recorded right away instead.
+    """
+    window = app.config['EVENT_INGEST_WINDOW']
+
+    try:
+        if idempotency_key and not redis_client.set(
+            _idempotency_key(server.id, idempotency_key), 1,
+            nx=True, ex=app.config['EVENT_INGEST_IDEMPOTENCY_TIME']
+        ):
+            return False
+
+        pipe = redis_client.pipeline()
+        pipe.lpush(INGEST_QUEUE_KEY, json.dumps({
+            'server_id': server.id,
+            'events': events
+        }))
+        pipe.set(INGEST_SCHEDULED_KEY, 1, nx=True, ex=window * 10)
+        _, schedule = pipe.execute()
+    except redis.RedisError:
+        log_events(server, events)
+        return True
+
+    if schedule:
+        ingest_events_task.apply_async(countdown=window)
+
+    return True
+
+
+def _record_items(items):
+    server_events = defaultdict(list)
+    for item in items:
+        item = json.loads(item)
+        server_events[item['server_id']].extend(item['events'])
+
+    for server_id, events in server_events.iteritems():
+        server = Server.query.get(server_id)
+
+        if server:
+            log_events(server, events, commit=False)
+
+    db.session.commit()
+
+
+def _record_batch(items):
+    """
+    Records a batch of queued requests in one transaction, or if that fails each
+    request in its own, returning the ones that couldn't be recorded.
+    """
+    try:
+        _record_items(items)
+        return []
+    except Exception:
+        db.session.rollback()
+
+    failed = []
+
+    for item in items:
+        try:
+            _record_items([item])
+        except Exception:
+            db.session.rollback()
+            rollbar.report_exc_info(extra_data={'item': item})
+            failed.append(item)
+
+    return failed
+
+
+def ingest_queued_events():
+    """
+    Records the queued events in batches of up to EVENT_INGEST_BATCH_SIZE queued
+    requests per transaction, returning the number of requests ingested, or None if
+    another ingest is already in progress.
+
+    Each batch is moved to a processing list before it's recorded and only removed
+    once it's committed, so a batch is recorded at least once: a worker dying after
+    the commit but before the removal leaves the batch to be recorded again by the
+    next ingest. If a batch fails to record its requests are recorded one at a time,
+    and any that still fail are moved aside to the failed list, to be put back on
+    the queue with replay_failed_events, so they don't hold up the rest of it.
+
+    The ingest stops if its lease expires, since the processing list then belongs
+    to whichever ingest takes the lease next.
+    """
+    batch_size = app.config['EVENT_INGEST_BATCH_SIZE']
+    ingested = 0
+
+    lease = Lease('event-ingest', time=app.config['EVENT_INGEST_LEASE_TIME'])
+
+    with lease as acquired:
+        if not acquired:
+            return None
+
+        while True:
+            if not lease.is_held():
+                statsd.incr('event_ingest.lease_lost')
+                return ingested
+
+            # a batch left behind by an ingest that didn't complete is recorded first
+            items = redis_client.lrange(INGEST_PROCESSING_KEY, 0, -1)
+
+            if not items:
+                # clear the scheduled flag before taking the batch so that anything
+                # queued after this point schedules another ingest
+                redis_client.delete(INGEST_SCHEDULED_KEY)
+
+                pipe = redis_client.pipeline(transaction=False)
+                for _ in xrange(batch_size):
+                    pipe.rpoplpush(INGEST_QUEUE_KEY, INGEST_PROCESSING_KEY)
+
+                items = [item for item in pipe.execute() if item]
+
+            if not items:
+                return ingested
+
+            failed = _record_batch(items)
+
+            if not lease.is_held():
+                # the batch is left for the ingest holding the lease now, which may
+                # already be recording it, or have queued more on the processing list
+                statsd.incr('event_ingest.lease_lost')
+                return ingested
+
+            pipe = redis_client.pipeline()
+            if failed:
+                pipe.rpush(INGEST_FAILED_KEY, *failed)
+            pipe.delete(INGEST_PROCESSING_KEY)
+            pipe.execute()
+
+            if failed:
+                statsd.incr('event_ingest.failed', len(failed))
+
+            ingested += len(items) - len(failed)
+
+            if len(items) < batch_size:
+                return ingested
+
+
+def replay_failed_events():
+    """
+    Puts the requests that failed to record back on the queue to be ingested
+    again, returning the number of requests put back.
+    """
+    replayed = 0
+
+    while redis_client.rpoplpush(INGEST_FAILED_KEY, INGEST_QUEUE_KEY):
+        replayed += 1
+
+    if replayed:
+        redis_client.set(INGEST_SCHEDULED_KEY, 1, ex=app.config['EVENT_INGEST_WINDOW'] * 10)
+        ingest_events_task.apply_async()
+
+    return replayed
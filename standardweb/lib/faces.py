@@ -0,0 +1,520 @@
+"""
+Player face images extracted from their skins.
+
+Faces are stored by content: the 8x8 face cut from a skin is saved once under
+the hash of its pixels as faces/store/<xx>/<hash>/base.png, so players with the
+same skin share it, and each of SIZES is rendered from that base the first time
+it's needed as <size>.png next to it. Which face a player has is kept in
+faces/players/<uuid>, a file holding the hash, whose modification time is when
+the player's skin was last fetched. An hourly eviction job keeps the store under
+FACE_STORE_MAX_BYTES by dropping the faces that were least recently served.
+
+Each process keeps an index of uuid -> (hash, last fetched) of up to
+FACE_INDEX_SIZE players for FACE_INDEX_TIME seconds. Since a hash always names
+the same image, the ETag of a face is just its hash and size, so conditional
+requests are answered without touching the disk.
+
+Face requests only ever serve what's in the store, or the default face if there's
+nothing yet, and queue a refresh on the 'faces' queue if the player's face is
+missing or older than FACE_MAX_AGE. A refresh is queued at most once per
+FACE_REFRESH_PENDING_TIME for the same player. Refreshes across all workers
+make no more than FACE_REFRESH_RATE_LIMIT profile lookups per
+FACE_REFRESH_RATE_WINDOW seconds to stay within Mojang's rate limits.
+
+Pages with many face thumbnails reference sprites instead, single images of a
+list of faces side by side. A sprite is named by the hash of its uuid list, which
+is stored in redis when the page is rendered, and it's built from the store when
+it's first requested and then kept for FACE_SPRITE_MAX_AGE, or for only
+FACE_SPRITE_PARTIAL_MAX_AGE if it has default faces in place of any that haven't
+been fetched yet.
+"""
+from collections import namedtuple
+from datetime import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import StringIO
+import subprocess
+import time
+
+from PIL import Image
+import redis
+import requests
+import rollbar
+
+from standardweb import app, redis_client
+from standardweb.lib import exceptions, mojang
+from standardweb.lib import player as libplayer
+from standardweb.lib.cache import LRUCache
+
+
+PROJECT_PATH = os.path.abspath(os.path.dirname(__name__))
+
+FACES_PATH = PROJECT_PATH + '/standardweb/faces'
+
+BASE_SIZE = 8
+
+# sizes faces are served at, rendered from the base the first time they're needed
+SIZES = (16, 32, 64, 128)
+
+# sizes rendered and optimized as soon as a face is fetched
+PRERENDERED_SIZES = (16, 64)
+
+# the size of the faces in sprites
+SPRITE_SIZE = 16
+
+UUID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+ACCESS_KEY = 'face-store-access'
+
+
+FaceEntry = namedtuple('FaceEntry', ['face_hash', 'last_modified', 'checked'])
+
+# uuid -> FaceEntry
+_index = LRUCache(app.config['FACE_INDEX_SIZE'])
+
+# hash -> when it was last recorded as served
+_touched = LRUCache(app.config['FACE_INDEX_SIZE'])
+
+_default_hash = None
+
+
+def _face_dir(face_hash):
+    return '%s/store/%s/%s' % (FACES_PATH, face_hash[:2], face_hash)
+
+
+def _face_path(face_hash, size):
+    return '%s/%s.png' % (_face_dir(face_hash), size)
+
+
+def _base_path(face_hash):
+    return '%s/base.png' % _face_dir(face_hash)
+
+
+def _player_path(uuid):
+    return '%s/players/%s' % (FACES_PATH, uuid)
+
+
+def _sprite_path(sprite_hash, complete=True):
+    return '%s/sprites/%s%s.png' % (FACES_PATH, sprite_hash, '' if complete else '-partial')
+
+
+def _write(path, write):
+    """
+    Writes a file through a temporary one that replaces it in one step, so it's
+    never read partially written.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+
+    write(tmp_path)
+
+    os.rename(tmp_path, path)
+
+
+def _optimize(path):
+    try:
+        subprocess.call(['optipng', '-quiet', path])
+    except OSError:
+        rollbar.report_exc_info(level='warning')
+
+
+def _store_base(base):
+    """
+    Adds the 8x8 face to the store if it isn't there yet, returning its hash.
+    """
+    base = base.convert('RGBA')
+    face_hash = hashlib.sha1(base.tobytes()).hexdigest()
+
+    path = _base_path(face_hash)
+
+    if not os.path.exists(path):
+        _write(path, lambda tmp_path: base.save(tmp_path, 'PNG'))
+
+    return face_hash
+
+
+def _render(face_hash, size, optimize=False):
+    """
+    Returns the path of the face with the given hash at the given size, rendering
+    it from the base if it hasn't been yet.
+    """
+    path = _face_path(face_hash, size)
+
+    if not os.path.exists(path):
+        base = Image.open(_base_path(face_hash))
+
+        def write(tmp_path):
+            base.resize((size, size), Image.NEAREST).save(tmp_path, 'PNG', optimize=True)
+
+            if optimize:
+                _optimize(tmp_path)
+
+        _write(path, write)
+
+    return path
+
+
+def _get_default_hash():
+    global _default_hash
+
+    if not _default_hash:
+        _default_hash = _store_base(
+            libplayer.extract_face(Image.open(PROJECT_PATH + '/standardweb/static/images/char.png'), BASE_SIZE)
+        )
+
+    return _default_hash
+
+
+def _set_player_face(uuid, face_hash, last_modified=None):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write(face_hash)
+
+        if last_modified:
+            os.utime(tmp_path, (last_modified, last_modified))
+
+    _write(_player_path(uuid), write)
+
+    _index.pop(uuid, None)
+
+
+def _get_entry(uuid):
+    now = time.time()
+    entry = _index.get(uuid)
+
+    if entry and now - entry.checked < app.config['FACE_INDEX_TIME']:
+        return entry
+
+    try:
+        with open(_player_path(uuid)) as f:
+            face_hash = f.read().strip()
+            last_modified = datetime.utcfromtimestamp(os.fstat(f.fileno()).st_mtime)
+    except (IOError, OSError):
+        face_hash, last_modified = None, None
+
+    entry = FaceEntry(face_hash, last_modified, now)
+    _index.set(uuid, entry)
+
+    return entry
+
+
+def _touch(face_hash):
+    now = time.time()
+
+    if now - _touched.get(face_hash, 0) < app.config['FACE_INDEX_TIME']:
+        return
+
+    _touched.set(face_hash, now)
+
+    try:
+        redis_client.zadd(ACCESS_KEY, now, face_hash)
+    except redis.RedisError:
+        pass
+
+
+def is_valid_size(size):
+    return size in SIZES
+
+
+def get_etag(face_hash, size):
+    return '%s-%d' % (face_hash, size)
+
+
+def get_face(uuid):
+    """
+    Returns a tuple of the hash of the player's face, when it was fetched and
+    whether it's the player's own face rather than the default one, queueing a
+    refresh of the player's face if it's missing or stale.
+    """
+    entry = _get_entry(uuid)
+
+    if not entry.last_modified or (
+        datetime.utcnow() - entry.last_modified
+    ).total_seconds() > app.config['FACE_MAX_AGE']:
+        request_refresh(uuid)
+
+    if entry.face_hash:
+        _touch(entry.face_hash)
+
+        return entry.face_hash, entry.last_modified, True
+
+    return _get_default_hash(), None, False
+
+
+def get_face_path(uuid, face_hash, size):
+    """
+    Returns a tuple of the hash and path of the image of the face with the given
+    hash, which get_face returned for the player, at the given size, or of the
+    default face if it's been evicted since.
+    """
+    try:
+        return face_hash, _render(face_hash, size)
+    except IOError:
+        # evicted since the player's face was fetched, so fetch it again
+        try:
+            os.utime(_player_path(uuid), (0, 0))
+        except OSError:
+            pass
+
+        _index.pop(uuid, None)
+        request_refresh(uuid)
+
+        default_hash = _get_default_hash()
+
+        return default_hash, _render(default_hash, size)
+
+
+def request_refresh(uuid):
+    """
+    Queues a refresh of the player's faces unless one was already queued recently.
+    """
+    from standardweb.tasks.faces import refresh_faces_task
+
+    if not UUID_RE.match(uuid):
+        return
+
+    try:
+        queued = redis_client.set(
+            'face-refresh-pending-%s' % uuid, 1, nx=True, ex=app.config['FACE_REFRESH_PENDING_TIME']
+        )
+    except redis.RedisError:
+        # without being able to tell if it's already queued, leave it for later
+        return
+
+    if queued:
+        refresh_faces_task.apply_async((uuid,))
+
+
+def _take_rate_limit():
+    window = app.config['FACE_REFRESH_RATE_WINDOW']
+    key = 'face-refresh-rate-%d' % (int(time.time()) // window)
+
+    count, _ = redis_client.pipeline().incr(key).expire(key, window).execute()
+
+    if count > app.config['FACE_REFRESH_RATE_LIMIT']:
+        raise exceptions.RemoteRateLimitException()
+
+
+def _get_skin_url(uuid):
+    profile = mojang.get_player_profile(uuid)
+
+    for property in profile.get('properties', []):
+        if property and property.get('name') == 'textures':
+            textures = json.loads(property['value'].decode('base64'))
+
+            return textures.get('textures', {}).get('SKIN', {}).get('url')
+
+    return None
+
+
+def refresh_faces(uuid):
+    """
+    Sets the player's face from their current skin, rendering it at each of
+    PRERENDERED_SIZES. If they don't have a skin their existing face is kept, or
+    the default face is set if they don't have one. Raises RemoteRateLimitException
+    if the refresh has to wait for the rate limit.
+    """
+    _take_rate_limit()
+
+    skin_url = _get_skin_url(uuid)
+
+    if skin_url:
+        resp = requests.get(skin_url, timeout=5)
+        resp.raise_for_status()
+
+        skin = Image.open(StringIO.StringIO(resp.content))
+        skin.load()
+
+        face_hash = _store_base(libplayer.extract_face(skin, BASE_SIZE))
+    else:
+        face_hash = _get_entry(uuid).face_hash
+
+        if not face_hash or not os.path.exists(_base_path(face_hash)):
+            face_hash = _get_default_hash()
+
+    for size in PRERENDERED_SIZES:
+        _render(face_hash, size, optimize=True)
+
+    _set_player_face(uuid, face_hash)
+
+
+def import_legacy_faces():
+    """
+    Adds the faces stored by uuid in faces/64/ before the store existed, keeping
+    when they were fetched so they're refreshed as they would have been. Returns
+    the number of faces imported.
+    """
+    imported = 0
+    legacy_path = '%s/64' % FACES_PATH
+
+    for filename in os.listdir(legacy_path):
+        uuid, ext = os.path.splitext(filename)
+
+        if ext != '.png' or not UUID_RE.match(uuid) or os.path.exists(_player_path(uuid)):
+            continue
+
+        path = os.path.join(legacy_path, filename)
+
+        try:
+            base = Image.open(path).resize((BASE_SIZE, BASE_SIZE), Image.NEAREST)
+        except IOError:
+            continue
+
+        _set_player_face(uuid, _store_base(base), last_modified=os.path.getmtime(path))
+
+        imported += 1
+
+    return imported
+
+
+def _get_dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, filename))
+        for directory, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+def evict_faces():
+    """
+    Removes the least recently served faces until the store is no bigger than
+    FACE_STORE_MAX_BYTES, along with sprites older than FACE_SPRITE_MAX_AGE.
+    Returns the number of faces removed.
+    """
+    store_path = '%s/store' % FACES_PATH
+
+    faces = []
+    for prefix in os.listdir(store_path) if os.path.exists(store_path) else ():
+        for face_hash in os.listdir(os.path.join(store_path, prefix)):
+            path = _face_dir(face_hash)
+            faces.append((face_hash, os.path.getmtime(path), _get_dir_size(path)))
+
+    total = sum(size for _, _, size in faces)
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for face_hash, _, _ in faces:
+            pipe.zscore(ACCESS_KEY, face_hash)
+
+        accessed = pipe.execute()
+    except redis.RedisError:
+        accessed = [None] * len(faces)
+
+    # faces that haven't been served yet count from when they were added
+    faces = sorted(
+        (max(score or 0, mtime), face_hash, size)
+        for (face_hash, mtime, size), score in zip(faces, accessed)
+    )
+
+    default_hash = _get_default_hash()
+    evicted = []
+
+    for _, face_hash, size in faces:
+        if total <= app.config['FACE_STORE_MAX_BYTES']:
+            break
+
+        if face_hash == default_hash:
+            continue
+
+        shutil.rmtree(_face_dir(face_hash), ignore_errors=True)
+
+        total -= size
+        evicted.append(face_hash)
+
+    if evicted:
+        try:
+            redis_client.zrem(ACCESS_KEY, *evicted)
+        except redis.RedisError:
+            pass
+
+    sprites_path = '%s/sprites' % FACES_PATH
+
+    for filename in os.listdir(sprites_path) if os.path.exists(sprites_path) else ():
+        path = os.path.join(sprites_path, filename)
+
+        if time.time() - os.path.getmtime(path) > app.config['FACE_SPRITE_MAX_AGE']:
+            os.remove(path)
+
+    return len(evicted)
+
+
+def _sprite_key(sprite_hash):
+    return 'face-sprite-%s' % sprite_hash
+
+
+def register_sprite(uuids):
+    """
+    Returns the hash naming the sprite of the faces of the given uuids in order,
+    storing the list so the sprite can be built when it's requested, or None if
+    it couldn't be stored.
+    """
+    uuids = ','.join(uuids)
+    sprite_hash = hashlib.sha1(uuids).hexdigest()
+
+    try:
+        redis_client.set(_sprite_key(sprite_hash), uuids, ex=app.config['FACE_SPRITE_TIME'])
+    except redis.RedisError:
+        return None
+
+    return sprite_hash
+
+
+def get_sprite(sprite_hash):
+    """
+    Returns a tuple of the PNG of the sprite with the given hash and whether it has
+    every face in it rather than default faces for any that aren't in the store
+    yet, or None if the sprite is unknown.
+    """
+    for complete, max_age in (
+        (True, app.config['FACE_SPRITE_MAX_AGE']),
+        (False, app.config['FACE_SPRITE_PARTIAL_MAX_AGE'])
+    ):
+        path = _sprite_path(sprite_hash, complete=complete)
+
+        try:
+            if time.time() - os.path.getmtime(path) < max_age:
+                with open(path, 'rb') as f:
+                    return f.read(), complete
+        except (IOError, OSError):
+            pass
+
+    try:
+        uuids = redis_client.get(_sprite_key(sprite_hash))
+    except redis.RedisError:
+        uuids = None
+
+    if not uuids:
+        return None
+
+    uuids = uuids.split(',')
+
+    sprite = Image.new('RGBA', (SPRITE_SIZE * len(uuids), SPRITE_SIZE))
+    complete = True
+
+    for i, uuid in enumerate(uuids):
+        face_hash, _, own = get_face(uuid)
+        rendered_hash, face_path = get_face_path(uuid, face_hash, SPRITE_SIZE)
+
+        complete = complete and own and rendered_hash == face_hash
+
+        sprite.paste(Image.open(face_path), (i * SPRITE_SIZE, 0))
+
+    tmp = StringIO.StringIO()
+    sprite.save(tmp, 'PNG', optimize=True)
+    png = tmp.getvalue()
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(png)
+
+    # sprites missing faces are only kept briefly, to be built again once the
+    # missing faces have been fetched
+    _write(_sprite_path(sprite_hash, complete=complete), write)
+
+    return png, complete
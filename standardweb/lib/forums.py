@@ -4,7 +4,6 @@ import cgi
 import re
 
 from standardweb import app, db
-from standardweb.lib import player as libplayer
 from standardweb.models import AuditLog, ForumTopicSubscription, ForumTopic, ForumPost, Forum
 
 
@@ -121,9 +120,7 @@ def can_user_post(user):
     if not user.player:
         return True
 
-    total_time = libplayer.get_total_player_time(user.player.id)
-
-    return total_time > app.config['MINIMUM_FORUM_POST_PLAYER_TIME']
+    return user.player.total_time > app.config['MINIMUM_FORUM_POST_PLAYER_TIME']
 
 
 def delete_post(post):
@@ -1,31 +1,359 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import redis
+import rollbar
+from sqlalchemy import func
 from sqlalchemy.orm import joinedload
 
-from standardweb import app
-from standardweb.lib import cache
-from standardweb.models import KillType, KillCount, MaterialType, OreDiscoveryCount
+from standardweb import app, db, redis_client
+from standardweb.lib import cache, counters, registry
+from standardweb.models import KillCount, KillCountDaily, OreDiscoveryCount, OreDiscoveryCountDaily, Player
+
+
+LEADERBOARD_SIZE = 10
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+
+# number of days of daily rollups summed for each leaderboard window
+WINDOWS = {
+    DAY: 1,
+    WEEK: 7,
+    MONTH: 30
+}
+
+# how long a built index is trusted before it's rebuilt from the db, which
+# corrects any drift such as increments made while it was being rebuilt
+INDEX_TIME = 86400
+
+# the type and player columns of the count models that have leaderboards
+BOARD_COLUMNS = {
+    KillCount: ('kill_type_id', 'killer_id'),
+    OreDiscoveryCount: ('material_type_id', 'player_id')
+}
+
+# the daily rollups of the count models that have leaderboards
+DAILY_MODELS = {
+    KillCount: KillCountDaily,
+    OreDiscoveryCount: OreDiscoveryCountDaily
+}
+
+
+def _index_key(cls, server_id, type_id):
+    return 'leaderboard-%s-%d-%d' % (cls.__tablename__, server_id, type_id)
+
+
+def _built_key(cls, server_id, type_id):
+    return 'leaderboard-built-%s-%d-%d' % (cls.__tablename__, server_id, type_id)
+
+
+def rebuild_index(cls, server_id, type_id):
+    """
+    Builds the sorted set of player id -> count for a leaderboard from the flushed
+    and pending counts and swaps it in place of the existing index.
+    """
+    type_column, player_column = BOARD_COLUMNS[cls]
+
+    key = _index_key(cls, server_id, type_id)
+    tmp_key = key + '-tmp'
+
+    counts = defaultdict(int)
+
+    rows = db.session.query(
+        getattr(cls, player_column),
+        cls.count
+    ).filter(
+        cls.server_id == server_id,
+        getattr(cls, type_column) == type_id
+    )
+
+    for player_id, count in rows:
+        counts[player_id] += count or 0
+
+    player_index = cls.KEY_COLUMNS.index(player_column)
+    for count_key, n in counters.get_pending(cls, server_id=server_id, **{type_column: type_id}).iteritems():
+        counts[count_key[player_index]] += n
+
+    counts = counts.items()
+
+    pipe = redis_client.pipeline()
+    pipe.delete(tmp_key)
+
+    for i in xrange(0, len(counts), 1000):
+        args = []
+        for player_id, count in counts[i:i + 1000]:
+            args.extend((count, player_id))
+
+        pipe.zadd(tmp_key, *args)
+
+    if counts:
+        pipe.rename(tmp_key, key)
+    else:
+        pipe.delete(key)
+
+    pipe.set(_built_key(cls, server_id, type_id), 1, ex=INDEX_TIME)
+    pipe.execute()
+
+
+def get_daily_increments(cls, counts):
+    """
+    Returns the daily rollup model of the count model and a map of its key -> n
+    adding each n in a map of count key -> n, as passed to counters.increment, to
+    today's rollups, or (None, None) if the count model has no leaderboards.
+    """
+    if cls not in BOARD_COLUMNS or not counts:
+        return None, None
+
+    type_column, player_column = BOARD_COLUMNS[cls]
+    server_index = cls.KEY_COLUMNS.index('server_id')
+    type_index = cls.KEY_COLUMNS.index(type_column)
+    player_index = cls.KEY_COLUMNS.index(player_column)
+
+    today = datetime.utcnow().date()
+
+    daily_counts = defaultdict(int)
+    for key, n in counts.iteritems():
+        if key[player_index]:
+            daily_counts[(key[server_index], key[type_index], key[player_index], today)] += n
+
+    return DAILY_MODELS[cls], daily_counts
+
+
+def update_index(cls, counts):
+    """
+    Adds each n in a map of count key -> n, as passed to counters.increment, to the
+    indexed leaderboards of the count model.
+    """
+    if cls not in BOARD_COLUMNS or not counts:
+        return
+
+    type_column, player_column = BOARD_COLUMNS[cls]
+    server_index = cls.KEY_COLUMNS.index('server_id')
+    type_index = cls.KEY_COLUMNS.index(type_column)
+    player_index = cls.KEY_COLUMNS.index(player_column)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key, n in counts.iteritems():
+        if key[player_index]:
+            pipe.zincrby(_index_key(cls, key[server_index], key[type_index]), key[player_index], n)
+
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning', extra_data={'table': cls.__tablename__})
+
+
+def _get_indexed_leaderboards(server, boards):
+    """
+    Returns a list of (count, player) for each (count model, type id) leaderboard,
+    or None if the index isn't available.
+    """
+    def read(boards):
+        pipe = redis_client.pipeline(transaction=False)
+        for cls, type_id in boards:
+            pipe.exists(_built_key(cls, server.id, type_id))
+            pipe.zrevrange(_index_key(cls, server.id, type_id), 0, LEADERBOARD_SIZE - 1,
+                           withscores=True, score_cast_func=int)
+
+        result = pipe.execute()
+
+        return zip(result[::2], result[1::2])
+
+    def unbuilt(results):
+        return [board for board, (built, _) in zip(boards, results) if not built]
+
+    try:
+        results = read(boards)
+
+        if unbuilt(results):
+            lease = cache.Lease('leaderboard-rebuild-%d' % server.id,
+                                time=app.config['LEADERBOARD_REBUILD_LEASE_TIME'])
+
+            with lease as acquired:
+                if acquired:
+                    # another request may have rebuilt them before this one got the lease
+                    results = read(boards)
+
+                    for cls, type_id in unbuilt(results):
+                        rebuild_index(cls, server.id, type_id)
+
+                    results = read(boards)
+                elif any(not board for (built, board) in results if not built):
+                    # another request is rebuilding them, and an unbuilt index that's
+                    # empty may never have been built, so fall back to the db until
+                    # it's done. Otherwise the existing index is served meanwhile
+                    return None
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning', extra_data={'server_id': server.id})
+        return None
+
+    player_ids = set(int(player_id) for _, board in results for player_id, _ in board)
+    players = {
+        player.id: player for player in Player.query.filter(Player.id.in_(player_ids))
+    } if player_ids else {}
+
+    return [
+        sorted([
+            (count, players[int(player_id)]) for player_id, count in board
+            if count > 0 and int(player_id) in players
+        ], key=lambda x: (-x[0], x[1].displayname.lower()))
+        for _, board in results
+    ]
+
+
+def _get_windowed_leaderboards(server, boards, window):
+    """
+    Returns a list of (count, player) for each (count model, type id) leaderboard
+    summed over the daily rollups of the given window, including today's.
+    """
+    start_date = datetime.utcnow().date() - timedelta(days=WINDOWS[window] - 1)
+
+    board_counts = []
+
+    for cls, type_id in boards:
+        daily_cls = DAILY_MODELS[cls]
+        type_column = getattr(daily_cls, BOARD_COLUMNS[cls][0])
+
+        filters = (
+            daily_cls.server_id == server.id,
+            type_column == type_id,
+            daily_cls.date >= start_date
+        )
+
+        counts = dict(
+            db.session.query(
+                daily_cls.player_id,
+                func.sum(daily_cls.count)
+            ).filter(
+                *filters
+            ).group_by(
+                daily_cls.player_id
+            ).order_by(
+                func.sum(daily_cls.count).desc()
+            ).limit(LEADERBOARD_SIZE)
+        )
+
+        pending = defaultdict(int)
+        for (_, _, player_id, date), n in counters.get_pending(
+            daily_cls, server_id=server.id, **{BOARD_COLUMNS[cls][0]: type_id}
+        ).iteritems():
+            if date >= start_date:
+                pending[player_id] += n
+
+        # players outside the top in the db may be pushed into it by their pending counts
+        missing_ids = set(pending) - set(counts)
+        if missing_ids:
+            counts.update(db.session.query(
+                daily_cls.player_id,
+                func.sum(daily_cls.count)
+            ).filter(
+                daily_cls.player_id.in_(missing_ids),
+                *filters
+            ).group_by(
+                daily_cls.player_id
+            ))
+
+        board_counts.append({
+            player_id: int(counts.get(player_id) or 0) + pending.get(player_id, 0)
+            for player_id in set(counts) | set(pending)
+        })
+
+    player_ids = set(player_id for counts in board_counts for player_id in counts)
+    players = {
+        player.id: player for player in Player.query.filter(Player.id.in_(player_ids))
+    } if player_ids else {}
+
+    return [
+        sorted([
+            (count, players[player_id]) for player_id, count in counts.iteritems()
+            if count > 0 and player_id in players
+        ], key=lambda x: (-x[0], x[1].displayname.lower()))[:LEADERBOARD_SIZE]
+        for counts in board_counts
+    ]
+
+
+def _with_pending(counts, pending):
+    """
+    Adds a map of player id -> pending count onto a list of (count, player) from
+    the db, pulling in any players that only have pending counts so far.
+    """
+    pending = dict(pending)
+
+    counts = [(count + pending.pop(player.id, 0), player) for count, player in counts]
+
+    if pending:
+        players = Player.query.filter(Player.id.in_(pending.keys()))
+        counts.extend((pending[player.id], player) for player in players)
+
+    return counts
 
 
 def _build_kill_leaderboard(server, type):
-    kill_type = KillType.query.filter_by(type=type).first()
-    kills = KillCount.query.filter_by(server=server, kill_type=kill_type) \
+    kill_type = registry.kill_types.get(type)
+    if not kill_type:
+        return None
+
+    kills = KillCount.query.filter_by(server=server, kill_type_id=kill_type.id) \
         .options(joinedload('killer')) \
         .order_by(KillCount.count.desc()) \
         .limit(10)
+
+    pending = {
+        key[2]: n for key, n in
+        counters.get_pending(KillCount, server_id=server.id, kill_type_id=kill_type.id).iteritems()
+    }
+
+    kills = list(kills)
+
+    if pending:
+        # players outside the top 10 in the db may be pushed into it by their pending kills
+        top_ids = set(x.id for x in kills)
+        kills.extend(x for x in KillCount.query.filter(
+            KillCount.server_id == server.id,
+            KillCount.kill_type_id == kill_type.id,
+            KillCount.killer_id.in_(pending.keys())
+        ).options(joinedload('killer')) if x.id not in top_ids)
+
+    kills = _with_pending([(x.count, x.killer) for x in kills], pending)
+
     if kills:
-        return sorted([(x.count, x.killer) for x in kills], key=lambda x: (-x[0], x[1].displayname.lower()))[:10]
+        return sorted(kills, key=lambda x: (-x[0], x[1].displayname.lower()))[:10]
 
     return None
 
 
 def _build_block_discovery_leaderboard(server, type):
-    material_type = MaterialType.query.filter_by(type=type).first()
-    discoveries = OreDiscoveryCount.query.filter_by(server=server, material_type=material_type) \
+    material_type = registry.material_types.get(type)
+    if not material_type:
+        return None
+
+    discoveries = OreDiscoveryCount.query.filter_by(server=server, material_type_id=material_type.id) \
         .options(joinedload('player')) \
         .order_by(OreDiscoveryCount.count.desc()) \
         .limit(10)
 
+    pending = {
+        key[2]: n for key, n in
+        counters.get_pending(OreDiscoveryCount, server_id=server.id, material_type_id=material_type.id).iteritems()
+    }
+
+    discoveries = list(discoveries)
+
+    if pending:
+        # players outside the top 10 in the db may be pushed into it by their pending discoveries
+        top_ids = set(x.id for x in discoveries)
+        discoveries.extend(x for x in OreDiscoveryCount.query.filter(
+            OreDiscoveryCount.server_id == server.id,
+            OreDiscoveryCount.material_type_id == material_type.id,
+            OreDiscoveryCount.player_id.in_(pending.keys())
+        ).options(joinedload('player')) if x.id not in top_ids)
+
+    discoveries = _with_pending([(x.count, x.player) for x in discoveries], pending)
+
     if discoveries:
-        return sorted([(x.count, x.player) for x in discoveries], key=lambda x: (-x[0], x[1].displayname.lower()))[:10]
+        return sorted(discoveries, key=lambda x: (-x[0], x[1].displayname.lower()))[:10]
 
     return None
 
@@ -58,24 +386,86 @@ def _get_ore_leaderboards(server, element, title, section, subtitle=None):
     _get_leaderboard_report(server, 'ores', element, title, section, subtitle)
 
 
-@cache.CachedResult('leaderbaords', time=30)
-def get_leaderboard_data(server):
+def get_leaderboard_data(server, window=None):
+    """
+    Returns the kill and ore leaderboards of the server, either all-time or for one
+    of the WINDOWS.
+    """
+    if window:
+        return _get_windowed_leaderboard_data(server, window)
+
+    return _get_leaderboard_data(server)
+
+
+# the windowed leaderboards are summed from the daily rollups on every request
+@cache.CachedResult('windowed-leaderboards', time=60)
+def _get_windowed_leaderboard_data(server, window):
+    return _get_leaderboard_data(server, window=window)
+
+
+def _get_leaderboard_data(server, window=None):
     kill_leaderboards = []
     ore_leaderboards = []
 
-    kill_identifiers = app.config['KILL_LEADERBOARDS']
-    material_identifiers = app.config['ORE_LEADERBOARDS']
+    kill_types = [registry.kill_types.get(identifier) for identifier in app.config['KILL_LEADERBOARDS']]
+    kill_types = [kill_type for kill_type in kill_types if kill_type]
 
-    kill_types = KillType.query.all()
-    kill_type_name_map = {kill_type.type: kill_type.displayname for kill_type in kill_types}
+    material_types = [registry.material_types.get(identifier) for identifier in app.config['ORE_LEADERBOARDS']]
+    material_types = [material_type for material_type in material_types if material_type]
 
-    material_types = MaterialType.query.all()
-    meterial_type_name_map = {material_type.type: material_type.displayname for material_type in material_types}
+    boards = [(KillCount, kill_type.id) for kill_type in kill_types] + \
+        [(OreDiscoveryCount, material_type.id) for material_type in material_types]
 
-    for identifier in kill_identifiers:
-        _get_kill_leaderboards(server, identifier, '%s Kills' % kill_type_name_map[identifier], kill_leaderboards)
+    if window:
+        leaderboard_lists = _get_windowed_leaderboards(server, boards, window)
+    else:
+        leaderboard_lists = _get_indexed_leaderboards(server, boards)
 
-    for identifier in material_identifiers:
-        _get_ore_leaderboards(server, identifier, '%s Discoveries' % meterial_type_name_map[identifier], ore_leaderboards)
+    if leaderboard_lists is None:
+        for kill_type in kill_types:
+            _get_kill_leaderboards(server, kill_type.type, '%s Kills' % kill_type.displayname, kill_leaderboards)
+
+        for material_type in material_types:
+            _get_ore_leaderboards(server, material_type.type, '%s Discoveries' % material_type.displayname,
+                                  ore_leaderboards)
+
+        return kill_leaderboards, ore_leaderboards
+
+    kill_lists = leaderboard_lists[:len(kill_types)]
+    ore_lists = leaderboard_lists[len(kill_types):]
+
+    for kill_type, leaderboard_list in zip(kill_types, kill_lists):
+        if leaderboard_list:
+            kill_leaderboards.append({
+                'title': '%s Kills' % kill_type.displayname,
+                'list': leaderboard_list
+            })
+
+    for material_type, leaderboard_list in zip(material_types, ore_lists):
+        if leaderboard_list:
+            ore_leaderboards.append({
+                'title': '%s Discoveries' % material_type.displayname,
+                'list': leaderboard_list
+            })
 
     return kill_leaderboards, ore_leaderboards
+
+
+def prune_daily_counts():
+    """
+    Deletes the daily rollups that are too old to be part of any leaderboard
+    window, returning the number of rows deleted.
+    """
+    retention = max(app.config['LEADERBOARD_DAILY_RETENTION_DAYS'], max(WINDOWS.values()))
+    cutoff = datetime.utcnow().date() - timedelta(days=retention)
+
+    deleted = 0
+
+    for daily_cls in DAILY_MODELS.values():
+        deleted += db.session.execute(
+            daily_cls.__table__.delete().where(daily_cls.date < cutoff)
+        ).rowcount
+
+    db.session.commit()
+
+    return deleted
@@ -0,0 +1,141 @@
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from sqlalchemy import func
+
+from standardweb import app, db
+from standardweb.lib import registry
+from standardweb.models import OreDiscoveryChunk, Player
+
+
+CHUNK = 'chunk'
+REGION = 'region'
+
+# number of chunks along each side of a region
+REGION_SIZE = 32
+
+# ores that are too rare to be found at this rate without seeing through blocks
+XRAY_ORES = ('DIAMOND_ORE', 'EMERALD_ORE')
+
+
+def record_discoveries(discoveries):
+    """
+    Adds ore discoveries to the chunk bins, taking a list of dicts with the
+    server_id, material_type_id, player_id and x/z of each discovery.
+    """
+    date = datetime.utcnow().date()
+
+    counts = Counter(
+        (row['server_id'], row['material_type_id'], date) +
+        OreDiscoveryChunk.get_chunk(row['x'], row['z']) +
+        (row['player_id'],)
+        for row in discoveries
+    )
+
+    OreDiscoveryChunk.increment_many(counts)
+
+
+def get_tiles(server, material_type_ids, min_x, min_z, max_x, max_z, start_date, end_date, resolution=CHUNK):
+    """
+    Returns a list of (tile x, tile z, count) of the discoveries of the given
+    material types within the block bounding box and date range, binned into
+    chunk or region sized tiles.
+    """
+    min_chunk_x, min_chunk_z = OreDiscoveryChunk.get_chunk(min_x, min_z)
+    max_chunk_x, max_chunk_z = OreDiscoveryChunk.get_chunk(max_x, max_z)
+
+    if resolution == REGION:
+        tile_x = func.floor(OreDiscoveryChunk.chunk_x / REGION_SIZE)
+        tile_z = func.floor(OreDiscoveryChunk.chunk_z / REGION_SIZE)
+    else:
+        tile_x = OreDiscoveryChunk.chunk_x
+        tile_z = OreDiscoveryChunk.chunk_z
+
+    rows = db.session.query(
+        tile_x,
+        tile_z,
+        func.sum(OreDiscoveryChunk.count)
+    ).filter(
+        OreDiscoveryChunk.server_id == server.id,
+        OreDiscoveryChunk.material_type_id.in_(material_type_ids),
+        OreDiscoveryChunk.date >= start_date,
+        OreDiscoveryChunk.date <= end_date,
+        OreDiscoveryChunk.chunk_x >= min_chunk_x,
+        OreDiscoveryChunk.chunk_x <= max_chunk_x,
+        OreDiscoveryChunk.chunk_z >= min_chunk_z,
+        OreDiscoveryChunk.chunk_z <= max_chunk_z
+    ).group_by(
+        tile_x,
+        tile_z
+    )
+
+    return [(int(x), int(z), int(count)) for x, z, count in rows]
+
+
+def get_xray_scores(server, start_date, end_date, limit=20):
+    """
+    Returns a list of the players with the most suspicious ore discoveries on the
+    server within the date range, most suspicious first.
+
+    A player's score is their share of rare ore (XRAY_ORES) among all the ore they
+    discovered relative to the same share across the whole server, so 1 is an
+    ordinary miner and anything well above it is finding rare ore unusually often.
+    Players with fewer than XRAY_MIN_DISCOVERIES discoveries aren't scored.
+    """
+    ores = registry.get_ores()
+    rare_ids = set(ore.id for ore in ores if ore.type in XRAY_ORES)
+
+    rows = db.session.query(
+        OreDiscoveryChunk.player_id,
+        OreDiscoveryChunk.material_type_id,
+        func.sum(OreDiscoveryChunk.count),
+        func.count()
+    ).filter(
+        OreDiscoveryChunk.server_id == server.id,
+        OreDiscoveryChunk.material_type_id.in_([ore.id for ore in ores]),
+        OreDiscoveryChunk.date >= start_date,
+        OreDiscoveryChunk.date <= end_date
+    ).group_by(
+        OreDiscoveryChunk.player_id,
+        OreDiscoveryChunk.material_type_id
+    )
+
+    totals = defaultdict(int)
+    rares = defaultdict(int)
+    rare_chunk_days = defaultdict(int)
+
+    for player_id, material_type_id, count, chunk_days in rows:
+        totals[player_id] += int(count)
+
+        if material_type_id in rare_ids:
+            rares[player_id] += int(count)
+            rare_chunk_days[player_id] += chunk_days
+
+    server_total = sum(totals.itervalues())
+    server_rare = sum(rares.itervalues())
+
+    if not server_total or not server_rare:
+        return []
+
+    server_ratio = float(server_rare) / server_total
+
+    scores = [
+        (player_id, (float(rares[player_id]) / total) / server_ratio)
+        for player_id, total in totals.iteritems()
+        if total >= app.config['XRAY_MIN_DISCOVERIES']
+    ]
+
+    scores = sorted(scores, key=lambda x: -x[1])[:limit]
+
+    players = {
+        player.id: player for player in
+        Player.query.filter(Player.id.in_([player_id for player_id, _ in scores]))
+    } if scores else {}
+
+    return [{
+        'player': players[player_id],
+        'score': score,
+        'total': totals[player_id],
+        'rare': rares[player_id],
+        'rare_chunk_days': rare_chunk_days[player_id]
+    } for player_id, score in scores]
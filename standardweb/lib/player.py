@@ -1,20 +1,13 @@
 from datetime import timedelta, datetime
 
 from sqlalchemy.orm import joinedload
-from sqlalchemy.sql import func, or_
 
-from standardweb import db
-from standardweb.lib import api, cache
+from standardweb.lib import api, profiles, registry, search
+from standardweb.lib import rank as librank
 from standardweb.lib import helpers as h
 from standardweb.models import (
     AuditLog,
-    DeathCount,
-    KillCount,
-    MaterialType,
-    OreDiscoveryCount,
     Player,
-    PlayerStats,
-    Server,
     Title,
     VeteranStatus
 )
@@ -40,168 +33,107 @@ def filter_players(query, page_size=None, page=None):
     if page is None:
         page = 0
 
-    results = Player.query.filter(
-        or_(
-            Player.username.ilike('%%%s%%' % query),
-            Player.nickname.ilike('%%%s%%' % query)
-        )
-    ).options(
-        joinedload(Player.user)
-    ).order_by(
-        func.ifnull(Player.nickname, Player.username)
-    ).limit(
-        page_size
-    ).offset(
-        page * page_size
-    )
+    return search.search_players(query, page_size=page_size, page=page)
 
-    return list(results)
 
+def get_combat_data(snapshot):
+    """
+    Returns the combat stats for the pvp and other kills and deaths in a player's
+    profile snapshot.
+    """
+    players = snapshot['players']
+
+    # skip any counts against a player the snapshot has no entry for, though they
+    # still count towards the totals
+    pvp_deaths = [{
+        'player': players[killer_id],
+        'count': count
+    } for (_, killer_id), count in snapshot['pvp_deaths'].iteritems() if killer_id in players]
+
+    pvp_kills = [{
+        'player': players[victim_id],
+        'count': count
+    } for (_, victim_id), count in snapshot['pvp_kills'].iteritems() if victim_id in players]
+
+    death_types = {
+        death_type_id: registry.death_types.get_by_id(death_type_id)
+        for death_type_id in snapshot['deaths']
+    }
 
-def get_combat_data(player, server):
-    pvp_kills = []
-    pvp_deaths = []
-    other_kills = []
-    other_deaths = []
+    kill_types = {
+        kill_type_id: registry.kill_types.get_by_id(kill_type_id)
+        for kill_type_id in snapshot['kills']
+    }
 
-    pvp_kill_count = 0
-    pvp_death_count = 0
-    other_kill_count = 0
-    other_death_count = 0
+    # skip any counts of a type that's since been deleted
+    other_deaths = [{
+        'type': death_types[death_type_id].displayname,
+        'count': count
+    } for death_type_id, count in snapshot['deaths'].iteritems() if death_types[death_type_id]]
 
-    deaths = DeathCount.query.filter_by(server=server, victim_id=player.id) \
-        .options(joinedload('killer')).options(joinedload('death_type'))
+    other_kills = [{
+        'type': kill_types[kill_type_id].displayname,
+        'count': count
+    } for kill_type_id, count in snapshot['kills'].iteritems() if kill_types[kill_type_id]]
 
-    for death in deaths:
-        if death.killer:
-            pvp_deaths.append({
-                'player': death.killer,
-                'count': death.count
-            })
-            pvp_death_count += death.count
-        else:
-            other_deaths.append({
-                'type': death.death_type.displayname,
-                'count': death.count
-            })
-            other_death_count += death.count
-
-    kills = KillCount.query.filter_by(server=server, killer_id=player.id) \
-        .options(joinedload('kill_type'))
-
-    for kill in kills:
-        other_kills.append({
-            'type': kill.kill_type.displayname,
-            'count': kill.count
-        })
-        other_kill_count += kill.count
-
-    kills = DeathCount.query.filter_by(server=server, killer_id=player.id) \
-        .options(joinedload('victim')).options(joinedload('death_type'))
-
-    for kill in kills:
-        pvp_kills.append({
-            'player': kill.victim,
-            'count': kill.count
-        })
-        pvp_kill_count += kill.count
-
-    pvp_kills = sorted(pvp_kills, key=lambda k: (-k['count'], k['player'].displayname.lower()))
-    pvp_deaths = sorted(pvp_deaths, key=lambda k: (-k['count'], k['player'].displayname.lower()))
+    pvp_kills = sorted(pvp_kills, key=lambda k: (-k['count'], k['player']['displayname'].lower()))
+    pvp_deaths = sorted(pvp_deaths, key=lambda k: (-k['count'], k['player']['displayname'].lower()))
     other_deaths = sorted(other_deaths, key=lambda k: (-k['count'], k['type']))
     other_kills = sorted(other_kills, key=lambda k: (-k['count'], k['type']))
 
     return {
-        'pvp_kill_count': pvp_kill_count,
-        'pvp_death_count': pvp_death_count,
+        'pvp_kill_count': sum(snapshot['pvp_kills'].itervalues()),
+        'pvp_death_count': sum(snapshot['pvp_deaths'].itervalues()),
         'pvp_kills': pvp_kills,
         'pvp_deaths': pvp_deaths,
-        'other_kill_count': other_kill_count,
-        'other_death_count': other_death_count,
+        'other_kill_count': sum(x['count'] for x in other_kills),
+        'other_death_count': sum(x['count'] for x in other_deaths),
         'other_deaths': other_deaths,
         'other_kills': other_kills
     }
 
 
-@cache.CachedResult('player', time=30)
 def get_data_on_server(player, server):
     """
     Returns a dict of all the data for a particular player which
     consists of their global gameplay stats and the stats for the
     given server.
     """
-    first_ever_seen = db.session.query(
-        func.min(PlayerStats.first_seen)
-    ).join(Server).filter(
-        PlayerStats.player_id == player.id,
-        Server.type == 'survival'
-    ).scalar()
-
-    if not first_ever_seen:
-        return None
-
-    last_seen = db.session.query(
-        func.max(PlayerStats.last_seen)
-    ).join(Server).filter(
-        PlayerStats.player_id == player.id,
-        Server.type == 'survival'
-    ).scalar()
+    snapshot = profiles.get_snapshot(player, server)
 
-    total_time = get_total_player_time(player.id)
-
-    ore_discoveries = OreDiscoveryCount.query.options(
-        joinedload(OreDiscoveryCount.material_type)
-    ).filter_by(
-        player=player,
-        server=server
-    )
-
-    ore_counts = {type: 0 for type in MaterialType.ORES}
-
-    for ore in ore_discoveries:
-        ore_counts[ore.material_type.type] += ore.count
-
-    ore_counts = [(ore.displayname, ore_counts[ore.type]) for ore in MaterialType.get_ores()]
+    if not snapshot:
+        return None
 
-    stats = PlayerStats.query.filter_by(
-        server=server,
-        player=player
-    ).first()
+    stats = snapshot['stats']
 
     server_stats = None
     if stats:
         server_stats = {
-            'rank': stats.rank,
-            'time_spent': h.elapsed_time_string(stats.time_spent),
-            'pvp_logs': stats.pvp_logs,
-            'group': stats.group,
-            'is_leader': stats.is_leader,
-            'is_moderator': stats.is_moderator,
-            'ore_counts': ore_counts
+            'rank': librank.get_player_rank(server.id, player.id, stats['time_spent']),
+            'time_spent': h.elapsed_time_string(stats['time_spent']),
+            'pvp_logs': stats['pvp_logs'],
+            'group': stats['group'],
+            'is_leader': stats['is_leader'],
+            'is_moderator': stats['is_moderator'],
+            'ore_counts': [
+                (ore.displayname, snapshot['ores'].get(ore.id, 0))
+                for ore in registry.get_ores()
+            ]
         }
 
+    last_seen = snapshot['last_seen']
     online_now = datetime.utcnow() - last_seen < timedelta(minutes=1)
 
     return {
-        'first_ever_seen': first_ever_seen,
+        'first_ever_seen': snapshot['first_ever_seen'],
         'last_seen': last_seen,
         'online_now': online_now,
-        'total_time': h.elapsed_time_string(total_time),
-        'combat_stats': get_combat_data(player, server),
+        'total_time': h.elapsed_time_string(player.total_time),
+        'combat_stats': get_combat_data(snapshot),
         'server_stats': server_stats
     }
 
 
-@cache.CachedResult('total_player_time', time=300)
-def get_total_player_time(player_id):
-    return db.session.query(
-        func.sum(PlayerStats.time_spent)
-    ).join(Server).filter(
-        PlayerStats.player_id == player_id,
-        Server.type == 'survival'
-    ).scalar()
-
-
 def apply_veteran_titles(player, allow_commit=True):
     update = False
     veteran_statuses = VeteranStatus.query.options(
@@ -0,0 +1,418 @@
+"""
+Materialized per-(player, server) profile snapshots backing the player page.
+
+A snapshot is a redis hash of everything the page shows for a player on a server
+that doesn't change by the second: when they were first and last seen, their
+stats on the server, and their ore, death and kill counts by type and opponent,
+along with the display fields of each opponent. It's built from the db and the
+pending count buffers the first time it's read, and from then on:
+ - count increments are added to it as they're buffered (lib/counters)
+ - the minute query sets the play time, pvp logs and last seen time of the players
+   it sees online
+ - any other change to a player's stats or group made through the ORM drops it
+   once committed, so it's built again on the next read
+
+so reading it is a single HGETALL. Updates only ever apply to snapshots that
+already exist, and every snapshot expires after PROFILE_SNAPSHOT_TIME seconds,
+which corrects any drift such as increments made while it was being built or
+opponents changing their nickname.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime
+import json
+
+import redis
+import rollbar
+from sqlalchemy import event, func, inspect, select
+
+from standardweb import app, db, redis_client
+from standardweb.lib import counters
+from standardweb.lib.transactions import after_commit
+from standardweb.models import DeathCount, Group, KillCount, OreDiscoveryCount, Player, PlayerStats, Server
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# field prefix -> snapshot key of the counts stored under it
+COUNT_FIELDS = {
+    'ore': 'ores',
+    'death': 'deaths',
+    'kill': 'kills',
+    'pvp_death': 'pvp_deaths',
+    'pvp_kill': 'pvp_kills'
+}
+
+# stats columns that only show up in the snapshot of the stats' own server
+SERVER_STATS_ATTRS = ('time_spent', 'pvp_logs', 'group', 'is_leader', 'is_moderator')
+
+# stats columns that are aggregated across the survival servers into every snapshot
+SEEN_ATTRS = ('first_seen', 'last_seen')
+
+
+# snapshots are only updated if they exist, so an update never leaves a partial one behind
+_hincrby_if_exists = redis_client.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    for i = 1, #ARGV, 2 do
+        redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+""")
+
+_hset_if_exists = redis_client.register_script("""
+if redis.call('exists', KEYS[1]) == 1 then
+    for i = 1, #ARGV, 2 do
+        redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+""")
+
+
+def _key(player_id, server_id):
+    return 'profile-%d-%d' % (player_id, server_id)
+
+
+def _encode_time(value):
+    return value.strftime(TIMESTAMP_FORMAT) if value else ''
+
+
+def _decode_time(value):
+    return datetime.strptime(value, TIMESTAMP_FORMAT) if value else None
+
+
+def _encode_player(player):
+    return json.dumps({
+        'username': player.username,
+        'uuid': player.uuid,
+        'displayname': player.displayname,
+        'displayname_html': player.displayname_html
+    })
+
+
+def _flatten(fields):
+    args = []
+    for field, value in fields.iteritems():
+        args.extend((field, value))
+
+    return args
+
+
+def _get_counts(cls, rows, **filters):
+    """
+    Returns a list of (key, count) for the given count rows with the increments
+    that are still buffered added on, including keys that are only buffered so far.
+    """
+    pending = counters.get_pending(cls, **filters)
+
+    counts = []
+    for row in rows:
+        key = tuple(getattr(row, column) for column in cls.KEY_COLUMNS)
+        counts.append((key, (row.count or 0) + pending.pop(key, 0)))
+
+    counts.extend(pending.iteritems())
+
+    return counts
+
+
+def _get_count_fields(cls, count_key):
+    """
+    Returns a list of (player id, field) of the snapshots that an increment of
+    the given key of a count model adds to.
+    """
+    if cls is DeathCount:
+        _, death_type_id, victim_id, killer_id = count_key
+
+        if not victim_id:
+            return []
+
+        if not killer_id:
+            return [(victim_id, 'death:%d' % death_type_id)]
+
+        return [
+            (victim_id, 'pvp_death:%d:%d' % (death_type_id, killer_id)),
+            (killer_id, 'pvp_kill:%d:%d' % (death_type_id, victim_id))
+        ]
+
+    if cls is KillCount:
+        _, kill_type_id, killer_id = count_key
+
+        return [(killer_id, 'kill:%d' % kill_type_id)] if killer_id else []
+
+    if cls is OreDiscoveryCount:
+        _, material_type_id, player_id = count_key
+
+        return [(player_id, 'ore:%d' % material_type_id)] if player_id else []
+
+    return []
+
+
+def _build(player, server):
+    """
+    Returns the fields of the player's snapshot for the server from the db, or
+    None if they've never played on a survival server.
+    """
+    first_ever_seen, last_seen = db.session.query(
+        func.min(PlayerStats.first_seen),
+        func.max(PlayerStats.last_seen)
+    ).join(Server).filter(
+        PlayerStats.player_id == player.id,
+        Server.type == 'survival'
+    ).first()
+
+    if not first_ever_seen:
+        return None
+
+    fields = {
+        'first_ever_seen': _encode_time(first_ever_seen),
+        'last_seen': _encode_time(last_seen)
+    }
+
+    stats = PlayerStats.query.filter_by(
+        server=server,
+        player=player
+    ).first()
+
+    if stats:
+        fields.update({
+            'has_stats': 1,
+            'time_spent': stats.time_spent or 0,
+            'pvp_logs': '' if stats.pvp_logs is None else stats.pvp_logs,
+            'group': json.dumps({'id': stats.group.id, 'name': stats.group.name}) if stats.group else '',
+            'is_leader': 1 if stats.is_leader else '',
+            'is_moderator': 1 if stats.is_moderator else ''
+        })
+
+    counts = Counter()
+
+    for cls, filters in (
+        (DeathCount, {'victim_id': player.id}),
+        (DeathCount, {'killer_id': player.id}),
+        (KillCount, {'killer_id': player.id}),
+        (OreDiscoveryCount, {'player_id': player.id})
+    ):
+        rows = cls.query.filter_by(server_id=server.id, **filters)
+
+        for count_key, count in _get_counts(cls, rows, server_id=server.id, **filters):
+            for player_id, field in _get_count_fields(cls, count_key):
+                if player_id == player.id:
+                    counts[field] += count
+
+    fields.update(counts)
+
+    return fields
+
+
+def _decode(fields):
+    snapshot = {
+        'first_ever_seen': _decode_time(fields.get('first_ever_seen')),
+        'last_seen': _decode_time(fields.get('last_seen')),
+        'stats': None,
+        'players': {}
+    }
+
+    for name in COUNT_FIELDS.itervalues():
+        snapshot[name] = {}
+
+    if fields.get('has_stats'):
+        snapshot['stats'] = {
+            'time_spent': int(fields.get('time_spent') or 0),
+            'pvp_logs': int(fields['pvp_logs']) if fields.get('pvp_logs') else None,
+            'group': json.loads(fields['group']) if fields.get('group') else None,
+            'is_leader': bool(fields.get('is_leader')),
+            'is_moderator': bool(fields.get('is_moderator'))
+        }
+
+    for field, value in fields.iteritems():
+        prefix, _, rest = field.partition(':')
+
+        if prefix in COUNT_FIELDS:
+            ids = tuple(int(x) for x in rest.split(':'))
+            snapshot[COUNT_FIELDS[prefix]][ids if len(ids) > 1 else ids[0]] = int(value)
+        elif prefix == 'player':
+            snapshot['players'][int(rest)] = json.loads(value)
+
+    return snapshot
+
+
+def _add_opponents(key, snapshot, store):
+    """
+    Adds the display fields of any opponents in the snapshot's pvp counts that it
+    doesn't have yet, which happens when an increment brings in a new opponent.
+    """
+    opponent_ids = set(
+        opponent_id for name in ('pvp_deaths', 'pvp_kills')
+        for _, opponent_id in snapshot[name]
+    ) - set(snapshot['players'])
+
+    if not opponent_ids:
+        return
+
+    fields = {}
+    for player in Player.query.filter(Player.id.in_(opponent_ids)):
+        fields['player:%d' % player.id] = _encode_player(player)
+        snapshot['players'][player.id] = json.loads(fields['player:%d' % player.id])
+
+    if store and fields:
+        try:
+            _hset_if_exists(keys=[key], args=_flatten(fields))
+        except redis.RedisError:
+            rollbar.report_exc_info(level='warning', extra_data={'key': key})
+
+
+def get_snapshot(player, server):
+    """
+    Returns the player's profile snapshot for the server as a dict, building it
+    if it doesn't exist, or None if they've never played on a survival server.
+    """
+    key = _key(player.id, server.id)
+    store = True
+
+    try:
+        fields = redis_client.hgetall(key)
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning', extra_data={'key': key})
+        fields = None
+        store = False
+
+    if not fields:
+        fields = _build(player, server)
+
+        if fields is None:
+            return None
+
+        if store:
+            pipe = redis_client.pipeline()
+            pipe.delete(key)
+            pipe.hmset(key, fields)
+            pipe.expire(key, app.config['PROFILE_SNAPSHOT_TIME'])
+
+            try:
+                pipe.execute()
+            except redis.RedisError:
+                rollbar.report_exc_info(level='warning', extra_data={'key': key})
+                store = False
+
+        fields = {field: str(value) for field, value in fields.iteritems()}
+
+    snapshot = _decode(fields)
+
+    _add_opponents(key, snapshot, store)
+
+    return snapshot
+
+
+def record_increments(cls, counts):
+    """
+    Adds each n in a map of key -> n for a count model to the snapshots of the
+    players involved, for the count models that are part of the snapshot.
+    """
+    updates = defaultdict(Counter)
+
+    for count_key, n in counts.iteritems():
+        for player_id, field in _get_count_fields(cls, count_key):
+            updates[_key(player_id, count_key[0])][field] += n
+
+    if not updates:
+        return
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key, fields in updates.iteritems():
+        _hincrby_if_exists(keys=[key], args=_flatten(fields), client=pipe)
+
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning', extra_data={'table': cls.__tablename__})
+
+
+def record_play(server, online_players, time_spent_map, server_ids):
+    """
+    Sets the time spent and pvp logs of each of the given (player id, player info)
+    pairs that were just seen online on the server in their snapshots for it, and
+    if it's a survival server the last seen time in their snapshots for all of the
+    given server ids, which should be every server.
+    """
+    if not online_players:
+        return
+
+    now = _encode_time(datetime.utcnow())
+
+    if server.type != 'survival':
+        server_ids = []
+
+    pipe = redis_client.pipeline(transaction=False)
+
+    for player_id, player_info in online_players:
+        pvp_logs = player_info.get('pvp_logs')
+
+        _hset_if_exists(keys=[_key(player_id, server.id)], args=[
+            'has_stats', 1,
+            'time_spent', time_spent_map[player_id],
+            'pvp_logs', '' if pvp_logs is None else pvp_logs
+        ], client=pipe)
+
+        for server_id in server_ids:
+            _hset_if_exists(keys=[_key(player_id, server_id)], args=['last_seen', now], client=pipe)
+
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning', extra_data={'server_id': server.id})
+
+
+def invalidate(keys):
+    if not keys:
+        return
+
+    try:
+        redis_client.delete(*list(keys))
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning')
+
+
+def _mark_stale(session, keys):
+    after_commit(session, 'stale-profile-keys', set, invalidate).update(keys)
+
+
+def _get_player_keys(connection, player_id):
+    server_table = Server.__table__
+
+    return [
+        _key(player_id, server_id)
+        for server_id, in connection.execute(select([server_table.c.id]))
+    ]
+
+
+@event.listens_for(PlayerStats, 'after_insert')
+@event.listens_for(PlayerStats, 'after_delete')
+def _stats_added_or_removed(mapper, connection, target):
+    _mark_stale(inspect(target).session, _get_player_keys(connection, target.player_id))
+
+
+@event.listens_for(PlayerStats, 'after_update')
+def _stats_updated(mapper, connection, target):
+    state = inspect(target)
+
+    def changed(attrs):
+        return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+    if changed(SEEN_ATTRS):
+        _mark_stale(state.session, _get_player_keys(connection, target.player_id))
+    elif changed(SERVER_STATS_ATTRS):
+        _mark_stale(state.session, [_key(target.player_id, target.server_id)])
+
+
+@event.listens_for(Group, 'after_update')
+def _group_updated(mapper, connection, target):
+    if not inspect(target).attrs.name.history.has_changes():
+        return
+
+    stats_table = PlayerStats.__table__
+
+    _mark_stale(inspect(target).session, [
+        _key(player_id, server_id)
+        for player_id, server_id in connection.execute(
+            select([stats_table.c.player_id, stats_table.c.server_id]).where(
+                stats_table.c.group_id == target.id
+            )
+        )
+    ])
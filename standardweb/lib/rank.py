@@ -0,0 +1,145 @@
+import redis
+import rollbar
+
+from standardweb import db, redis_client
+from standardweb.models import PlayerStats
+
+
+# how long a built index is trusted before it's rebuilt from the db, which
+# corrects any drift from updates that were indexed but never committed
+INDEX_TIME = 86400
+
+
+def _index_key(server_id):
+    return 'rank-index-%d' % server_id
+
+
+def _built_key(server_id):
+    return 'rank-index-built-%d' % server_id
+
+
+def rebuild_index(server_id):
+    """
+    Builds the sorted set of player id -> time spent for a server from the db
+    and swaps it in place of the existing index.
+    """
+    key = _index_key(server_id)
+    tmp_key = key + '-tmp'
+
+    rows = db.session.query(
+        PlayerStats.player_id,
+        PlayerStats.time_spent
+    ).filter(
+        PlayerStats.server_id == server_id
+    ).all()
+
+    pipe = redis_client.pipeline()
+    pipe.delete(tmp_key)
+
+    for i in xrange(0, len(rows), 1000):
+        args = []
+        for player_id, time_spent in rows[i:i + 1000]:
+            args.extend((time_spent or 0, player_id))
+
+        pipe.zadd(tmp_key, *args)
+
+    if rows:
+        pipe.rename(tmp_key, key)
+    else:
+        pipe.delete(key)
+
+    pipe.set(_built_key(server_id), 1, ex=INDEX_TIME)
+    pipe.execute()
+
+
+def ensure_index(server_id):
+    try:
+        if not redis_client.exists(_built_key(server_id)):
+            rebuild_index(server_id)
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning', extra_data={'server_id': server_id})
+
+
+def update_index(server_id, time_spent_map):
+    """
+    Sets the indexed time spent for each player id in the given map.
+    """
+    if not time_spent_map:
+        return
+
+    args = []
+    for player_id, time_spent in time_spent_map.iteritems():
+        args.extend((time_spent or 0, player_id))
+
+    try:
+        redis_client.zadd(_index_key(server_id), *args)
+    except redis.RedisError:
+        rollbar.report_exc_info(level='warning', extra_data={'server_id': server_id})
+
+
+def get_ranks(server_id, time_spents):
+    """
+    Returns a map of time spent -> rank on the server for each of the given time
+    spent values, or None if the index isn't available.
+    """
+    time_spents = list(set(time_spents))
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.exists(_built_key(server_id))
+
+    for time_spent in time_spents:
+        pipe.zcount(_index_key(server_id), '(%d' % (time_spent or 0), '+inf')
+
+    try:
+        result = pipe.execute()
+    except redis.RedisError:
+        return None
+
+    if not result[0]:
+        return None
+
+    return {time_spent: count + 1 for time_spent, count in zip(time_spents, result[1:])}
+
+
+def get_rank(server_id, time_spent):
+    ranks = get_ranks(server_id, [time_spent])
+
+    return ranks[time_spent] if ranks else None
+
+
+def get_player_rank(server_id, player_id, time_spent):
+    """
+    Returns the rank of a player with the given time spent on the server, counting
+    in the db if the index isn't available.
+    """
+    rank = get_rank(server_id, time_spent)
+
+    if rank is None:
+        # the rank index hasn't been built yet
+        rank = PlayerStats.query.filter(
+            PlayerStats.server_id == server_id,
+            PlayerStats.time_spent > time_spent,
+            PlayerStats.player_id != player_id
+        ).count() + 1
+
+    return rank
+
+
+def get_rank_range(server_id, start, end):
+    """
+    Returns a list of (player id, time spent) for the players ranked `start`
+    through `end` on the server, or None if the index isn't available.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.exists(_built_key(server_id))
+    pipe.zrevrange(_index_key(server_id), start - 1, end - 1, withscores=True, score_cast_func=int)
+
+    try:
+        built, result = pipe.execute()
+    except redis.RedisError:
+        return None
+
+    if not built:
+        return None
+
+    return [(int(player_id), time_spent) for player_id, time_spent in result]
@@ -0,0 +1,160 @@
+from collections import namedtuple
+import threading
+import time
+
+import redis
+from sqlalchemy import select
+
+from standardweb import app, db, redis_client
+from standardweb.models import DeathType, KillType, MaterialType
+
+
+TypeEntry = namedtuple('TypeEntry', ['id', 'type', 'displayname'])
+
+
+class TypeRegistry(object):
+    """
+    Process-local copy of a small lookup table of types (DeathType, KillType,
+    MaterialType) that maps names to ids without going to the db.
+
+    The whole table is loaded on first use and reloaded whenever the shared version
+    number in redis has changed, which every process bumps after adding a type. The
+    version is checked at most every TYPE_REGISTRY_CHECK_INTERVAL seconds, so other
+    processes see a new type's displayname within that time, but a name that isn't
+    known locally is always looked up in the db before it's created.
+
+    Names are looked up case-insensitively, the same way the type column's
+    collation compares them.
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked = 0
+        self.by_name = None
+        self.by_id = None
+
+    @property
+    def _version_key(self):
+        return 'type-registry-version-%s' % self.cls.__tablename__
+
+    def _get_version(self):
+        try:
+            return redis_client.get(self._version_key)
+        except redis.RedisError:
+            # keep what's loaded until redis is back, names not loaded yet will
+            # still be found through the db
+            return self.version
+
+    def _load(self, version):
+        entries = [
+            TypeEntry(row.id, row.type, row.displayname)
+            for row in db.session.query(self.cls.id, self.cls.type, self.cls.displayname)
+        ]
+
+        self.by_name = {entry.type.lower(): entry for entry in entries}
+        self.by_id = {entry.id: entry for entry in entries}
+        self.version = version
+
+    def _refresh(self):
+        now = time.time()
+
+        if self.by_name is not None and now - self.checked < app.config['TYPE_REGISTRY_CHECK_INTERVAL']:
+            return
+
+        with self.lock:
+            version = self._get_version()
+
+            if self.by_name is None or version != self.version:
+                self._load(version)
+
+            self.checked = now
+
+    def _create(self, name):
+        table = self.cls.__table__
+
+        # insert in a transaction of its own so the type is visible to other
+        # processes as soon as they reload, and let the unique key on the type
+        # column settle any race to insert the same name
+        with db.engine.begin() as connection:
+            inserted = connection.execute(table.insert().prefix_with('IGNORE'), type=name).rowcount
+
+            row = connection.execute(
+                select([table.c.id, table.c.type, table.c.displayname]).where(table.c.type == name)
+            ).first()
+
+        # only make every process reload if there's actually a new type
+        if inserted:
+            try:
+                redis_client.incr(self._version_key)
+            except redis.RedisError:
+                pass
+
+        return TypeEntry(row.id, row.type, row.displayname)
+
+    def get(self, name):
+        if not name:
+            return None
+
+        self._refresh()
+
+        return self.by_name.get(name.lower())
+
+    def get_by_id(self, id):
+        self._refresh()
+
+        entry = self.by_id.get(id)
+        if not entry:
+            # may have just been added by another process
+            self.checked = 0
+            self._refresh()
+            entry = self.by_id.get(id)
+
+        return entry
+
+    def all(self):
+        self._refresh()
+
+        return self.by_name.values()
+
+    def get_or_create(self, name):
+        if not name:
+            raise ValueError('Type names can\'t be empty')
+
+        entry = self.get(name)
+
+        if not entry:
+            with self.lock:
+                entry = self._create(name)
+
+                # copy rather than mutate so readers in other threads never see
+                # the maps change under them, keeping the entry under the name as
+                # requested too in case the collation matched it some other way
+                by_name = dict(self.by_name)
+                by_name[entry.type.lower()] = entry
+                by_name[name.lower()] = entry
+                by_id = dict(self.by_id)
+                by_id[entry.id] = entry
+
+                self.by_name, self.by_id = by_name, by_id
+
+        return entry
+
+    def get_ids(self, names):
+        """
+        Returns a map of name -> id for the given type names, creating any that
+        don't exist yet.
+        """
+        return {name: self.get_or_create(name).id for name in set(names)}
+
+
+death_types = TypeRegistry(DeathType)
+kill_types = TypeRegistry(KillType)
+material_types = TypeRegistry(MaterialType)
+
+
+def get_ores():
+    """
+    Returns the known ore material types in the order of MaterialType.ORES.
+    """
+    return [entry for entry in (material_types.get(type) for type in MaterialType.ORES) if entry]
@@ -0,0 +1,235 @@
+"""
+Trigram index over player names for substring search.
+
+Every player's lowercased username, nickname and past usernames are stored in
+PlayerSearchName, and each name's trigrams in PlayerSearchTrigram. A query of
+three or more characters finds the names that have all of its trigrams through
+the primary key, and the candidates are then checked against the query itself,
+so the trigrams only have to narrow the search down.
+
+A shorter query would match most of the trigrams, so it only finds the names
+starting with it instead, reading them off the index on the name in order.
+
+The index is updated in the same flush as a player being created or renamed, and
+filled for existing players with rebuild_index.
+"""
+from sqlalchemy import case, distinct, event, func, inspect, select
+from sqlalchemy.orm import joinedload
+
+from standardweb import db
+from standardweb.models import AuditLog, Player, PlayerSearchName, PlayerSearchTrigram
+
+
+# shorter queries only match names starting with them
+MIN_SUBSTRING_LENGTH = 3
+
+# players can have several names starting with the same prefix, so more names
+# than players are read for a page of prefix matches
+PREFIX_NAMES_PER_PLAYER = 4
+
+
+def _normalize(name):
+    return name.strip().lower() if name else None
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def get_trigrams(name):
+    return set(name[i:i + 3] for i in xrange(len(name) - 2))
+
+
+def _set_names(connection, player_id, current_names, past_names=()):
+    """
+    Replaces the player's current names in the index with the given ones and adds
+    any of the given past names it doesn't have yet.
+    """
+    name_table = PlayerSearchName.__table__
+    trigram_table = PlayerSearchTrigram.__table__
+
+    existing = {
+        (row.name, row.kind): row.id for row in connection.execute(
+            select([name_table.c.id, name_table.c.name, name_table.c.kind]).where(
+                name_table.c.player_id == player_id
+            )
+        )
+    }
+
+    names = set((name, PlayerSearchName.CURRENT) for name in map(_normalize, current_names) if name)
+    names |= set((name, PlayerSearchName.PAST) for name in map(_normalize, past_names) if name)
+
+    stale_ids = [
+        name_id for (name, kind), name_id in existing.iteritems()
+        if kind == PlayerSearchName.CURRENT and (name, kind) not in names
+    ]
+
+    if stale_ids:
+        connection.execute(trigram_table.delete().where(trigram_table.c.name_id.in_(stale_ids)))
+        connection.execute(name_table.delete().where(name_table.c.id.in_(stale_ids)))
+
+    for name, kind in names - set(existing):
+        result = connection.execute(name_table.insert(), player_id=player_id, name=name, kind=kind)
+        name_id = result.inserted_primary_key[0]
+
+        connection.execute(trigram_table.insert(), [
+            {'trigram': trigram, 'name_id': name_id}
+            for trigram in get_trigrams(name)
+        ])
+
+
+def search_players(query, page_size=20, page=0):
+    """
+    Returns a page of the players with a username, nickname or past username
+    containing the query, exact matches first, then names starting with it, then
+    the rest, each in order of display name.
+
+    Queries shorter than MIN_SUBSTRING_LENGTH only match names starting with them,
+    in order of the matching name.
+    """
+    query = _normalize(query)
+
+    if not query:
+        return []
+
+    escaped = _escape_like(query)
+
+    if len(query) < MIN_SUBSTRING_LENGTH:
+        return _search_prefix(escaped, page_size, page)
+
+    trigrams = get_trigrams(query)
+
+    candidates = db.session.query(
+        PlayerSearchTrigram.name_id
+    ).filter(
+        PlayerSearchTrigram.trigram.in_(trigrams)
+    ).group_by(
+        PlayerSearchTrigram.name_id
+    ).having(
+        func.count(distinct(PlayerSearchTrigram.trigram)) == len(trigrams)
+    ).subquery()
+
+    match_rank = func.min(case([
+        (PlayerSearchName.name == query, 0),
+        (PlayerSearchName.name.like(escaped + '%', escape='\\'), 1)
+    ], else_=2))
+
+    matches = db.session.query(
+        PlayerSearchName.player_id,
+        match_rank.label('match_rank')
+    ).join(
+        candidates, candidates.c.name_id == PlayerSearchName.id
+    ).filter(
+        PlayerSearchName.name.like('%' + escaped + '%', escape='\\')
+    ).group_by(
+        PlayerSearchName.player_id
+    ).subquery()
+
+    results = Player.query.join(
+        matches, matches.c.player_id == Player.id
+    ).options(
+        joinedload(Player.user)
+    ).order_by(
+        matches.c.match_rank,
+        func.ifnull(Player.nickname, Player.username)
+    ).limit(
+        page_size
+    ).offset(
+        page * page_size
+    )
+
+    return list(results)
+
+
+def _search_prefix(escaped, page_size, page):
+    # an exact match sorts before every other name starting with it
+    rows = db.session.query(
+        PlayerSearchName.player_id
+    ).filter(
+        PlayerSearchName.name.like(escaped + '%', escape='\\')
+    ).order_by(
+        PlayerSearchName.name
+    ).limit(
+        (page + 1) * page_size * PREFIX_NAMES_PER_PLAYER
+    )
+
+    player_ids = []
+    for player_id, in rows:
+        if player_id not in player_ids:
+            player_ids.append(player_id)
+
+    player_ids = player_ids[page * page_size:(page + 1) * page_size]
+
+    if not player_ids:
+        return []
+
+    players = {
+        player.id: player for player in Player.query.filter(
+            Player.id.in_(player_ids)
+        ).options(
+            joinedload(Player.user)
+        )
+    }
+
+    return [players[player_id] for player_id in player_ids if player_id in players]
+
+
+def rebuild_index(batch_size=1000):
+    """
+    Indexes the names of every player, including their past usernames from the
+    rename audit logs. Returns the number of players indexed.
+    """
+    past_names = {}
+    for player_id, data in db.session.query(
+        AuditLog.player_id,
+        AuditLog.data
+    ).filter(
+        AuditLog.type == AuditLog.PLAYER_RENAME
+    ):
+        past_names.setdefault(player_id, set()).add(data.get('old_name'))
+
+    indexed = 0
+    last_id = 0
+
+    while True:
+        players = db.session.query(
+            Player.id,
+            Player.username,
+            Player.nickname
+        ).filter(
+            Player.id > last_id
+        ).order_by(
+            Player.id
+        ).limit(batch_size).all()
+
+        if not players:
+            break
+
+        connection = db.session.connection()
+
+        for player_id, username, nickname in players:
+            _set_names(connection, player_id, [username, nickname], past_names.get(player_id, ()))
+
+        db.session.commit()
+
+        indexed += len(players)
+        last_id = players[-1].id
+
+    return indexed
+
+
+@event.listens_for(Player, 'after_insert')
+def _player_inserted(mapper, connection, target):
+    _set_names(connection, target.id, [target.username, target.nickname])
+
+
+@event.listens_for(Player, 'after_update')
+def _player_updated(mapper, connection, target):
+    state = inspect(target)
+
+    username_history = state.attrs.username.history
+
+    if not username_history.has_changes() and not state.attrs.nickname.history.has_changes():
+        return
+
+    _set_names(connection, target.id, [target.username, target.nickname], username_history.deleted)
@@ -1,28 +1,43 @@
 import calendar
 from datetime import datetime
 from datetime import timedelta
-import math
-import time
 
-from sqlalchemy import func
 from sqlalchemy.orm import joinedload
-from sqlalchemy.sql.expression import label
-from standardweb import db
 
+from standardweb import cache as cache_backend
 from standardweb.lib import api
 from standardweb.lib import cache
 from standardweb.lib import helpers as h
-from standardweb.models import PlayerStats, Player, ServerStatus
+from standardweb.lib import rank
+from standardweb.models import PlayerStats, Player, ServerStatusRollup
+
+
+# minimum number of points a player graph should have before falling back to a finer resolution
+GRAPH_MIN_POINTS = 300
 
 
 @cache.CachedResult('ranking')
 def get_ranking_data(server):
     retval = []
 
-    player_stats = PlayerStats.query.filter_by(server=server) \
-        .order_by(PlayerStats.time_spent.desc()) \
-        .limit(40) \
-        .options(joinedload('player')) \
+    ranked = rank.get_rank_range(server.id, 1, 40)
+
+    if ranked is not None:
+        player_ids = [player_id for player_id, _ in ranked]
+
+        stats_map = {
+            stats.player_id: stats for stats in PlayerStats.query.filter(
+                PlayerStats.server == server,
+                PlayerStats.player_id.in_(player_ids)
+            ).options(joinedload('player'))
+        } if player_ids else {}
+
+        player_stats = [stats_map[player_id] for player_id in player_ids if player_id in stats_map]
+    else:
+        player_stats = PlayerStats.query.filter_by(server=server) \
+            .order_by(PlayerStats.time_spent.desc()) \
+            .limit(40) \
+            .options(joinedload('player'))
 
     for stats in player_stats:
         online_now = datetime.utcnow() - timedelta(minutes=1) < stats.last_seen
@@ -32,8 +47,32 @@ def get_ranking_data(server):
     return retval
 
 
-@cache.CachedResult('player-list', time=5)
+def _player_list_snapshot_key(server):
+    return 'player-list-snapshot-%d' % server.id
+
+
 def get_player_list_data(server):
+    """
+    Returns the live player list for the server, or the last one seen marked
+    as stale if the server isn't responding.
+    """
+    if not api.get_circuit_breaker(server).is_open:
+        data = _get_player_list_data(server)
+
+        if data:
+            cache_backend.set(_player_list_snapshot_key(server), data, 86400)
+            return data
+
+    data = cache_backend.get(_player_list_snapshot_key(server))
+
+    if data:
+        data = dict(data, stale=True)
+
+    return data
+
+
+@cache.CachedResult('player-list', time=5)
+def _get_player_list_data(server):
     server_status = api.get_server_status(server, minimal=True)
 
     if not server_status:
@@ -69,32 +108,46 @@ def get_player_list_data(server):
     }
 
 
+def _get_graph_resolution(start_date, end_date, granularity):
+    """
+    Returns the coarsest rollup resolution no finer than the requested granularity
+    that still gives enough points to draw the given range.
+    """
+    seconds = (end_date - start_date).total_seconds()
+
+    resolutions = [
+        resolution for resolution in ServerStatusRollup.RESOLUTIONS
+        if resolution >= granularity * 60
+    ] or [max(ServerStatusRollup.RESOLUTIONS)]
+
+    for resolution in sorted(resolutions, reverse=True):
+        if seconds / resolution >= GRAPH_MIN_POINTS:
+            return resolution
+
+    return min(resolutions)
+
+
 @cache.CachedResult('player-graph', time=240)
 def get_player_graph_data(server, granularity=15, start_date=None, end_date=None):
     end_date = end_date or datetime.utcnow()
     start_date = start_date or end_date - timedelta(days=7)
 
-    result = db.session.query(
-        label(
-            'timestamp_group',
-            func.round(
-                (func.unix_timestamp(ServerStatus.timestamp) - time.timezone) / (granularity * 60)
-            ),
-        ),
-        func.avg(ServerStatus.player_count)
-    ).filter(
-        ServerStatus.server == server,
-        ServerStatus.timestamp >= start_date,
-        ServerStatus.timestamp <= end_date
-    ).group_by('timestamp_group').order_by(
-        ServerStatus.timestamp
-    ).all()
+    resolution = _get_graph_resolution(start_date, end_date, granularity)
+
+    result = ServerStatusRollup.query.filter(
+        ServerStatusRollup.server == server,
+        ServerStatusRollup.resolution == resolution,
+        ServerStatusRollup.timestamp >= start_date,
+        ServerStatusRollup.timestamp <= end_date
+    ).order_by(
+        ServerStatusRollup.timestamp
+    )
 
     points = []
-    for chunk, count in result:
+    for rollup in result:
         points.append({
-            'time': int(chunk * granularity * 60 * 1000),
-            'player_count': int(count)
+            'time': int(calendar.timegm(rollup.timestamp.timetuple()) * 1000),
+            'player_count': int(rollup.player_count_avg)
         })
 
     return {
@@ -0,0 +1,41 @@
+"""
+Deferring work on changes seen in mapper events until they're committed.
+
+A change seen during a flush isn't visible to anyone else until its transaction
+commits, and may never be if it rolls back, so anything that tells other
+processes about it (dropping a cached copy, publishing it) has to wait for the
+commit. Otherwise they could load the old values again right after being told,
+or act on a change that never happened.
+
+Changes are gathered per session under a name and handed to the callback the
+name was registered with once the session commits, or dropped if it rolls back.
+"""
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+
+def after_commit(session, name, factory, callback):
+    """
+    Returns the collection the session is gathering changes under the given name
+    in, created with factory() if it's the first change, to be passed to callback
+    once the session commits.
+
+    after_commit(session, 'stale-keys', set, invalidate).update(keys)
+    """
+    pending = session.info.setdefault('after_commit', {})
+
+    if name not in pending:
+        pending[name] = (factory(), callback)
+
+    return pending[name][0]
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _session_committed(session):
+    for changes, callback in session.info.pop('after_commit', {}).values():
+        callback(changes)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def _session_rolled_back(session):
+    session.info.pop('after_commit', None)
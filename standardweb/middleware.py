@@ -13,6 +13,7 @@ from standardweb.lib import helpers as h
 from standardweb.lib import player as libplayer
 from standardweb.models import User, ForumBan
 from standardweb.tasks.access_log import log as log_task
+from standardweb.template_filters import apply_face_sprites
 from sqlalchemy.orm import joinedload
 
 
@@ -38,7 +39,7 @@ def user_session():
 
 
 def _is_not_static_request():
-    return request.endpoint and 'static' not in request.endpoint and request.endpoint != 'face'
+    return request.endpoint and 'static' not in request.endpoint and request.endpoint not in ('face', 'face_sprite')
 
 
 @app.before_request
@@ -88,7 +89,7 @@ def first_login():
     first_login = False
 
     if request.endpoint and 'static' not in request.endpoint \
-            and request.endpoint != 'face' and session.get('user_session_key'):
+            and request.endpoint not in ('face', 'face_sprite') and session.get('user_session_key'):
         if 'first_login' in session:
             first_login = session.pop('first_login')
 
@@ -114,6 +115,18 @@ def ensure_valid_user():
             libplayer.ban_player(player, source='invalid_user', commit=True)
 
 
+@app.after_request
+def face_sprites(response):
+    if (
+        g.get('face_thumbs') and
+        response.mimetype == 'text/html' and
+        not response.direct_passthrough
+    ):
+        response.set_data(apply_face_sprites(response.get_data(as_text=True), g.face_thumbs))
+
+    return response
+
+
 @app.after_request
 def access_log(response):
     if not hasattr(g, '_start_time'):
@@ -123,7 +136,7 @@ def access_log(response):
     route = request.url_rule.rule if request.url_rule else None
 
     if endpoint and (
-        'static' in endpoint or endpoint == 'face'
+        'static' in endpoint or endpoint in ('face', 'face_sprite')
     ):
         return response
 
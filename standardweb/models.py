@@ -1,4 +1,5 @@
 import binascii
+import calendar
 from datetime import datetime, timedelta
 import hashlib
 from operator import attrgetter
@@ -12,6 +13,7 @@ import uuid
 
 from flask import json
 from flask import url_for
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext import mutable
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import backref
@@ -45,6 +47,30 @@ def _get_or_create(cls, **kwargs):
             return instance, False
 
 
+def _upsert_counts(cls, counts, session=None):
+    """
+    Adds each n in a map of key column values -> n to the count of the matching row
+    with a single INSERT ... ON DUPLICATE KEY UPDATE, for count tables with a primary
+    or unique key on their key columns, in the given session or else the current one.
+    """
+    if not counts:
+        return
+
+    session = session or db.session
+
+    values = []
+    for key, n in counts.iteritems():
+        row = dict(zip(cls.KEY_COLUMNS, key))
+        row['count'] = n
+        values.append(row)
+
+    table = cls.__table__
+    stmt = mysql_insert(table).values(values)
+    stmt = stmt.on_duplicate_key_update(count=table.c.count + stmt.inserted.count)
+
+    session.execute(stmt)
+
+
 class JsonEncodedDict(db.TypeDecorator):
     impl = db.String
 
@@ -339,6 +365,8 @@ class Player(db.Model, Base):
     nickname = db.Column(db.String(30))
     nickname_ansi = db.Column(db.String(256))
     banned = db.Column(db.Boolean, default=False)
+    # sum of time_spent across survival servers, kept up to date wherever it changes
+    total_time = db.Column(db.Integer, default=0, nullable=False)
 
     def __str__(self):
         return self.displayname
@@ -425,20 +453,24 @@ class PlayerStats(db.Model, Base):
 
     @property
     def rank(self):
-        return len(
-            PlayerStats.query.with_entities(
-                PlayerStats.id
-            ).filter(
-                PlayerStats.server_id == self.server_id,
-                PlayerStats.time_spent > self.time_spent,
-                PlayerStats.player_id != self.player_id
-            ).all()
-        ) + 1
+        from standardweb.lib import rank as librank
+
+        return librank.get_player_rank(self.server_id, self.player_id, self.time_spent)
 
     def adjust_time_spent(self, adjustment, reason=None, commit=True):
+        from standardweb.lib import rank as librank
+
         self.time_spent += adjustment
         self.save(commit=False)
 
+        if self.server.type == 'survival':
+            # add to the total in the db rather than to the loaded value so an
+            # increment from the minute query in the meantime isn't overwritten
+            self.player.total_time = Player.total_time + adjustment
+            self.player.save(commit=False)
+
+        librank.update_index(self.server_id, {self.player_id: self.time_spent})
+
         AuditLog.create(
             AuditLog.PLAYER_TIME_ADJUSTMENT,
             server_id=self.server_id,
@@ -449,6 +481,30 @@ class PlayerStats(db.Model, Base):
         )
 
 
+class PlayerSearchName(db.Model, Base):
+    __tablename__ = 'playersearch_name'
+
+    CURRENT = 'current'
+    PAST = 'past'
+
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), index=True, nullable=False)
+    # lowercased username or nickname
+    name = db.Column(db.String(30), index=True, nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+
+    player = db.relationship('Player')
+
+
+class PlayerSearchTrigram(db.Model, Base):
+    __tablename__ = 'playersearch_trigram'
+
+    trigram = db.Column(db.String(3), primary_key=True)
+    name_id = db.Column(db.Integer, db.ForeignKey('playersearch_name.id'), primary_key=True)
+
+    name = db.relationship('PlayerSearchName')
+
+
 class Server(db.Model, Base):
     __tablename__ = 'server'
 
@@ -478,6 +534,84 @@ class ServerStatus(db.Model, Base):
     server = db.relationship('Server')
 
 
+class ServerStatusRollup(db.Model, Base):
+    __tablename__ = 'serverstatus_rollup'
+
+    server_id = db.Column(db.Integer, db.ForeignKey('server.id'), primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, primary_key=True)
+    sample_count = db.Column(db.Integer, default=0)
+    player_count_sum = db.Column(db.Integer, default=0)
+    player_count_min = db.Column(db.Integer, default=0)
+    player_count_max = db.Column(db.Integer, default=0)
+    cpu_load_sum = db.Column(db.Float, default=0)
+    cpu_load_min = db.Column(db.Float, default=0)
+    cpu_load_max = db.Column(db.Float, default=0)
+    tps_sum = db.Column(db.Float, default=0)
+    tps_min = db.Column(db.Float, default=0)
+    tps_max = db.Column(db.Float, default=0)
+
+    server = db.relationship('Server')
+
+    FIFTEEN_MINUTES = 900
+    HOUR = 3600
+    DAY = 86400
+
+    RESOLUTIONS = (FIFTEEN_MINUTES, HOUR, DAY)
+
+    @property
+    def player_count_avg(self):
+        return float(self.player_count_sum) / self.sample_count if self.sample_count else 0
+
+    @property
+    def cpu_load_avg(self):
+        return self.cpu_load_sum / self.sample_count if self.sample_count else 0
+
+    @property
+    def tps_avg(self):
+        return self.tps_sum / self.sample_count if self.sample_count else 0
+
+    @classmethod
+    def record(cls, server_status):
+        """
+        Folds a single ServerStatus sample into the rollup bucket of every resolution.
+        """
+        timestamp = calendar.timegm(server_status.timestamp.timetuple())
+
+        values = [{
+            'server_id': server_status.server.id,
+            'resolution': resolution,
+            'timestamp': datetime.utcfromtimestamp(timestamp // resolution * resolution),
+            'sample_count': 1,
+            'player_count_sum': server_status.player_count,
+            'player_count_min': server_status.player_count,
+            'player_count_max': server_status.player_count,
+            'cpu_load_sum': server_status.cpu_load,
+            'cpu_load_min': server_status.cpu_load,
+            'cpu_load_max': server_status.cpu_load,
+            'tps_sum': server_status.tps,
+            'tps_min': server_status.tps,
+            'tps_max': server_status.tps
+        } for resolution in cls.RESOLUTIONS]
+
+        table = cls.__table__
+        stmt = mysql_insert(table).values(values)
+        stmt = stmt.on_duplicate_key_update(
+            sample_count=table.c.sample_count + stmt.inserted.sample_count,
+            player_count_sum=table.c.player_count_sum + stmt.inserted.player_count_sum,
+            player_count_min=func.least(table.c.player_count_min, stmt.inserted.player_count_min),
+            player_count_max=func.greatest(table.c.player_count_max, stmt.inserted.player_count_max),
+            cpu_load_sum=table.c.cpu_load_sum + stmt.inserted.cpu_load_sum,
+            cpu_load_min=func.least(table.c.cpu_load_min, stmt.inserted.cpu_load_min),
+            cpu_load_max=func.greatest(table.c.cpu_load_max, stmt.inserted.cpu_load_max),
+            tps_sum=table.c.tps_sum + stmt.inserted.tps_sum,
+            tps_min=func.least(table.c.tps_min, stmt.inserted.tps_min),
+            tps_max=func.greatest(table.c.tps_max, stmt.inserted.tps_max)
+        )
+
+        db.session.execute(stmt)
+
+
 class MojangStatus(db.Model, Base):
     __tablename__ = 'mojangstatus'
 
@@ -494,7 +628,7 @@ class DeathType(db.Model, Base):
     __tablename__ = 'deathtype'
 
     id = db.Column(db.Integer, primary_key=True)
-    type = db.Column(db.String(100))
+    type = db.Column(db.String(100), unique=True)
     displayname = db.Column(db.String(100))
 
 
@@ -502,7 +636,7 @@ class KillType(db.Model, Base):
     __tablename__ = 'killtype'
 
     id = db.Column(db.Integer, primary_key=True)
-    type = db.Column(db.String(100))
+    type = db.Column(db.String(100), unique=True)
     displayname = db.Column(db.String(100))
 
 
@@ -539,6 +673,11 @@ class KillEvent(db.Model, Base):
 class DeathCount(db.Model, Base):
     __tablename__ = 'deathcount'
 
+    # the unique key is on a generated ifnull(killer_id, 0) column rather than
+    # killer_id itself since MySQL doesn't treat NULLs as duplicates in a unique key,
+    # see migrations/count_unique_keys.sql
+    KEY_COLUMNS = ('server_id', 'death_type_id', 'victim_id', 'killer_id')
+
     id = db.Column(db.Integer, primary_key=True)
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'))
     death_type_id = db.Column(db.Integer, db.ForeignKey('deathtype.id'))
@@ -552,35 +691,61 @@ class DeathCount(db.Model, Base):
     victim = db.relationship('Player', foreign_keys='DeathCount.victim_id')
 
     @classmethod
-    def increment(cls, server, death_type, victim, killer, commit=True):
-        death_count = cls.factory(server=server,
-                                  death_type=death_type,
-                                  victim=victim,
-                                  killer=killer)
-        death_count.count = (death_count.count or 0) + 1
-        death_count.save(commit=commit)
+    def increment_many(cls, counts, session=None):
+        """
+        Takes a map of (server id, death type id, victim id, killer id) -> n.
+        """
+        _upsert_counts(cls, counts, session=session)
 
 
 class KillCount(db.Model, Base):
     __tablename__ = 'killcount'
 
+    KEY_COLUMNS = ('server_id', 'kill_type_id', 'killer_id')
+
     id = db.Column(db.Integer, primary_key=True)
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'))
     kill_type_id = db.Column(db.Integer, db.ForeignKey('killtype.id'))
     killer_id = db.Column(db.Integer, db.ForeignKey('player.id'))
     count = db.Column(db.Integer, default=0)
 
+    __table_args__ = (
+        db.UniqueConstraint(*KEY_COLUMNS),
+    )
+
     server = db.relationship('Server')
     kill_type = db.relationship('KillType')
     killer = db.relationship('Player')
 
     @classmethod
-    def increment(cls, server, kill_type, killer, commit=True):
-        kill_count = cls.factory(server=server,
-                                 kill_type=kill_type,
-                                 killer=killer)
-        kill_count.count = (kill_count.count or 0) + 1
-        kill_count.save(commit=commit)
+    def increment_many(cls, counts, session=None):
+        """
+        Takes a map of (server id, kill type id, killer id) -> n.
+        """
+        _upsert_counts(cls, counts, session=session)
+
+
+class KillCountDaily(db.Model, Base):
+    __tablename__ = 'killcount_daily'
+
+    KEY_COLUMNS = ('server_id', 'kill_type_id', 'player_id', 'date')
+
+    server_id = db.Column(db.Integer, db.ForeignKey('server.id'), primary_key=True)
+    kill_type_id = db.Column(db.Integer, db.ForeignKey('killtype.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), primary_key=True)
+    count = db.Column(db.Integer, default=0)
+
+    server = db.relationship('Server')
+    kill_type = db.relationship('KillType')
+    player = db.relationship('Player')
+
+    @classmethod
+    def increment_many(cls, counts, session=None):
+        """
+        Takes a map of (server id, kill type id, player id, date) -> n.
+        """
+        _upsert_counts(cls, counts, session=session)
 
 
 class MaterialType(db.Model, Base):
@@ -594,12 +759,6 @@ class MaterialType(db.Model, Base):
         'DIAMOND_ORE', 'EMERALD_ORE', 'LAPIS_ORE', 'REDSTONE_ORE', 'NETHER_QUARTZ_ORE', 'COAL_ORE'
     )
 
-    @classmethod
-    def get_ores(cls):
-        return cls.query.filter(
-            cls.type.in_(cls.ORES)
-        ).order_by(func.field(cls.type, *cls.ORES))
-
 
 class OreDiscoveryEvent(db.Model, Base):
     __tablename__ = 'orediscoveryevent'
@@ -621,25 +780,84 @@ class OreDiscoveryEvent(db.Model, Base):
 class OreDiscoveryCount(db.Model, Base):
     __tablename__ = 'orediscoverycount'
 
+    KEY_COLUMNS = ('server_id', 'material_type_id', 'player_id')
+
     id = db.Column(db.Integer, primary_key=True)
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'))
     player_id = db.Column(db.Integer, db.ForeignKey('player.id'))
     material_type_id = db.Column(db.Integer, db.ForeignKey('materialtype.id'))
     count = db.Column(db.Integer, default=0)
 
+    __table_args__ = (
+        db.UniqueConstraint(*KEY_COLUMNS),
+    )
+
     server = db.relationship('Server')
     player = db.relationship('Player')
     material_type = db.relationship('MaterialType')
 
     @classmethod
-    def increment(cls, server, material_type, player, commit=True):
-        ore_count = cls.factory(
-            server=server,
-            material_type=material_type,
-            player=player
-        )
-        ore_count.count = (ore_count.count or 0) + 1
-        ore_count.save(commit=commit)
+    def increment_many(cls, counts, session=None):
+        """
+        Takes a map of (server id, material type id, player id) -> n.
+        """
+        _upsert_counts(cls, counts, session=session)
+
+
+class OreDiscoveryCountDaily(db.Model, Base):
+    __tablename__ = 'orediscoverycount_daily'
+
+    KEY_COLUMNS = ('server_id', 'material_type_id', 'player_id', 'date')
+
+    server_id = db.Column(db.Integer, db.ForeignKey('server.id'), primary_key=True)
+    material_type_id = db.Column(db.Integer, db.ForeignKey('materialtype.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), primary_key=True)
+    count = db.Column(db.Integer, default=0)
+
+    server = db.relationship('Server')
+    material_type = db.relationship('MaterialType')
+    player = db.relationship('Player')
+
+    @classmethod
+    def increment_many(cls, counts, session=None):
+        """
+        Takes a map of (server id, material type id, player id, date) -> n.
+        """
+        _upsert_counts(cls, counts, session=session)
+
+
+class OreDiscoveryChunk(db.Model, Base):
+    __tablename__ = 'orediscovery_chunk'
+
+    KEY_COLUMNS = ('server_id', 'material_type_id', 'date', 'chunk_x', 'chunk_z', 'player_id')
+
+    server_id = db.Column(db.Integer, db.ForeignKey('server.id'), primary_key=True)
+    material_type_id = db.Column(db.Integer, db.ForeignKey('materialtype.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    chunk_x = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    chunk_z = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), primary_key=True)
+    count = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.Index('server_id_player_id_date', 'server_id', 'player_id', 'date'),
+    )
+
+    server = db.relationship('Server')
+    material_type = db.relationship('MaterialType')
+    player = db.relationship('Player')
+
+    @staticmethod
+    def get_chunk(x, z):
+        return x >> 4, z >> 4
+
+    @classmethod
+    def increment_many(cls, counts, session=None):
+        """
+        Takes a map of (server id, material type id, date, chunk x, chunk z, player id) -> n.
+        """
+        _upsert_counts(cls, counts, session=session)
 
 
 class IPTracking(db.Model, Base):
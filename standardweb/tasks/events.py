@@ -0,0 +1,13 @@
+from standardweb import app, celery
+
+
+@celery.task(bind=True, max_retries=10)
+def ingest_events_task(self):
+    from standardweb.lib.events import ingest_queued_events
+
+    if ingest_queued_events() is None:
+        # the ingest holding the lease may have already found the queue empty
+        # before the events this was scheduled for were queued, so try again
+        # once it's done rather than leaving them until more events come in,
+        # up to a limit so a lease that's never released can't keep it retrying
+        raise self.retry(countdown=app.config['EVENT_INGEST_WINDOW'])
@@ -0,0 +1,14 @@
+import requests
+
+from standardweb import celery
+from standardweb.lib import exceptions
+
+
+@celery.task(bind=True, max_retries=5, default_retry_delay=60)
+def refresh_faces_task(self, uuid):
+    from standardweb.lib.faces import refresh_faces
+
+    try:
+        refresh_faces(uuid)
+    except (exceptions.RemoteRateLimitException, requests.RequestException) as e:
+        raise self.retry(exc=e)
@@ -5,46 +5,64 @@ from standardweb import celery
 from standardweb.models import Player, PlayerStats, Server, User
 
 
-@celery.task()
-def api_forum_post_task(username, uuid, forum_name, topic_name, path, is_new_topic):
-    from standardweb.lib.api import api_call
+def _retry_failed_servers(task, statuses, args):
+    from standardweb.lib.api import BROADCAST_NOT_SENT
+
+    # a call that failed or timed out may still have been acted on by the server,
+    # so only send again the ones that certainly never got there
+    failed_server_ids = [
+        server_id for server_id, status in statuses.iteritems()
+        if status == BROADCAST_NOT_SENT
+    ]
+
+    if failed_server_ids:
+        raise task.retry(args=args, kwargs={
+            'server_ids': failed_server_ids
+        })
+
+
+@celery.task(bind=True, max_retries=3, default_retry_delay=30)
+def api_forum_post_task(self, username, uuid, forum_name, topic_name, path, is_new_topic, server_ids=None):
+    from standardweb.lib.api import broadcast
 
     base_url = url_for('index', _external=True).rstrip('/')
 
-    for server in Server.query.filter_by(online=True):
-        data = {
-            'forum_name': forum_name,
-            'topic_name': topic_name,
-            'path': '%s%s' % (base_url, path),
-            'is_new_topic': is_new_topic,
-            'username': username
-        }
+    data = {
+        'forum_name': forum_name,
+        'topic_name': topic_name,
+        'path': '%s%s' % (base_url, path),
+        'is_new_topic': is_new_topic,
+        'username': username
+    }
 
-        if uuid:
-            data['uuid'] = uuid
+    if uuid:
+        data['uuid'] = uuid
 
-        api_call(server, 'forum_post', data=data)
+    statuses = broadcast('forum_post', data=data, server_ids=server_ids)
 
+    _retry_failed_servers(self, statuses, (username, uuid, forum_name, topic_name, path, is_new_topic))
 
-@celery.task()
-def api_player_action_task(uuid, action, reason, ip, with_ip):
-    from standardweb.lib.api import api_call
 
-    for server in Server.query.filter_by(online=True):
-        data = {
-            'uuid': uuid,
-            'action': action,
-            'reason': reason,
-            'ip': ip,
-            'with_ip': with_ip
-        }
+@celery.task(bind=True, max_retries=3, default_retry_delay=30)
+def api_player_action_task(self, uuid, action, reason, ip, with_ip, server_ids=None):
+    from standardweb.lib.api import broadcast
+
+    data = {
+        'uuid': uuid,
+        'action': action,
+        'reason': reason,
+        'ip': ip,
+        'with_ip': with_ip
+    }
 
-        api_call(server, 'player_action', data=data)
+    statuses = broadcast('player_action', data=data, server_ids=server_ids)
+
+    _retry_failed_servers(self, statuses, (uuid, action, reason, ip, with_ip))
 
 
 @celery.task()
 def api_new_message_task(to_player_id, from_user_id):
-    from standardweb.lib.api import api_call
+    from standardweb.lib.api import queue_api_call
 
     to_player = Player.query.get(to_player_id)
     from_user = User.query.get(from_user_id)
@@ -73,4 +91,13 @@ def api_new_message_task(to_player_id, from_user_id):
             'url': url
         }
 
-        api_call(server, 'new_message', data=data)
\ No newline at end of file
+        queue_api_call(server, 'new_message', data=data)
+
+
+@celery.task()
+def api_batch_flush_task(server_id):
+    from standardweb.lib.api import flush_queued_api_calls
+
+    server = Server.query.get(server_id)
+
+    flush_queued_api_calls(server)
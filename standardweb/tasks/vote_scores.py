@@ -3,7 +3,6 @@ from sqlalchemy import func
 from sqlalchemy.orm import joinedload
 
 from standardweb import celery, db
-from standardweb.lib import player as libplayer
 from standardweb.models import ForumPost, ForumPostVote, PlayerStats, Server
 
 
@@ -11,12 +10,10 @@ MAX_USER_ACTIVE_MULTIPLIER_TIME = 48000  # time in minutes before a player gets
 MAX_VOTE_WEIGHT_TIME = 4320  # time in minutes before a vote no longer affects post score
 
 
-def _calculate_player_time_weight(player_id):
+def _calculate_player_time_weight(player):
     """Return a weight between 0.0 and 1.0 that is proportional to the user's
     total time spent on the server."""
-    total_time = libplayer.get_total_player_time(player_id)
-
-    player_time_weight = min(1.0, float(total_time) / MAX_USER_ACTIVE_MULTIPLIER_TIME)
+    player_time_weight = min(1.0, float(player.total_time) / MAX_USER_ACTIVE_MULTIPLIER_TIME)
 
     return player_time_weight
 
@@ -31,8 +28,8 @@ def calculate_user_score_weight(user):
         # the lower the user's score, the less weight their votes have
         weight = 1 / (-user_score + 2)
 
-    if user.player_id:
-        player_time_weight = _calculate_player_time_weight(user.player_id)
+    if user.player:
+        player_time_weight = _calculate_player_time_weight(user.player)
 
         weight *= player_time_weight
 
@@ -1,26 +1,77 @@
+from flask import g, has_request_context
 import pytz
 
 from jinja2.nodes import Markup
 
 from standardweb import app
+from standardweb.lib import faces
+
+
+def _face_macros():
+    return app.jinja_env.get_template('includes/faces.html').module
 
 
 def _face_image(uuid, size, scaled_size=None):
     scaled_size = scaled_size or size
 
     cls = 'face-thumb' if size == 16 else 'face-large'
-    return '<img src="/face/%(size)d/%(uuid)s.png" class="%(cls)s" width="%(scaled_size)d" height="%(scaled_size)d">' \
-           % {'size': size, 'scaled_size': scaled_size, 'cls': cls, 'uuid': uuid}
+    return _face_macros().face_image(uuid, size, scaled_size, cls)
+
+
+def apply_face_sprites(html, thumbs):
+    """
+    Replaces the face thumbnails in a page, given as a map of the markup of each
+    thumbnail to its (uuid, scaled size), with the same faces in sprites of up to
+    FACE_SPRITE_MAX_FACES faces, so the page needs one image request per sprite
+    rather than one per face.
+
+    The faces are put in sprites in order of uuid rather than where they are on
+    the page, so pages showing the same players share the same sprites.
+    """
+    thumbs = {markup: thumb for markup, thumb in thumbs.iteritems() if markup in html}
+
+    uuids = sorted(set(uuid for uuid, _ in thumbs.itervalues()))
+
+    if len(uuids) < 2:
+        return html
+
+    max_faces = app.config['FACE_SPRITE_MAX_FACES']
+    positions = {}
+
+    for i in xrange(0, len(uuids), max_faces):
+        sprite_uuids = uuids[i:i + max_faces]
+        sprite_hash = faces.register_sprite(sprite_uuids)
+
+        if not sprite_hash:
+            return html
+
+        for index, uuid in enumerate(sprite_uuids):
+            positions[uuid] = (sprite_hash, index, len(sprite_uuids))
+
+    macros = _face_macros()
+
+    for markup, (uuid, scaled_size) in thumbs.iteritems():
+        sprite_hash, index, count = positions[uuid]
+
+        html = html.replace(markup, macros.face_sprite(sprite_hash, index, count, scaled_size, 'face-thumb'))
+
+    return html
 
 
 @app.template_filter('face_thumb')
 def face_thumb(uuid, scaled_size=16):
-    return Markup(_face_image(uuid, 16, scaled_size=scaled_size))
+    markup = _face_image(uuid, 16, scaled_size=scaled_size)
+
+    if has_request_context():
+        # let the page's faces be swapped for sprites once it's rendered
+        g.setdefault('face_thumbs', {})[markup] = (uuid, scaled_size)
+
+    return markup
 
 
 @app.template_filter('face_large')
 def face_large(uuid):
-    return Markup(_face_image(uuid, 64))
+    return _face_image(uuid, 64)
 
 
 @app.template_filter('from_now')
@@ -1,6 +1,10 @@
-from flask import abort, redirect, render_template, url_for
+from datetime import datetime, timedelta
+
+from flask import abort, jsonify, redirect, render_template, request, url_for
 
 from standardweb import app
+from standardweb.lib import ores as libores
+from standardweb.lib import registry
 from standardweb.models import Server
 from standardweb.views.decorators.auth import login_required
 
@@ -26,3 +30,89 @@ def admin(server_id=None):
     }
 
     return render_template('admin.html', **retval)
+
+
+def _get_date_range():
+    try:
+        end_date = datetime.strptime(request.args['end'], '%Y-%m-%d').date() \
+            if request.args.get('end') else datetime.utcnow().date()
+        start_date = datetime.strptime(request.args['start'], '%Y-%m-%d').date() \
+            if request.args.get('start') else end_date - timedelta(days=30)
+    except ValueError:
+        abort(400)
+
+    return start_date, end_date
+
+
+@app.route('/<int:server_id>/admin/ore_tiles')
+@login_required(only_admin=True)
+def ore_tiles(server_id):
+    server = Server.query.get(server_id)
+
+    if not server:
+        abort(404)
+
+    start_date, end_date = _get_date_range()
+
+    try:
+        min_x, min_z, max_x, max_z = [int(request.args[arg]) for arg in ('min_x', 'min_z', 'max_x', 'max_z')]
+    except (KeyError, ValueError):
+        abort(400)
+
+    if max_x < min_x or max_z < min_z:
+        abort(400)
+
+    resolution = request.args.get('resolution', libores.CHUNK)
+    if resolution not in (libores.CHUNK, libores.REGION):
+        abort(400)
+
+    # chunk tiles are only served for areas small enough to render
+    chunk_count = ((max_x >> 4) - (min_x >> 4) + 1) * ((max_z >> 4) - (min_z >> 4) + 1)
+    if resolution == libores.CHUNK and chunk_count > app.config['ORE_TILES_MAX_CHUNKS']:
+        abort(400)
+
+    types = request.args.get('types')
+    if types:
+        material_types = [registry.material_types.get(type) for type in types.split(',')]
+    else:
+        material_types = registry.get_ores()
+
+    tiles = libores.get_tiles(
+        server,
+        [material_type.id for material_type in material_types if material_type],
+        min_x, min_z, max_x, max_z,
+        start_date, end_date,
+        resolution=resolution
+    )
+
+    return jsonify({
+        'resolution': resolution,
+        'tiles': [{
+            'x': x,
+            'z': z,
+            'count': count
+        } for x, z, count in tiles]
+    })
+
+
+@app.route('/<int:server_id>/admin/xray_scores')
+@login_required(only_admin=True)
+def xray_scores(server_id):
+    server = Server.query.get(server_id)
+
+    if not server:
+        abort(404)
+
+    start_date, end_date = _get_date_range()
+
+    scores = libores.get_xray_scores(server, start_date, end_date)
+
+    return jsonify({
+        'scores': [{
+            'player': score['player'].to_dict(),
+            'score': round(score['score'], 2),
+            'total': score['total'],
+            'rare': score['rare'],
+            'rare_chunk_days': score['rare_chunk_days']
+        } for score in scores]
+    })
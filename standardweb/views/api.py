@@ -15,10 +15,16 @@ from sqlalchemy import or_
 from sqlalchemy.orm import joinedload
 
 from standardweb import app, db, stats
+from standardweb.lib import autocomplete
+from standardweb.lib import counters as libcounters
+from standardweb.lib import credentials
+from standardweb.lib import events as libevents
 from standardweb.lib import forums as libforums
 from standardweb.lib import helpers as h
+from standardweb.lib import ores as libores
 from standardweb.lib import player as libplayer
 from standardweb.lib import realtime
+from standardweb.lib import registry
 from standardweb.lib.csrf import exempt_funcs
 from standardweb.lib.email import (
     send_creation_email,
@@ -29,7 +35,7 @@ from standardweb.lib.email import (
 from standardweb.lib.notifications import InvalidNotificationError
 from standardweb.lib.notifier import notify_new_message
 from standardweb.models import (
-    Server, Player, DeathType, DeathEvent, KillCount, KillEvent, KillType, MaterialType,
+    Server, Player, DeathEvent, KillCount, KillEvent,
     OreDiscoveryEvent, OreDiscoveryCount, EmailToken, User, PlayerStats, Message,
     AuditLog, DeathCount, Notification
 )
@@ -84,11 +90,12 @@ def server_api_func(function):
     def decorator(*args, **kwargs):
         server = None
 
-        if request.headers.get('Authorization'):
-            auth = request.headers['Authorization'].split(' ')[1]
-            server_id, secret_key = auth.strip().decode('base64').split(':')
+        with stats.timer('server_api_auth.%s' % function.__name__):
+            if request.headers.get('Authorization'):
+                auth = request.headers['Authorization'].split(' ')[1]
+                server_id, secret_key = auth.strip().decode('base64').split(':')
 
-            server = Server.query.filter_by(id=server_id, secret_key=secret_key).first()
+                server = credentials.get_server(server_id, secret_key)
 
         if not server:
             abort(403)
@@ -102,8 +109,34 @@ def server_api_func(function):
     return decorator
 
 
+def _queue_events(events):
+    try:
+        events = libevents.validate_events(events)
+    except libevents.InvalidEventError:
+        return jsonify({
+            'err': 1,
+            'message': 'Invalid events'
+        }), 400
+
+    libevents.queue_events(g.server, events, idempotency_key=request.headers.get('Idempotency-Key'))
+
+    return jsonify({
+        'err': 0
+    }), 202
+
+
+def _queue_form_event(event):
+    return _queue_events([dict(
+        {key: value for key, value in request.form.iteritems() if value},
+        event=event
+    )])
+
+
 @server_api_func
 def log_death():
+    if app.config['EVENT_INGEST_ASYNC']:
+        return _queue_form_event(libevents.DEATH)
+
     type = request.form.get('type')
     victim_uuid = request.form.get('victim_uuid')
     killer_uuid = request.form.get('killer_uuid')
@@ -113,16 +146,24 @@ def log_death():
     if victim_uuid == killer_uuid:
         type = 'suicide'
 
-    death_type = DeathType.factory(type=type)
+    if not type:
+        return jsonify({
+            'err': 1
+        })
+
+    death_type = registry.death_types.get_or_create(type)
 
     if type == 'player':
         killer = Player.query.filter_by(uuid=killer_uuid).first()
 
-        death_event = DeathEvent(server=g.server, death_type=death_type, victim=victim, killer=killer)
-        DeathCount.increment(g.server, death_type, victim, killer, commit=False)
+        death_event = DeathEvent(server=g.server, death_type_id=death_type.id, victim=victim, killer=killer)
     else:
-        death_event = DeathEvent(server=g.server, death_type=death_type, victim=victim)
-        DeathCount.increment(g.server, death_type, victim, None, commit=False)
+        killer = None
+        death_event = DeathEvent(server=g.server, death_type_id=death_type.id, victim=victim)
+
+    libcounters.increment(DeathCount, {
+        (g.server.id, death_type.id, victim.id if victim else None, killer.id if killer else None): 1
+    })
 
     death_event.save(commit=True)
 
@@ -133,19 +174,22 @@ def log_death():
 
 @server_api_func
 def log_kill():
+    if app.config['EVENT_INGEST_ASYNC']:
+        return _queue_form_event(libevents.KILL)
+
     type = request.form.get('type')
     killer_uuid = request.form.get('killer_uuid')
 
     killer = Player.query.filter_by(uuid=killer_uuid).first()
-    if not killer:
+    if not killer or not type:
         return jsonify({
             'err': 1
         })
 
-    kill_type = KillType.factory(type=type)
+    kill_type = registry.kill_types.get_or_create(type)
 
-    kill_event = KillEvent(server=g.server, kill_type=kill_type, killer=killer)
-    KillCount.increment(g.server, kill_type, killer, commit=False)
+    kill_event = KillEvent(server=g.server, kill_type_id=kill_type.id, killer=killer)
+    libcounters.increment(KillCount, {(g.server.id, kill_type.id, killer.id): 1})
 
     kill_event.save(commit=True)
 
@@ -156,6 +200,9 @@ def log_kill():
 
 @server_api_func
 def log_ore_discovery():
+    if app.config['EVENT_INGEST_ASYNC']:
+        return _queue_form_event(libevents.ORE_DISCOVERY)
+
     uuid = request.form.get('uuid')
     type = request.form.get('type')
     x = int(request.form.get('x'))
@@ -164,16 +211,23 @@ def log_ore_discovery():
 
     player = Player.query.filter_by(uuid=uuid).first()
 
-    if not player:
+    if not player or not type:
         return jsonify({
             'err': 1
         })
 
-    material_type = MaterialType.factory(type=type)
+    material_type = registry.material_types.get_or_create(type)
 
-    ore_event = OreDiscoveryEvent(server=g.server, material_type=material_type,
+    ore_event = OreDiscoveryEvent(server=g.server, material_type_id=material_type.id,
                                   player=player, x=x, y=y, z=z)
-    OreDiscoveryCount.increment(g.server, material_type, player, commit=False)
+    libcounters.increment(OreDiscoveryCount, {(g.server.id, material_type.id, player.id): 1})
+    libores.record_discoveries([{
+        'server_id': g.server.id,
+        'material_type_id': material_type.id,
+        'player_id': player.id,
+        'x': x,
+        'z': z
+    }])
 
     ore_event.save(commit=True)
 
@@ -182,6 +236,30 @@ def log_ore_discovery():
     })
 
 
+@server_api_func
+def log_events():
+    body = request.json or {}
+
+    if app.config['EVENT_INGEST_ASYNC']:
+        return _queue_events(body.get('events'))
+
+    try:
+        events = libevents.validate_events(body.get('events'))
+    except libevents.InvalidEventError:
+        return jsonify({
+            'err': 1,
+            'message': 'Invalid events'
+        }), 400
+
+    count = libevents.log_events(g.server, events)
+
+    stats.incr('events.logged', count)
+
+    return jsonify({
+        'err': 0
+    })
+
+
 @server_api_func
 def register():
     uuid = request.form.get('uuid')
@@ -225,8 +303,7 @@ def register():
     else:
         send_creation_email(email, uuid, username)
 
-    total_time = libplayer.get_total_player_time(player.id)
-    if total_time < app.config['MINIMUM_REGISTER_PLAYER_TIME']:
+    if player.total_time < app.config['MINIMUM_REGISTER_PLAYER_TIME']:
         rollbar.report_message('Player creating user account super quickly', level='error', request=request)
         AuditLog.create(
             AuditLog.QUICK_USER_CREATE,
@@ -261,14 +338,8 @@ def rank_query():
         ).first()
 
         if not player:
-            player = Player.query.options(
-                joinedload(Player.titles)
-            ).filter(
-                or_(
-                    Player.username.ilike('%%%s%%' % username),
-                    Player.nickname.ilike('%%%s%%' % username)
-                )
-            ).first()
+            players = libplayer.filter_players(username, page_size=1)
+            player = players[0] if players else None
 
     if not player:
         return jsonify({
@@ -527,28 +598,19 @@ def contact_query():
     contacts = []
 
     if query:
-        players = libplayer.filter_players(query, page_size=10)
-
         contacts = [{
-            'player_id': player.id,
-            'username': player.username,
-            'nickname': player.nickname,
-            'displayname_html': player.displayname_html
-        } for player in players]
-
-        users = User.query.filter(
-            User.username.ilike('%%%s%%' % query)
-        ).order_by(
-            User.username.desc()
-        )
-
-        for user in users:
-            contacts.insert(0, {
-                'user_id': user.id,
-                'username': user.username,
-                'nickname': None,
-                'displayname_html': user.username
-            })
+            'user_id': user_id,
+            'username': data['username'],
+            'nickname': None,
+            'displayname_html': data['username']
+        } for user_id, data in autocomplete.complete(query, autocomplete.USER)]
+
+        contacts.extend({
+            'player_id': player_id,
+            'username': data['username'],
+            'nickname': data['nickname'],
+            'displayname_html': data['displayname_html']
+        } for player_id, data in autocomplete.complete(query, autocomplete.PLAYER))
 
     return jsonify({
         'err': 0,
@@ -1,27 +1,19 @@
-import json
-from datetime import datetime
 from datetime import timedelta
-import os
-import subprocess
+import re
 
-from flask import abort, flash, g, jsonify, redirect, request, render_template, send_file, url_for
-from PIL import Image
-import requests
+from flask import abort, flash, g, jsonify, make_response, redirect, request, render_template, send_file, url_for
 import rollbar
 import StringIO
 
 from standardweb import app
-from standardweb.lib import leaderboards as libleaderboards, mojang, exceptions
+from standardweb.lib import faces
+from standardweb.lib import leaderboards as libleaderboards
 from standardweb.lib import player as libplayer
 from standardweb.lib import server as libserver
-from standardweb.models import Server, ServerStatus, MojangStatus
-from standardweb.views.decorators.cache import last_modified
+from standardweb.models import Server, ServerStatusRollup, MojangStatus
 from standardweb.views.decorators.redirect import redirect_route
 
 
-PROJECT_PATH = os.path.abspath(os.path.dirname(__name__))
-
-
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -87,9 +79,16 @@ def player_graph(server_id=None):
     if week_index is None:
         graph_data = libserver.get_player_graph_data(server)
     else:
-        first_status = ServerStatus.query.filter_by(server=server).order_by('timestamp').first()
+        # raw statuses get archived, the daily rollups go back to the beginning
+        first_rollup = ServerStatusRollup.query.filter_by(
+            server=server,
+            resolution=ServerStatusRollup.DAY
+        ).order_by(ServerStatusRollup.timestamp).first()
+
+        if not first_rollup:
+            abort(404)
 
-        timestamp = first_status.timestamp + int(week_index) * timedelta(days=7)
+        timestamp = first_rollup.timestamp + int(week_index) * timedelta(days=7)
         start_date = timestamp
         end_date = timestamp + timedelta(days=7)
 
@@ -128,7 +127,11 @@ def leaderboards(server_id=None):
 
     server = Server.query.get(server_id)
 
-    kill_leaderboards, ore_leaderboards = libleaderboards.get_leaderboard_data(server)
+    window = request.args.get('window')
+    if window not in libleaderboards.WINDOWS:
+        window = None
+
+    kill_leaderboards, ore_leaderboards = libleaderboards.get_leaderboard_data(server, window=window)
 
     leaderboard_sections = [{
         'active': True,
@@ -142,118 +145,75 @@ def leaderboards(server_id=None):
     retval = {
         'server': server,
         'servers': Server.get_survival_servers(),
-        'leaderboard_sections': leaderboard_sections
+        'leaderboard_sections': leaderboard_sections,
+        'window': window,
+        'windows': [
+            (None, 'All Time'),
+            (libleaderboards.MONTH, 'Last 30 Days'),
+            (libleaderboards.WEEK, 'Last 7 Days'),
+            (libleaderboards.DAY, 'Today')
+        ]
     }
 
     return render_template('leaderboards.html', **retval)
 
 
-def _face_last_modified(uuid, size=16):
-    path = '%s/standardweb/faces/%s/%s.png' % (PROJECT_PATH, size, uuid.replace('-', ''))
-
-    try:
-        return datetime.utcfromtimestamp(os.path.getmtime(path))
-    except:
-        return None
-
-
 @redirect_route('/faces/<username>.png')
 @redirect_route('/faces/<int:size>/<uuid>.png')
 @app.route('/face/<uuid>.png')
 @app.route('/face/<int:size>/<uuid>.png')
-@last_modified(_face_last_modified)
 def face(uuid, size=16):
     size = int(size)
 
-    if size not in (16, 64):
+    if not faces.is_valid_size(size):
         abort(404)
 
     uuid = uuid.replace('-', '')
 
-    path = '%s/standardweb/faces/%s/%s.png' % (PROJECT_PATH, size, uuid)
-
-    image = None
-
-    try:
-        file_date = datetime.utcfromtimestamp(os.path.getmtime(path))
-    except Exception:
-        file_date = None
+    # never fetch the skin in the request, serve what's in the store and refresh it in the background
+    face_hash, last_modified, _ = faces.get_face(uuid)
+    etag = faces.get_etag(face_hash, size)
 
-    # if the image exists on disk already and it's not too old, just load it
-    if file_date and datetime.utcnow() - file_date < timedelta(hours=12):
-        image = Image.open(path)
-    # otherwise query the player's profile through the mojang api and get the skin url
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
     else:
-        try:
-            profile = mojang.get_player_profile(uuid)
-        except exceptions.RemoteRateLimitException:
-            # rate limited, don't save default image to disk in this case
-            return send_file(_write_face_img_result(_get_default_skin(size)), mimetype="image/png")
-        except:
-            pass
-        else:
-            properties = profile.get('properties', [])
-
-            for property in properties:
-                if property and property.get('name') == 'textures':
-                    value = property['value'].decode('base64')
-                    value_dict = json.loads(value)
-                    skin_url = value_dict.get('textures', {}).get('SKIN', {}).get('url')
-
-                    if skin_url:
-                        try:
-                            resp = requests.get(skin_url, timeout=1)
-                        except Exception:
-                            pass
-                        else:
-                            if resp.status_code == 200:
-                                images = _save_skin_images(resp.content, uuid)
-                                image = images[size]
-
-    if not image:
-        try:
-            # try opening existing image if it exists on disk if any of the above fails
-            image = Image.open(path)
-        except IOError:
-            pass
-
-    if not image:
-        image = _get_default_skin(size)
-        image.save(path)
+        not_modified = bool(
+            last_modified and request.if_modified_since and
+            request.if_modified_since >= last_modified.replace(microsecond=0)
+        )
 
-    return send_file(_write_face_img_result(image), mimetype="image/png")
+    if not_modified:
+        resp = make_response('', 304)
+    else:
+        face_hash, path = faces.get_face_path(uuid, face_hash, size)
+        etag = faces.get_etag(face_hash, size)
 
+        resp = send_file(path, mimetype='image/png', add_etags=False, last_modified=last_modified)
 
-def _write_face_img_result(image):
-    tmp = StringIO.StringIO()
-    image.save(tmp, 'PNG', optimize=True)
-    tmp.seek(0)
-    return tmp
+    resp.set_etag(etag)
 
+    if last_modified:
+        resp.last_modified = last_modified
 
-def _get_default_skin(size):
-    return libplayer.extract_face(Image.open(PROJECT_PATH + '/standardweb/static/images/char.png'), size)
+    return resp
 
 
-def _save_skin_images(image, uuid):
-    return {
-        16: _save_skin_image(image, 16, uuid),
-        64: _save_skin_image(image, 64, uuid)
-    }
+@app.route('/face_sprite/<sprite_hash>.png')
+def face_sprite(sprite_hash):
+    result = faces.get_sprite(sprite_hash) if re.match(r'^[0-9a-f]{40}$', sprite_hash) else None
 
+    if not result:
+        abort(404)
 
-def _save_skin_image(image_content, size, uuid):
-    path = '%s/standardweb/faces/%s/%s.png' % (PROJECT_PATH, size, uuid)
+    png, complete = result
 
-    image = libplayer.extract_face(Image.open(StringIO.StringIO(image_content)), size)
-    image.save(path, optimize=True)
+    resp = send_file(StringIO.StringIO(png), mimetype='image/png')
 
-    try:
-        subprocess.Popen(['optipng', path], stderr=subprocess.PIPE)
-    except OSError:
-        rollbar.report_exc_info(request=request)
+    # sprites with default faces in place of ones still being fetched shouldn't stick around
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config['FACE_SPRITE_MAX_AGE' if complete else 'FACE_SPRITE_PARTIAL_MAX_AGE']
 
-    return image
+    return resp
 
 
 @app.route('/chat')